@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+"""
+   Cache admission policies for pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import threading
+
+from array import array
+
+from lrucache import LRUCache
+
+"""
+# Decides whether a file which has nothing cached yet should be cached when
+# it is opened. Files which are not admitted are read straight from the
+# origin, so that a scan through many files which are each read once (a
+# backup, or a find -exec md5sum) does not fill the cache with them.
+#
+# Files larger than max_file_size (if it is not 0) are never admitted;
+# subclasses decide which of the rest are.
+"""
+class AdmissionPolicy(object):
+	# Name of the policy, as given to --admission
+	policy = None
+
+	def __init__(self, max_file_size = 0):
+		self.max_file_size = max_file_size
+
+		self.admitted = 0
+		self.rejected = 0
+
+		self._lock = threading.Lock()
+
+	"""
+	# Record that path, described by stat, has been opened, and return True
+	# if its data should now be cached.
+	"""
+	def admit(self, path, stat):
+		with self._lock:
+			if self.max_file_size > 0 and stat.st_size > self.max_file_size:
+				result = False
+			else:
+				result = self._admit(path)
+
+			if result:
+				self.admitted += 1
+			else:
+				self.rejected += 1
+
+		self._maintain()
+		return result
+
+	""" Return the policy name and how many opens it has admitted and rejected. """
+	def stats(self):
+		return {
+			'policy': self.policy,
+			'admitted': self.admitted,
+			'rejected': self.rejected,
+		}
+
+	def _admit(self, path):
+		raise NotImplementedError()
+
+	# Called after each admit(), without the lock held, for housekeeping
+	# which should not hold up other opens
+	def _maintain(self):
+		pass
+
+"""
+# Admits every file (within max_file_size).
+"""
+class AlwaysAdmit(AdmissionPolicy):
+	policy = 'always'
+
+	def __init__(self, max_file_size = 0, count = None):
+		AdmissionPolicy.__init__(self, max_file_size)
+
+	def _admit(self, path):
+		return True
+
+"""
+# Admits a file once it has been opened count times. The counts of up to
+# max_paths recently opened files are remembered.
+"""
+class NthAccessAdmission(AdmissionPolicy):
+	policy = 'nth'
+
+	DEFAULT_MAX_PATHS = 100000
+
+	def __init__(self, max_file_size = 0, count = 2, max_paths = DEFAULT_MAX_PATHS):
+		AdmissionPolicy.__init__(self, max_file_size)
+
+		self.count = count
+		self._counts = LRUCache(max_paths)
+
+	def _admit(self, path):
+		opens = self._counts.get(path, 0, count = False) + 1
+
+		if opens >= self.count:
+			self._counts.invalidate(path)
+			return True
+
+		self._counts.put(path, opens)
+		return False
+
+	def stats(self):
+		result = AdmissionPolicy.stats(self)
+		result['tracked_files'] = len(self._counts)
+		return result
+
+"""
+# Admits a file once it has been opened count times recently, estimating
+# how often each file is opened with a count-min sketch as in TinyLFU
+# (Einziger, Friedman and Manes, 2017). This takes a fixed amount of memory
+# however many files there are, at the cost of occasionally admitting a file
+# early when it shares counters with others.
+#
+# The sketch has depth rows of width counters each, which saturate at 15.
+# Once width * 10 opens have been recorded every counter is halved, so that
+# files which were popular long ago must earn their place again. Each row is
+# halved in one pass through a translation table, taking the lock for one
+# row at a time, by the open which was recorded last.
+"""
+class TinyLFUAdmission(AdmissionPolicy):
+	policy = 'tinylfu'
+
+	DEFAULT_WIDTH = 65536
+	DEPTH = 4
+	MAX_COUNT = 15
+
+	# Maps each counter value to half of it
+	HALVE = ''.join([ chr(i >> 1) for i in range(256) ])
+
+	def __init__(self, max_file_size = 0, count = 2, width = DEFAULT_WIDTH):
+		AdmissionPolicy.__init__(self, max_file_size)
+
+		self.count = count
+		self.width = width
+		self.sample_size = width * 10
+
+		self._rows = [ array('B', [ 0 ]) * width for i in range(self.DEPTH) ]
+		self._recorded = 0
+		self._reset_due = False
+		self.resets = 0
+
+	def _admit(self, path):
+		return self._increment(path) >= self.count
+
+	# Count an open of path, returning its estimated number of opens
+	def _increment(self, path):
+		indexes = self._indexes(path)
+		estimate = min([ row[i] for (row, i) in zip(self._rows, indexes) ])
+
+		# only the smallest counters are incremented (conservative update),
+		# which keeps the others from overestimating
+		if estimate < self.MAX_COUNT:
+			for (row, i) in zip(self._rows, indexes):
+				if row[i] == estimate:
+					row[i] += 1
+			estimate += 1
+
+		self._recorded += 1
+		if self._recorded >= self.sample_size:
+			self._recorded = 0
+			self._reset_due = True
+
+		return estimate
+
+	def _indexes(self, path):
+		return [ hash((seed, path)) % self.width for seed in range(self.DEPTH) ]
+
+	def _maintain(self):
+		with self._lock:
+			if not self._reset_due:
+				return
+			self._reset_due = False
+
+		for i in range(self.DEPTH):
+			with self._lock:
+				self._rows[i] = array('B', self._rows[i].tostring().translate(self.HALVE))
+
+		with self._lock:
+			self.resets += 1
+
+	def stats(self):
+		result = AdmissionPolicy.stats(self)
+		result['resets'] = self.resets
+		return result
+
+# Admission policies available by name, for --admission
+ADMISSION_POLICIES = {
+	AlwaysAdmit.policy: AlwaysAdmit,
+	NthAccessAdmission.policy: NthAccessAdmission,
+	TinyLFUAdmission.policy: TinyLFUAdmission,
+}
+
+"""
+# Return a new AdmissionPolicy of the named kind, admitting files once they
+# have been opened count times and never those larger than max_file_size
+# (0 means no limit). Raises ValueError if there is no such policy.
+"""
+def create_admission_policy(policy, count = 2, max_file_size = 0):
+	if policy not in ADMISSION_POLICIES:
+		raise ValueError('Unknown admission policy ' + repr(policy) + '; choose from ' + ', '.join(sorted(ADMISSION_POLICIES.keys())))
+
+	if count < 1:
+		raise ValueError('count (' + str(count) + ') must be at least 1')
+
+	return ADMISSION_POLICIES[policy](max_file_size, count)
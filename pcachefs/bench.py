@@ -0,0 +1,492 @@
+#!/usr/bin/python
+
+"""
+   pcachefs-bench: measures pCacheFS performance against a slow origin
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import pcachefsutil
+
+from pcachefs import (Cacher, UnderlyingFs)
+from pcachefsutil import parse_size
+from metadata import create_store
+from compression import create_codec
+from memorycache import (POLICIES, create_memory_cache)
+from stats import Stats
+
+USAGE = """%prog [options]
+
+Benchmark a Cacher reading from a generated dataset through an origin
+which adds a fixed latency to every request and limits the bandwidth of
+reads. Each scenario is run twice against an empty cache directory: once
+cold, filling the cache, then again warm. Results are written as JSON.
+
+With --mount, the scenarios are also run through a pCacheFS mount of
+--data-dir, which must be mounted at MOUNTPOINT with an empty cache
+directory. Requests made by the mount are not slowed down, unless the
+target directory is itself slow."""
+
+# Version of the JSON results format
+FORMAT_VERSION = 1
+
+# Scenarios in the order they are run
+SCENARIOS = [ 'sequential_read', 'random_read', 'tree_walk', 'large_listing' ]
+
+"""
+# An UnderlyingFs which sleeps for latency seconds before every request,
+# and for as long as reading the data at bandwidth bytes per second would
+# take before every read, counting the requests made of each kind.
+"""
+class SlowUnderlyingFs(UnderlyingFs):
+	def __init__(self, real_path, latency = 0, bandwidth = 0, stat_threads = 0):
+		UnderlyingFs.__init__(self, real_path, stat_threads)
+
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.requests = Stats()
+
+	def _delay(self, operation, nbytes = 0):
+		self.requests.add(operation)
+
+		delay = self.latency
+		if self.bandwidth > 0:
+			delay += float(nbytes) / self.bandwidth
+
+		if delay > 0:
+			time.sleep(delay)
+
+	def getattr(self, path):
+		self._delay('getattr')
+		return UnderlyingFs.getattr(self, path)
+
+	def readdir(self, path, offset):
+		self._delay('readdir')
+		return UnderlyingFs.readdir(self, path, offset)
+
+	def open(self, path):
+		self._delay('open')
+		return UnderlyingFs.open(self, path)
+
+	def read(self, path, size, offset, fh = None):
+		result = UnderlyingFs.read(self, path, size, offset, fh)
+		self._delay('read', len(result))
+		return result
+
+	def open_writable(self, path):
+		self._delay('open')
+		return UnderlyingFs.open_writable(self, path)
+
+	def write(self, path, buf, offset, fh = None):
+		self._delay('write', len(buf))
+		return UnderlyingFs.write(self, path, buf, offset, fh)
+
+	def truncate(self, path, size, fh = None):
+		self._delay('truncate')
+		return UnderlyingFs.truncate(self, path, size, fh)
+
+	def fsync(self, path, fh):
+		self._delay('fsync')
+		return UnderlyingFs.fsync(self, path, fh)
+
+	def total_requests(self):
+		return sum(self.requests.values().values())
+
+"""
+# Runs the operations of a scenario against a Cacher, as the mount would.
+"""
+class CacherClient(object):
+	def __init__(self, cacher):
+		self.cacher = cacher
+
+	def read(self, path, size, offsets):
+		fh = self.cacher.open(path, os.O_RDONLY)
+		try:
+			return sum([ len(self.cacher.read(path, size, offset, fh)) for offset in offsets ])
+		finally:
+			self.cacher.release(path, fh)
+
+	def listdir(self, path):
+		return [ e.name for e in self.cacher.readdir(path, 0) if e.name not in ('.', '..') ]
+
+	def stat(self, path):
+		return self.cacher.getattr(path)
+
+"""
+# Runs the operations of a scenario through a mounted filesystem.
+"""
+class MountClient(object):
+	def __init__(self, mountpoint):
+		self.mountpoint = mountpoint
+
+	def _real_path(self, path):
+		return os.path.join(self.mountpoint, path[1:])
+
+	def read(self, path, size, offsets):
+		total = 0
+		with open(self._real_path(path), 'rb') as f:
+			for offset in offsets:
+				f.seek(offset)
+				total += len(f.read(size))
+		return total
+
+	def listdir(self, path):
+		return os.listdir(self._real_path(path))
+
+	def stat(self, path):
+		return os.stat(self._real_path(path))
+
+"""
+# The shape of the generated dataset:
+#
+# files and file_size the number and size of the files read sequentially,
+#   and again of those read at random offsets
+# read_size the number of bytes asked for by each read
+# random_reads the number of reads made of each randomly read file
+# tree_fanout and tree_depth the number of subdirectories and files in
+#   each directory of the tree walked, and the depth of the tree
+# dir_entries the number of files in the large directory listed
+"""
+class Dataset(object):
+	# Written once the dataset is complete, so that it can be reused
+	MARKER = '.pcachefs-bench'
+
+	def __init__(self, root, files = 8, file_size = 4 * 1024 * 1024, read_size = 128 * 1024,
+			random_reads = 256, tree_fanout = 6, tree_depth = 3, dir_entries = 5000, seed = 0):
+		self.root = root
+		self.files = files
+		self.file_size = file_size
+		self.read_size = read_size
+		self.random_reads = random_reads
+		self.tree_fanout = tree_fanout
+		self.tree_depth = tree_depth
+		self.dir_entries = dir_entries
+		self.seed = seed
+
+	def config(self):
+		return dict([ (k, v) for (k, v) in self.__dict__.items() if k != 'root' ])
+
+	""" Create the dataset under root, unless it was already created with the same shape. """
+	def create(self):
+		marker = os.path.join(self.root, self.MARKER)
+		if os.path.exists(marker):
+			with open(marker) as f:
+				if json.load(f) == self.config():
+					return
+
+		for name in [ 'sequential', 'random', 'tree', 'listing' ]:
+			path = os.path.join(self.root, name)
+			if os.path.exists(path):
+				shutil.rmtree(path)
+			os.makedirs(path)
+
+		for name in [ 'sequential', 'random' ]:
+			for path in self._files(name):
+				with open(os.path.join(self.root, path[1:]), 'wb') as f:
+					f.write(os.urandom(self.file_size))
+
+		self._create_tree(os.path.join(self.root, 'tree'), self.tree_depth)
+
+		for i in xrange(self.dir_entries):
+			open(os.path.join(self.root, 'listing', 'entry-%d' % i), 'wb').close()
+
+		with open(marker, 'w') as f:
+			json.dump(self.config(), f)
+
+	def _create_tree(self, path, depth):
+		for i in xrange(self.tree_fanout):
+			with open(os.path.join(path, 'file-%d' % i), 'wb') as f:
+				f.write('x' * 100)
+
+		if depth > 1:
+			for i in xrange(self.tree_fanout):
+				subdir = os.path.join(path, 'dir-%d' % i)
+				os.mkdir(subdir)
+				self._create_tree(subdir, depth - 1)
+
+	def _files(self, name):
+		return [ '/%s/file-%d' % (name, i) for i in xrange(self.files) ]
+
+	def sequential_read(self, client):
+		offsets = range(0, self.file_size, self.read_size)
+		return [ (client.read, (path, self.read_size, offsets), self.file_size) for path in self._files('sequential') ]
+
+	def random_read(self, client):
+		rand = random.Random(self.seed)
+		last = max(self.file_size - self.read_size, 0)
+
+		operations = []
+		for path in self._files('random'):
+			offsets = [ rand.randint(0, last) for i in xrange(self.random_reads) ]
+			operations.append((client.read, (path, self.read_size, offsets), None))
+		return operations
+
+	def tree_walk(self, client):
+		return [ (self._walk, (client, '/tree'), None) ]
+
+	def large_listing(self, client):
+		return [ (self._list_and_stat, (client, '/listing'), None) ]
+
+	# List path and everything under it, stat'ing every entry as 'ls -lR' does
+	def _walk(self, client, path):
+		for name in client.listdir(path):
+			child = path + '/' + name
+			if name.startswith('dir-'):
+				self._walk(client, child)
+			else:
+				client.stat(child)
+		return 0
+
+	def _list_and_stat(self, client, path):
+		for name in client.listdir(path):
+			client.stat(path + '/' + name)
+		return 0
+
+"""
+# Run the operations of a scenario one after another, timing each. Returns
+# a dict of results.
+"""
+def run_operations(operations):
+	latencies = []
+	total_bytes = 0
+
+	started = time.time()
+	for (fn, args, expected) in operations:
+		op_started = time.time()
+		nbytes = fn(*args)
+		latencies.append(time.time() - op_started)
+
+		if expected is not None and nbytes != expected:
+			raise IOError('read %d bytes of %s, expected %d' % (nbytes, args[0], expected))
+		total_bytes += nbytes
+	seconds = max(time.time() - started, 1e-9)
+
+	latencies.sort()
+	return {
+		'seconds': seconds,
+		'operations': len(operations),
+		'bytes': total_bytes,
+		'mib_per_second': total_bytes / seconds / (1024 * 1024),
+		'operation_ms_p50': _percentile(latencies, 0.5) * 1000,
+		'operation_ms_max': latencies[-1] * 1000 if len(latencies) > 0 else 0,
+	}
+
+def _percentile(sorted_values, fraction):
+	if len(sorted_values) == 0:
+		return 0
+	return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+"""
+# Runs the scenarios of a Dataset against a new Cacher for each, created
+# by calling create_cacher(cachedir, underlying_fs) with an empty cache
+# directory and a SlowUnderlyingFs.
+"""
+class Benchmark(object):
+	def __init__(self, dataset, create_cacher, latency = 0, bandwidth = 0, stat_threads = 0):
+		self.dataset = dataset
+		self.create_cacher = create_cacher
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.stat_threads = stat_threads
+
+	""" Run the given scenarios against a Cacher, returning a list of results. """
+	def run_cacher(self, scenarios = SCENARIOS):
+		results = []
+
+		for scenario in scenarios:
+			cachedir = tempfile.mkdtemp(prefix = 'pcachefs-bench-')
+			try:
+				ufs = SlowUnderlyingFs(self.dataset.root, self.latency, self.bandwidth, self.stat_threads)
+				cacher = self.create_cacher(cachedir, ufs)
+				try:
+					client = CacherClient(cacher)
+
+					for phase in [ 'cold', 'warm' ]:
+						before = ufs.total_requests()
+
+						result = self._run(scenario, phase, 'cacher', client)
+						self._settle(cacher)
+
+						result['origin_requests'] = ufs.total_requests() - before
+						results.append(result)
+				finally:
+					cacher.close()
+			finally:
+				shutil.rmtree(cachedir)
+
+		return results
+
+	""" Run the given scenarios through a mount of the dataset at mountpoint. """
+	def run_mount(self, mountpoint, scenarios = SCENARIOS):
+		client = MountClient(mountpoint)
+		results = []
+
+		for scenario in scenarios:
+			for phase in [ 'cold', 'warm' ]:
+				results.append(self._run(scenario, phase, 'mount', client))
+
+		return results
+
+	def _run(self, scenario, phase, target, client):
+		result = run_operations(getattr(self.dataset, scenario)(client))
+		result.update({ 'scenario': scenario, 'phase': phase, 'target': target })
+		return result
+
+	# Let background prefetches finish, so that they neither slow down nor
+	# are counted against the next pass
+	def _settle(self, cacher):
+		if cacher.readahead is not None:
+			cacher.readahead.wait()
+
+def format_results(results):
+	lines = []
+	for r in results:
+		line = '%-16s %-5s %-7s %9.3fs %9.1f MiB/s %9.2fms p50' % (
+			r['scenario'], r['phase'], r['target'], r['seconds'], r['mib_per_second'], r['operation_ms_p50'])
+		if 'origin_requests' in r:
+			line += ' %7d origin requests' % r['origin_requests']
+		lines.append(line + '\n')
+	return ''.join(lines)
+
+def main(argv = None):
+	parser = OptionParser(usage = USAGE)
+	parser.add_option('-d', '--data-dir', dest='data_dir', default=None, help="Directory in which to generate the dataset, which is reused if it is already there. By default a temporary directory is used and removed afterwards.")
+	parser.add_option('-o', '--output', dest='output', default=None, help="Write the JSON results to this file rather than to stdout.")
+	parser.add_option('-s', '--scenarios', dest='scenarios', default=','.join(SCENARIOS), help="Comma-separated scenarios to run (default: " + ','.join(SCENARIOS) + ").")
+	parser.add_option('--mount', dest='mount', default=None, metavar='MOUNTPOINT', help="Also run the scenarios through a pCacheFS mount of --data-dir at MOUNTPOINT.")
+	parser.add_option('--latency', dest='latency', type='float', default=2, help="Milliseconds added to every request made of the origin (default 2).")
+	parser.add_option('--bandwidth', dest='bandwidth', default='100M', help="Bytes per second at which each read from the origin returns data, e.g. 100M (the default). 0 means unlimited.")
+	parser.add_option('--files', dest='files', type='int', default=8, help="Number of files read sequentially, and of files read at random (default 8).")
+	parser.add_option('--file-size', dest='file_size', default='4M', help="Size of each file read (default 4M).")
+	parser.add_option('--read-size', dest='read_size', default='128K', help="Bytes asked for by each read (default 128K).")
+	parser.add_option('--random-reads', dest='random_reads', type='int', default=256, help="Number of reads at random offsets made of each file (default 256).")
+	parser.add_option('--tree-fanout', dest='tree_fanout', type='int', default=6, help="Number of files and subdirectories in each directory of the tree walked (default 6).")
+	parser.add_option('--tree-depth', dest='tree_depth', type='int', default=3, help="Depth of the tree walked (default 3).")
+	parser.add_option('--dir-entries', dest='dir_entries', type='int', default=5000, help="Number of entries in the large directory listed (default 5000).")
+	parser.add_option('--block-size', dest='block_size', default=str(Cacher.DEFAULT_BLOCK_SIZE), help="Block size of the Cacher.")
+	parser.add_option('--readahead', dest='readahead', type='int', default=Cacher.DEFAULT_READAHEAD, help="Readahead window of the Cacher, in blocks.")
+	parser.add_option('--fetch-threads', dest='fetch_threads', type='int', default=Cacher.DEFAULT_FETCH_THREADS, help="Fetch threads of the Cacher.")
+	parser.add_option('--readdir-stat-threads', dest='readdir_stat_threads', type='int', default=8, help="Threads used to stat the entries of a listed directory (0 disables readdir stats).")
+	parser.add_option('--metadata-store', dest='metadata_store', default='file', help="Metadata store of the Cacher ('file' or 'sqlite').")
+	parser.add_option('--dedup', dest='dedup', action='store_true', default=False, help="Keep cached data in the block store.")
+	parser.add_option('--compress', dest='compress', default=None, help="Compress cached data with this codec.")
+	parser.add_option('--memory-cache-size', dest='memory_cache_size', default='0', help="Memory cache size of the Cacher, e.g. 64M (default 0, disabled).")
+	parser.add_option('--memory-cache-policy', dest='memory_cache_policy', default='arc', help="Memory cache policy of the Cacher ('arc' or 'lru').")
+	parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False, help="Print debugging output.")
+
+	(options, args) = parser.parse_args(argv)
+
+	pcachefsutil.DEBUG = options.verbose
+
+	scenarios = [ s.strip() for s in options.scenarios.split(',') if s.strip() != '' ]
+	for s in scenarios:
+		if s not in SCENARIOS:
+			parser.error('Unknown scenario ' + repr(s) + '; choose from ' + ', '.join(SCENARIOS))
+
+	if options.mount is not None and options.data_dir is None:
+		parser.error('--mount needs the --data-dir the mount is caching')
+
+	try:
+		block_size = parse_size(options.block_size)
+		bandwidth = parse_size(options.bandwidth)
+		file_size = parse_size(options.file_size)
+		read_size = parse_size(options.read_size)
+		memory_cache_size = parse_size(options.memory_cache_size)
+		if options.memory_cache_policy not in POLICIES:
+			raise ValueError('Unknown memory cache policy ' + repr(options.memory_cache_policy))
+
+		codec = None
+		if options.compress is not None:
+			codec = create_codec(options.compress)
+	except ValueError, e:
+		parser.error(str(e))
+
+	data_dir = options.data_dir
+	if data_dir is None:
+		data_dir = tempfile.mkdtemp(prefix = 'pcachefs-bench-data-')
+	elif not os.path.exists(data_dir):
+		os.makedirs(data_dir)
+
+	dataset = Dataset(data_dir, files = options.files, file_size = file_size, read_size = read_size,
+		random_reads = options.random_reads, tree_fanout = options.tree_fanout,
+		tree_depth = options.tree_depth, dir_entries = options.dir_entries)
+
+	def create_cacher(cachedir, ufs):
+		memory_cache = None
+		if memory_cache_size > 0:
+			memory_cache = create_memory_cache(options.memory_cache_policy, memory_cache_size, block_size)
+
+		return Cacher(cachedir, ufs,
+			block_size = block_size,
+			readahead = options.readahead,
+			fetch_threads = options.fetch_threads,
+			readdir_stats = options.readdir_stat_threads > 0,
+			dedup = options.dedup,
+			codec = codec,
+			memory_cache = memory_cache,
+			metadata = create_store(options.metadata_store, cachedir))
+
+	benchmark = Benchmark(dataset, create_cacher, options.latency / 1000.0, bandwidth, options.readdir_stat_threads)
+
+	try:
+		sys.stderr.write('creating dataset in %s\n' % data_dir)
+		dataset.create()
+
+		results = benchmark.run_cacher(scenarios)
+		if options.mount is not None:
+			results.extend(benchmark.run_mount(options.mount, scenarios))
+	finally:
+		if options.data_dir is None:
+			shutil.rmtree(data_dir)
+
+	sys.stderr.write(format_results(results))
+
+	report = {
+		'version': FORMAT_VERSION,
+		'time': time.time(),
+		'config': {
+			'dataset': dataset.config(),
+			'latency_ms': options.latency,
+			'bandwidth': bandwidth,
+			'block_size': block_size,
+			'readahead': options.readahead,
+			'fetch_threads': options.fetch_threads,
+			'readdir_stat_threads': options.readdir_stat_threads,
+			'metadata_store': options.metadata_store,
+			'dedup': options.dedup,
+			'compress': options.compress,
+			'memory_cache_size': memory_cache_size,
+			'memory_cache_policy': options.memory_cache_policy,
+		},
+		'results': results,
+	}
+
+	if options.output is None:
+		json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+		sys.stdout.write('\n')
+	else:
+		with open(options.output, 'w') as f:
+			json.dump(report, f, indent = 2, sort_keys = True)
+
+	return 0
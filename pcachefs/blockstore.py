@@ -0,0 +1,641 @@
+#!/usr/bin/python
+
+"""
+   Content-addressed block storage used by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import __builtin__
+import errno
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+
+from cachedfile import CachedFile
+from compression import (CODECS, create_codec)
+from lrucache import LRUCache
+from stats import Stats
+from workers import WorkerPool
+from pcachefsutil import debug
+
+"""
+# Stores each distinct block of cached file data once, however many cached
+# files it appears in, so that duplicate files (and duplicate blocks within
+# files) only take up disk space once. Only disk space is saved: a block is
+# fetched from the origin for every cached file it appears in, as its
+# content isn't known until it has been read.
+#
+# Blocks are kept as follows in the cache directory:
+#   /cache/dir/.pcachefs.blocks/ab/cdef...   # a block, named by the SHA-1 of its content
+#   /cache/dir/filename.ext/cache.blocks/N   # hard link to block N of filename.ext
+#   /cache/dir/filename.ext/cache.blocks/block_size  # block size and codec the links were made with
+#
+# Hard links do the reference counting: a stored block is deleted once the
+# last cache.blocks link to it is removed and only the store's own link is
+# left.
+#
+# If a Codec is given, blocks are compressed before they are stored (and
+# named by the SHA-1 of the compressed data). Whether to compress is decided
+# for each cached file from its first block: files whose first block does
+# not shrink by at least MIN_SAVING, such as media and archives, are stored
+# uncompressed. Compression is spread over a pool of threads, and recently
+# read blocks are kept decompressed in memory.
+#
+# The store also remembers which cache.blocks directory holds the blocks of
+# each origin file it has seen, identified by device, inode, size and
+# modification time, so that a second path for the same origin file (a
+# hard link or bind mount at the origin) is served from the blocks already
+# cached rather than from the origin. A copy of the file at another origin
+# path has a different inode, so it is not matched and is read from the
+# origin as usual.
+"""
+class BlockStore(object):
+	DIRECTORY = '.pcachefs.blocks'
+
+	# Maximum number of origin files whose cache.blocks directory is remembered
+	MAX_IDENTITIES = 10000
+
+	# Maximum number of decompressed blocks kept in memory
+	MAX_DECOMPRESSED_BLOCKS = 64
+
+	# Fraction of its size a file's first block must shrink by for the file
+	# to be compressed
+	MIN_SAVING = 0.1
+
+	COUNTERS = [ 'stored_blocks', 'shared_blocks', 'compressed_bytes_in', 'compressed_bytes_out',
+		'compressed_files', 'uncompressed_files' ]
+
+	def __init__(self, cachedir, block_size, codec = None, threads = 0):
+		self.root = os.path.join(cachedir, self.DIRECTORY)
+		self.block_size = block_size
+		self.codec = codec
+
+		self._pool = None
+		if codec is not None and threads > 0:
+			self._pool = WorkerPool(threads, 'pcachefs-compress')
+
+		# Counters reported by stats(), updated from the fetch and compress
+		# threads: blocks written to the store and blocks which were already
+		# there, bytes of data compressed and what they were compressed to,
+		# and cached files stored compressed and uncompressed, as decided by
+		# decide_codec()
+		self.counters = Stats()
+		for name in self.COUNTERS:
+			self.counters.add(name, 0)
+
+		# (cache.blocks directory, index) -> decompressed block
+		self._decompressed = LRUCache(self.MAX_DECOMPRESSED_BLOCKS)
+
+		# (st_dev, st_ino, st_size, st_mtime) -> cache.blocks directory
+		self._identities = LRUCache(self.MAX_IDENTITIES)
+
+		# Serialises creating and removing links, so that a block is never
+		# deleted while another file is linking to it
+		self._lock = threading.Lock()
+
+	""" Stop the threads used to compress blocks. """
+	def close(self):
+		if self._pool is not None:
+			self._pool.shutdown()
+
+	def _block_path(self, digest):
+		return os.path.join(self.root, digest[:2], digest[2:])
+
+	"""
+	# Store data as block index of the file whose links are in blocks_dir,
+	# replacing any block already there. Returns the number of bytes of disk
+	# space newly used.
+	"""
+	def put(self, blocks_dir, index, data):
+		digest = hashlib.sha1(data).hexdigest()
+		block_path = self._block_path(digest)
+		link_path = os.path.join(blocks_dir, str(index))
+
+		self._decompressed.invalidate((blocks_dir, index))
+		self._unlink(link_path)
+
+		tmp_path = None
+		stored = False
+		try:
+			while True:
+				with self._lock:
+					try:
+						os.link(block_path, link_path)
+						break
+					except OSError, e:
+						if e.errno != errno.ENOENT:
+							raise
+
+					if tmp_path is not None:
+						os.rename(tmp_path, block_path)
+						tmp_path = None
+						stored = True
+						continue
+
+				# the block is new, so write it out (without holding the
+				# lock) and try again
+				tmp_path = self._write_tmp(os.path.dirname(block_path), data)
+
+			if not stored:
+				self.counters.add('shared_blocks')
+				return 0
+
+			self.counters.add('stored_blocks')
+			return os.stat(link_path).st_blocks * 512
+
+		finally:
+			if tmp_path is not None:
+				os.remove(tmp_path)
+
+	def _write_tmp(self, directory, data):
+		try:
+			os.makedirs(directory)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+
+		(fd, tmp_path) = tempfile.mkstemp(dir = directory, prefix = '.tmp')
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+
+		return tmp_path
+
+	"""
+	# Remove block index of the file whose links are in blocks_dir, deleting
+	# it from the store if no other file uses it. Returns the number of bytes
+	# of disk space freed.
+	"""
+	def remove(self, blocks_dir, index):
+		self._decompressed.invalidate((blocks_dir, index))
+		return self._unlink(os.path.join(blocks_dir, str(index)))
+
+	"""
+	# Store the blocks in datas as consecutive blocks of the file whose links
+	# are in blocks_dir, starting at block index, compressing them with codec
+	# if it is not None. Returns the number of bytes of disk space newly used.
+	"""
+	def put_all(self, blocks_dir, index, datas, codec):
+		if codec is None:
+			return sum([ self.put(blocks_dir, index + i, data) for (i, data) in enumerate(datas) ])
+
+		if self._pool is None or len(datas) < 2:
+			return sum([ self._compress_and_put(blocks_dir, index + i, data, codec) for (i, data) in enumerate(datas) ])
+
+		tasks = [ self._pool.submit(self._compress_and_put, blocks_dir, index + i, data, codec) for (i, data) in enumerate(datas) ]
+
+		# wait for every block, even if one fails, so none is still being
+		# stored once the caller moves on
+		allocated = 0
+		error = None
+		for task in tasks:
+			try:
+				allocated += task.result()
+			except Exception:
+				if error is None:
+					error = sys.exc_info()
+
+		if error is not None:
+			raise error[0], error[1], error[2]
+
+		return allocated
+
+	def _compress_and_put(self, blocks_dir, index, data, codec):
+		compressed = codec.compress(data)
+
+		self.counters.add('compressed_bytes_in', len(data))
+		self.counters.add('compressed_bytes_out', len(compressed))
+
+		allocated = self.put(blocks_dir, index, compressed)
+
+		# the block is likely to be read straight away
+		self._decompressed.put((blocks_dir, index), data)
+		return allocated
+
+	"""
+	# Read block index of the file whose links are in blocks_dir, which was
+	# stored with codec. Returns '' if the block is not there.
+	"""
+	def get(self, blocks_dir, index, codec):
+		if codec is not None:
+			data = self._decompressed.get((blocks_dir, index))
+			if data is not None:
+				return data
+
+		try:
+			with __builtin__.open(os.path.join(blocks_dir, str(index)), 'rb') as f:
+				data = f.read()
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return ''
+
+		if codec is not None:
+			data = codec.decompress(data)
+			self._decompressed.put((blocks_dir, index), data)
+
+		return data
+
+	"""
+	# Return the Codec to store a new cached file with, given its first
+	# block: the store's codec, or None if the file is not compressible
+	# enough to be worth it.
+	"""
+	def decide_codec(self, sample):
+		if self.codec is None:
+			return None
+
+		if len(self.codec.compress(sample)) > len(sample) * (1 - self.MIN_SAVING):
+			self.counters.add('uncompressed_files')
+			return None
+
+		self.counters.add('compressed_files')
+		return self.codec
+
+	def _unlink(self, link_path):
+		with self._lock:
+			try:
+				st = os.stat(link_path)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+				return 0
+
+			# only this link and the store's own are left, so find the
+			# store's from the content and delete that too
+			block_path = None
+			if st.st_nlink <= 2:
+				with __builtin__.open(link_path, 'rb') as f:
+					block_path = self._block_path(hashlib.sha1(f.read()).hexdigest())
+
+			os.remove(link_path)
+
+			if block_path is None:
+				return 0
+
+			try:
+				os.remove(block_path)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+
+			return st.st_blocks * 512
+
+	""" Remove every block of the file whose links are in blocks_dir, and blocks_dir itself. """
+	def remove_all(self, blocks_dir):
+		freed = 0
+		for index in self.indexes(blocks_dir):
+			freed += self.remove(blocks_dir, index)
+
+		self.remove_marker(blocks_dir)
+		os.rmdir(blocks_dir)
+
+		return freed
+
+	""" Indexes of the blocks linked into blocks_dir. """
+	def indexes(self, blocks_dir):
+		return [ int(name) for name in os.listdir(blocks_dir) if name.isdigit() ]
+
+	"""
+	# Number of bytes of disk space used by the blocks of the file whose
+	# links are in blocks_dir. Blocks shared with other files are counted in
+	# proportion to the number of files sharing them.
+	"""
+	def allocated_bytes(self, blocks_dir):
+		total = 0
+		for index in self.indexes(blocks_dir):
+			try:
+				st = os.stat(os.path.join(blocks_dir, str(index)))
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+				continue
+
+			total += st.st_blocks * 512 // max(1, st.st_nlink - 1)
+
+		return total
+
+	""" Create blocks_dir for a new file's links. """
+	def create(self, blocks_dir):
+		try:
+			os.mkdir(blocks_dir)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+
+	"""
+	# Record the codec (or None) the blocks of the file whose links are in
+	# blocks_dir are stored with, along with the block size. This must be
+	# done before any blocks are stored.
+	"""
+	def write_marker(self, blocks_dir, codec):
+		marker = str(self.block_size)
+		if codec is not None:
+			marker += ' ' + codec.name
+
+		with __builtin__.open(os.path.join(blocks_dir, 'block_size'), 'w') as f:
+			f.write(marker)
+
+	"""
+	# Returns (block size, codec name or None) as recorded by write_marker()
+	# for blocks_dir, or None if nothing has been recorded.
+	"""
+	def read_marker(self, blocks_dir):
+		try:
+			with __builtin__.open(os.path.join(blocks_dir, 'block_size'), 'r') as f:
+				fields = f.read().split()
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return None
+
+		return (int(fields[0]), fields[1] if len(fields) > 1 else None)
+
+	"""
+	# Returns True if blocks_dir exists and its links cannot be used: they
+	# were made with a different block size or a codec which is not
+	# available, or they were never recorded.
+	"""
+	def is_stale(self, blocks_dir):
+		marker = self.read_marker(blocks_dir)
+		if marker is None:
+			return os.path.isdir(blocks_dir)
+
+		(block_size, codec_name) = marker
+		return block_size != self.block_size or (codec_name is not None and codec_name not in CODECS)
+
+	""" Forget what was recorded by write_marker() for blocks_dir. """
+	def remove_marker(self, blocks_dir):
+		try:
+			os.remove(os.path.join(blocks_dir, 'block_size'))
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+
+	"""
+	# Record that blocks_dir holds the blocks of the origin file described by
+	# stat, unless another cache.blocks directory already does.
+	"""
+	def register(self, stat, blocks_dir):
+		identity = self._identity(stat)
+
+		twin = self._identities.get(identity, count = False)
+		if twin is None or not os.path.isdir(twin):
+			self._identities.put(identity, blocks_dir)
+
+	"""
+	# Link block index of the origin file described by stat into blocks_dir
+	# from another file's cache.blocks, if it is cached there. Returns True
+	# if it was.
+	"""
+	def link_twin(self, stat, blocks_dir, index):
+		twin = self.twin(stat, blocks_dir)
+		if twin is None:
+			return False
+
+		link_path = os.path.join(blocks_dir, str(index))
+		self._unlink(link_path)
+
+		with self._lock:
+			try:
+				os.link(os.path.join(twin, str(index)), link_path)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+				return False
+
+		self.counters.add('shared_blocks')
+		return True
+
+	"""
+	# Return the cache.blocks directory of another path for the origin file
+	# described by stat, or None.
+	"""
+	def twin(self, stat, blocks_dir):
+		twin = self._identities.get(self._identity(stat))
+		if twin is None or twin == blocks_dir:
+			return None
+
+		return twin
+
+	def _identity(self, stat):
+		return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+	"""
+	# Return how many blocks are stored and how many writes were deduplicated
+	# against an existing block, along with the compression totals.
+	"""
+	def stats(self):
+		return self.counters.values()
+
+"""
+# A CachedFile whose data is kept in a BlockStore rather than in cache.data.
+#
+# Data must be written in whole blocks of the store's block size (the last
+# block of the file may be short), as Cacher does when filling the cache.
+# Parts of the file which are not cached read back as zeroes, as they do
+# from a sparse cache.data.
+#
+# Whether the file's blocks are compressed, and how, is decided when the
+# first of them is written and recorded in cache.blocks.
+"""
+class BlockStoreCachedFile(CachedFile):
+	"""
+	# data_path the path of the file's cache.blocks directory
+	# store the BlockStore holding the file's blocks
+	#
+	# Other arguments are as for CachedFile.
+	"""
+	def __init__(self, path, data_path, coverage, stat, open_origin, store):
+		self.store = store
+		CachedFile.__init__(self, path, data_path, coverage, stat, open_origin)
+
+		# The Codec the file's blocks are stored with, once decided
+		self._decided = False
+		self._codec = None
+		self._codec_lock = threading.Lock()
+
+		marker = store.read_marker(data_path)
+		if marker is not None:
+			self._set_codec(marker[1])
+
+		if self.has_data_file():
+			store.register(stat, data_path)
+
+	def _set_codec(self, codec_name):
+		self._codec = None
+		if codec_name is not None:
+			self._codec = create_codec(codec_name)
+
+		self._decided = True
+
+	# Decide how the file's blocks are to be stored, given its first block
+	def _decide_codec(self, sample):
+		with self._codec_lock:
+			if self._decided:
+				return
+
+			codec = self.store.decide_codec(sample)
+			self.store.write_marker(self.data_path, codec)
+
+			self._codec = codec
+			self._decided = True
+
+	def _open_data_file(self):
+		return None
+
+	def has_data_file(self):
+		return os.path.isdir(self.data_path)
+
+	def create_data_file(self):
+		self.store.create(self.data_path)
+		self.store.register(self.stat, self.data_path)
+
+	def preallocate(self):
+		return False
+
+	def discard(self, start, end):
+		self.coverage.remove(start, end)
+		self.coverage.flush()
+
+		if not self.has_data_file():
+			return 0
+
+		# only blocks which lie entirely within start..end can be removed
+		bs = self.store.block_size
+		freed = 0
+		for index in xrange(-(-start // bs), self._end_index(end)):
+			freed += self.store.remove(self.data_path, index)
+
+		return freed
+
+	# Index of the first block which does not lie entirely before end
+	def _end_index(self, end):
+		bs = self.store.block_size
+		if end >= self.stat.st_size:
+			return -(-self.stat.st_size // bs)
+		return end // bs
+
+	def invalidate(self, stat):
+		ranges = self.coverage.ranges
+		if len(ranges) > 0:
+			self.coverage.remove(ranges.start, ranges.end)
+			self.coverage.flush()
+
+		freed = 0
+		if self.has_data_file():
+			for index in self.store.indexes(self.data_path):
+				freed += self.store.remove(self.data_path, index)
+
+		# the new content may compress differently
+		with self._codec_lock:
+			self._decided = False
+			self.store.remove_marker(self.data_path)
+
+		self.stat = stat
+		self._close_origins()
+
+		if self.has_data_file():
+			self.store.register(stat, self.data_path)
+
+		return freed
+
+	def fill_locally(self, start, end):
+		bs = self.store.block_size
+		if start % bs != 0:
+			return False
+
+		twin = self.store.twin(self.stat, self.data_path)
+		if twin is None:
+			return False
+
+		# the twin's blocks can only be used if they are stored the same way
+		# as this file's are (or this file has none yet)
+		marker = self.store.read_marker(twin)
+		if marker is None:
+			return False
+
+		with self._codec_lock:
+			if not self._decided:
+				self._set_codec(marker[1])
+				self.store.write_marker(self.data_path, self._codec)
+
+			elif marker[1] != (None if self._codec is None else self._codec.name):
+				return False
+
+		indexes = range(start // bs, self._end_index(end))
+		for index in indexes:
+			if not self.store.link_twin(self.stat, self.data_path, index):
+				return False
+
+		debug('  linked', str(len(indexes)), 'blocks of', self.path, 'from a twin')
+		return len(indexes) > 0
+
+	def allocated_bytes(self):
+		if not self.has_data_file():
+			return 0
+
+		return self.store.allocated_bytes(self.data_path)
+
+	def read(self, offset, size):
+		bs = self.store.block_size
+		result = []
+
+		while size > 0:
+			index = offset // bs
+			within = offset % bs
+			n = min(size, bs - within)
+
+			if self._codec is not None:
+				data = self.store.get(self.data_path, index, self._codec)[within:within + n]
+
+			else:
+				data = ''
+				try:
+					with __builtin__.open(os.path.join(self.data_path, str(index)), 'rb') as f:
+						f.seek(within)
+						data = f.read(n)
+				except IOError, e:
+					if e.errno != errno.ENOENT:
+						raise
+
+			result.append(data + '\0' * (n - len(data)))
+			offset += n
+			size -= n
+
+		return ''.join(result)
+
+	"""
+	# Write whole blocks of data at offset. Returns the number of bytes of
+	# disk space newly used, which is less than len(data) where blocks are
+	# shared or compressed.
+	"""
+	def write(self, offset, data):
+		bs = self.store.block_size
+		if offset % bs != 0:
+			raise ValueError('offset (' + str(offset) + ') is not a multiple of the block size')
+
+		blocks = [ data[i:i + bs] for i in xrange(0, len(data), bs) ]
+		if len(blocks) == 0:
+			return 0
+
+		if not self._decided:
+			self._decide_codec(blocks[0])
+
+		return self.store.put_all(self.data_path, offset // bs, blocks, self._codec)
+
+	def flush(self):
+		pass
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+
+"""
+   Open file state used by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import __builtin__
+import errno
+import mmap
+import threading
+
+import sparse
+
+from pcachefsutil import debug
+
+"""
+# State kept for a file while it is open: its stat, its coverage map and the
+# open cache.data and origin files.
+#
+# One CachedFile is shared by every open FUSE handle on the same path, so
+# that they all see the same coverage map. It is created by Cacher.open()
+# and closed by Cacher.release() once the last handle on the path is gone,
+# so cache.data, cache.data.coverage and the origin file are opened at most
+# once for the life of the handles rather than once per read.
+#
+# cache.data is only created when data is first fetched for the file, and
+# the origin file only opened when something is first missing from the
+# cache; files read entirely from the cache never touch the origin. Each
+# concurrent fetch from the origin needs its own file object, so origin
+# files are kept in a pool which grows to the number of fetches that have
+# run at once.
+#
+# Cached data is read through a read-only mapping of cache.data, kept for
+# the life of the object, so that a read which hits the cache is a single
+# copy out of the page cache rather than a seek() and read() through the
+# shared file object. Where cache.data cannot be mapped, it is read as an
+# ordinary file.
+"""
+class CachedFile(object):
+	"""
+	# path the path of the file within the filesystem
+	# data_path the path of the cache.data file
+	# coverage the file's CoverageMap
+	# stat the file's FuseStat
+	# open_origin called with no arguments to open an origin file
+	# use_mmap if False, cache.data is never mapped
+	"""
+	def __init__(self, path, data_path, coverage, stat, open_origin, use_mmap = True):
+		self.path = path
+		self.data_path = data_path
+		self.coverage = coverage
+		self.stat = stat
+
+		# number of FUSE handles (and internal users) sharing this object;
+		# maintained by Cacher
+		self.refcount = 0
+
+		# False while the file's data is read straight from the origin, as
+		# it has not been admitted to the cache; maintained by Cacher
+		self.admitted = True
+
+		self._open_origin = open_origin
+		self._idle_origins = []
+		self._origins_lock = threading.Lock()
+
+		self._data_file = self._open_data_file()
+
+		# The coverage map may describe data which is no longer there, if
+		# cache.data was removed by hand or pCacheFS stopped before the map
+		# was brought up to date. Such ranges are fetched again.
+		if not self.has_data_file() and (len(coverage.ranges) > 0 or len(coverage.dirty) > 0):
+			debug('  no cached data for', path, 'forgetting its coverage map')
+			self._forget_coverage()
+
+		# Mapping of cache.data, created by the first read; see _mapping()
+		self._use_mmap = use_mmap
+		self._map = None
+
+		# Serialises seek()+read()/write() pairs on the shared cache.data
+		# file object. This is only ever held for the duration of local
+		# disk I/O, never while waiting for the origin.
+		self._io_lock = threading.Lock()
+
+	# Returns cache.data opened for reading and writing, or None if it has
+	# not been created yet
+	def _open_data_file(self):
+		try:
+			return __builtin__.open(self.data_path, 'r+b')
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return None
+
+	# Mark everything in the coverage map as not cached, and any data not
+	# yet written to the origin as written, since it has been lost
+	def _forget_coverage(self):
+		ranges = self.coverage.ranges
+		if len(ranges) > 0:
+			self.coverage.remove(ranges.start, ranges.end)
+
+		dirty = self.coverage.dirty
+		if len(dirty) > 0:
+			debug('  data not yet written to the origin has been lost', self.path, repr(dirty))
+			self.coverage.mark_clean(dirty.start, dirty.end)
+
+		self.coverage.flush()
+
+	def __repr__(self):
+		return 'CachedFile ' + self.path + ' (' + str(self.refcount) + ' refs)'
+
+	""" Returns True if start..end is present in cache.data. """
+	def is_cached(self, start, end):
+		return self.coverage.ranges.covers(start, end)
+
+	""" Returns True if cache.data has been created for this file. """
+	def has_data_file(self):
+		return self._data_file is not None
+
+	"""
+	# Create cache.data as a sparse file the same size as the real file, so
+	# that it only takes up disk space for the parts which have been cached.
+	# The directory it lives in must already exist.
+	"""
+	def create_data_file(self):
+		if self._data_file is not None:
+			return
+
+		debug('  creating sparse file, size', str(self.stat.st_size))
+		f = __builtin__.open(self.data_path, 'w+b')
+		sparse.allocate_sparse(f.fileno(), self.stat.st_size)
+
+		self._data_file = f
+
+	"""
+	# Reserve disk space for the whole of cache.data. Returns False if this
+	# is not supported, or cache.data has not been created.
+	"""
+	def preallocate(self):
+		with self._io_lock:
+			if self._data_file is None:
+				return False
+
+			return sparse.preallocate(self._data_file.fileno(), 0, self.stat.st_size)
+
+	"""
+	# Remove start..end from the cache, freeing the disk space it used where
+	# the filesystem holding the cache supports punching holes. Returns the
+	# number of bytes of disk space freed, or None if the space could not be
+	# freed because holes cannot be punched.
+	#
+	# Callers must hold the path lock for this file, as when filling it.
+	"""
+	def discard(self, start, end):
+		# The coverage map is updated first so that no new reads are served
+		# from the range once it starts reading back as zeroes
+		self.coverage.remove(start, end)
+		self.coverage.flush()
+
+		with self._io_lock:
+			if self._data_file is None:
+				return 0
+
+			self._data_file.flush()
+			fd = self._data_file.fileno()
+
+			before = sparse.allocated_bytes(fd)
+			if not sparse.punch_hole(fd, start, end - start):
+				return None
+
+			return before - sparse.allocated_bytes(fd)
+
+	"""
+	# Forget everything cached for the file because it has changed at the
+	# origin, and carry on with the given stat. cache.data is emptied and
+	# resized, and the origin file reopened when next needed. Returns the
+	# number of bytes of disk space freed.
+	#
+	# Callers must hold the path lock for this file.
+	"""
+	def invalidate(self, stat):
+		ranges = self.coverage.ranges
+		if len(ranges) > 0:
+			self.coverage.remove(ranges.start, ranges.end)
+			self.coverage.flush()
+
+		freed = 0
+		with self._io_lock:
+			if self._data_file is not None:
+				fd = self._data_file.fileno()
+				before = sparse.allocated_bytes(fd)
+
+				# pages of a mapping beyond the end of the file can't be
+				# read, so it must go before cache.data is truncated
+				self._unmap()
+				self._data_file.truncate(0)
+				sparse.allocate_sparse(fd, stat.st_size)
+
+				freed = before - sparse.allocated_bytes(fd)
+
+		self.stat = stat
+		self._close_origins()
+
+		return freed
+
+	"""
+	# Resize cache.data to size bytes, as the file has been truncated or
+	# extended locally in write-back mode; anything added reads as zeroes.
+	# Callers must hold the path lock for this file.
+	"""
+	def truncate(self, size):
+		with self._io_lock:
+			if self._data_file is not None:
+				# as in invalidate(), the mapping must not outlive the data
+				self._unmap()
+				self._data_file.flush()
+				sparse.allocate_sparse(self._data_file.fileno(), size)
+
+	"""
+	# Fill start..end from data already cached for another path, where the
+	# storage allows it, rather than from the origin. Returns True if it
+	# was filled. Callers must hold the path lock for this file.
+	"""
+	def fill_locally(self, start, end):
+		return False
+
+	""" Number of bytes of disk space used by cache.data. """
+	def allocated_bytes(self):
+		with self._io_lock:
+			if self._data_file is None:
+				return 0
+
+			return sparse.allocated_bytes(self._data_file.fileno())
+
+	"""
+	# Return an origin file for this thread's exclusive use, opening a new
+	# one if all those already open are in use. It must be handed back with
+	# release_origin().
+	"""
+	def acquire_origin(self):
+		with self._origins_lock:
+			if len(self._idle_origins) > 0:
+				return self._idle_origins.pop()
+
+		return self._open_origin()
+
+	def release_origin(self, origin):
+		with self._origins_lock:
+			self._idle_origins.append(origin)
+
+	def _close_origins(self):
+		with self._origins_lock:
+			origins = self._idle_origins
+			self._idle_origins = []
+
+		for origin in origins:
+			origin.close()
+
+	""" Read size bytes at offset from cache.data. """
+	def read(self, offset, size):
+		m = self._mapping()
+		if m is not None:
+			try:
+				if offset + size <= len(m):
+					return m[offset:offset + size]
+			except ValueError:
+				# unmapped by invalidate() while we were reading
+				pass
+
+		with self._io_lock:
+			if self._data_file is None:
+				raise IOError(errno.EIO, 'cache.data missing for ' + self.path)
+
+			self._data_file.seek(offset)
+			return self._data_file.read(size)
+
+	""" Write data into cache.data at offset, overwriting what is there. """
+	def write(self, offset, data):
+		with self._io_lock:
+			self._data_file.seek(offset)
+			self._data_file.write(data)
+
+			# the mapping only sees what has left the file object's buffer,
+			# and the data may be read through it as soon as the coverage
+			# map says it is cached
+			if self._map is not None:
+				self._data_file.flush()
+
+	# Returns the mapping of cache.data, mapping it if it is not yet mapped,
+	# or None if cache.data has not been created or cannot be mapped
+	def _mapping(self):
+		m = self._map
+		if m is not None or not self._use_mmap:
+			return m
+
+		with self._io_lock:
+			if self._map is None and self._data_file is not None and self.stat.st_size > 0:
+				try:
+					self._data_file.flush()
+					self._map = mmap.mmap(self._data_file.fileno(), 0, access = mmap.ACCESS_READ)
+				except (EnvironmentError, ValueError), e:
+					debug('cannot map', self.data_path, e)
+					self._use_mmap = False
+
+			return self._map
+
+	# Callers must hold _io_lock
+	def _unmap(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+
+	""" Flush buffered writes to cache.data. """
+	def flush(self):
+		with self._io_lock:
+			if self._data_file is not None:
+				self._data_file.flush()
+
+	""" Flush and close cache.data and the origin file. """
+	def close(self):
+		# a map with nothing to write is left alone, so that no coverage
+		# file is created for a file which was never cached
+		if len(self.coverage.pending) > 0:
+			self.coverage.flush()
+
+		with self._io_lock:
+			self._unmap()
+
+			if self._data_file is not None:
+				self._data_file.close()
+				self._data_file = None
+
+		self._close_origins()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+"""
+   Codecs for compressing cached blocks in pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import bz2
+import zlib
+
+"""
+# A way of compressing blocks. Subclasses set name, which is recorded with
+# each cached file compressed with the codec, so that it must not change.
+"""
+class Codec(object):
+	name = None
+
+	def compress(self, data):
+		raise NotImplementedError()
+
+	def decompress(self, data):
+		raise NotImplementedError()
+
+class ZlibCodec(Codec):
+	name = 'zlib'
+
+	def __init__(self, level = 6):
+		self.level = level
+
+	def compress(self, data):
+		return zlib.compress(data, self.level)
+
+	def decompress(self, data):
+		return zlib.decompress(data)
+
+class Bz2Codec(Codec):
+	name = 'bz2'
+
+	def __init__(self, level = 9):
+		self.level = level
+
+	def compress(self, data):
+		return bz2.compress(data, self.level)
+
+	def decompress(self, data):
+		return bz2.decompress(data)
+
+class LzmaCodec(Codec):
+	name = 'lzma'
+
+	def compress(self, data):
+		return lzma.compress(data)
+
+	def decompress(self, data):
+		return lzma.decompress(data)
+
+# Codecs available by name, for --compress
+CODECS = {
+	ZlibCodec.name: ZlibCodec,
+	Bz2Codec.name: Bz2Codec,
+}
+
+# lzma is only in the standard library from Python 3.3; on Python 2 it is
+# provided by the backports.lzma package
+try:
+	import lzma
+	CODECS[LzmaCodec.name] = LzmaCodec
+except ImportError:
+	try:
+		from backports import lzma
+		CODECS[LzmaCodec.name] = LzmaCodec
+	except ImportError:
+		pass
+
+"""
+# Return a new Codec of the given name. Raises ValueError if there is no
+# such codec, or it is not available here.
+"""
+def create_codec(name):
+	if name not in CODECS:
+		raise ValueError('Unknown or unavailable codec ' + repr(name) + '; choose from ' + ', '.join(sorted(CODECS.keys())))
+
+	return CODECS[name]()
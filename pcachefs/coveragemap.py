@@ -0,0 +1,312 @@
+#!/usr/bin/python
+
+"""
+   On-disk coverage maps used by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import __builtin__
+import errno
+import os
+import pickle
+import struct
+
+from pcachefsutil import debug
+from ranges import Ranges
+
+"""
+# Records which byte ranges of a file are present in its cache.data file.
+#
+# The map is held in memory as a Ranges object and persisted in a small
+# binary file, laid out as:
+#
+#   header    magic, format version, number of snapshot ranges (N)
+#   snapshot  N (start, end) pairs, sorted
+#   dirty     (version 2 only) number of dirty ranges (M), then M pairs
+#   journal   any number of (kind, start, end) delta records
+#
+# All integers are little-endian and unsigned. When a miss brings more
+# data into the cache, the newly covered ranges are appended to the
+# journal, so only a few bytes are written no matter how fragmented the
+# file is. Once the journal grows larger than the snapshot the whole map is
+# rewritten as a fresh snapshot (compacted).
+#
+# A partially written journal record at the end of the file (e.g. after a
+# crash) is ignored; at worst this causes some data to be fetched again.
+#
+# Ranges written locally in write-back mode but not yet to the origin are
+# also recorded, as self.dirty. Maps without any are written in version 1
+# format, so that older versions of pCacheFS can still read them.
+#
+# Changes made by add() are applied to a private copy of the ranges, which
+# only replaces self.ranges when flush() is called. This means other
+# threads can query self.ranges without locking, and only ever see ranges
+# whose data has already been written to cache.data. Callers making
+# changes must still serialise them with each other. self.dirty is updated
+# in place, so it must only be used while holding the path lock.
+"""
+class CoverageMap(object):
+	MAGIC = 'PCFSCOV\0'
+	VERSION = 1
+
+	# Version of maps which include dirty ranges
+	DIRTY_VERSION = 2
+
+	HEADER = struct.Struct('<8sII')
+	PAIR = struct.Struct('<QQ')
+	COUNT = struct.Struct('<I')
+	RECORD = struct.Struct('<BQQ')
+
+	# Journal record kinds
+	RECORD_ADD = 1
+	RECORD_REMOVE = 2
+	RECORD_DIRTY = 3
+	RECORD_CLEAN = 4
+
+	# Always allow at least this many journal records before compacting
+	MIN_JOURNAL_RECORDS = 64
+
+	def __init__(self, path, ranges = None):
+		self.path = path
+		self.ranges = ranges if ranges is not None else Ranges()
+		self.dirty = Ranges()
+
+		# number of journal records currently in the file, and records
+		# waiting to be written by flush()
+		self.journal_records = 0
+		self.pending = []
+
+		# copy of self.ranges that add() applies changes to, until flush()
+		self._working = None
+
+		# True if the file does not exist yet or needs rewriting in full
+		self.needs_compaction = True
+
+	def __repr__(self):
+		return 'CoverageMap ' + self.path + ' ' + repr(self.ranges)
+
+	"""
+	# Load the coverage map stored at path.
+	#
+	# If there is no file at path but legacy_path names a pickled Ranges
+	# file (cache.data.range, as written by older versions of pCacheFS),
+	# it is converted to the new format and removed.
+	#
+	# If neither exists, an empty map is returned; nothing is written to
+	# disk until flush() is called.
+	"""
+	@classmethod
+	def open(cls, path, legacy_path = None):
+		try:
+			with __builtin__.open(path, 'rb') as f:
+				data = f.read()
+
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				raise
+
+			if legacy_path is not None:
+				return cls._migrate(path, legacy_path)
+
+			return cls(path)
+
+		return cls._parse(path, data)
+
+	@classmethod
+	def _parse(cls, path, data, *args):
+		result = cls(path, None, *args)
+
+		if len(data) < cls.HEADER.size:
+			debug('coverage map too short, ignoring', path)
+			return result
+
+		(magic, version, count) = cls.HEADER.unpack_from(data, 0)
+		if magic != cls.MAGIC or version not in (cls.VERSION, cls.DIRTY_VERSION):
+			debug('coverage map has unknown format, ignoring', path)
+			return result
+
+		offset = cls.HEADER.size
+		ranges = cls._unpack_pairs(data, offset, count)
+		offset += count * cls.PAIR.size
+		dirty = Ranges()
+
+		if ranges is not None and version == cls.DIRTY_VERSION:
+			if len(data) < offset + cls.COUNT.size:
+				ranges = None
+			else:
+				(count,) = cls.COUNT.unpack_from(data, offset)
+				offset += cls.COUNT.size
+				dirty = cls._unpack_pairs(data, offset, count)
+				offset += count * cls.PAIR.size
+
+		if ranges is None or dirty is None:
+			debug('coverage map snapshot truncated, ignoring', path)
+			return result
+
+		result.ranges = ranges
+		result.dirty = dirty
+
+		while offset + cls.RECORD.size <= len(data):
+			result.apply(*cls.RECORD.unpack_from(data, offset))
+			offset += cls.RECORD.size
+
+		# a torn record at the end means the journal must be rewritten
+		# before anything more is appended to it
+		result.needs_compaction = offset != len(data)
+		return result
+
+	# Returns a Ranges of the count pairs at offset in data, or None if data
+	# is too short to hold them
+	@classmethod
+	def _unpack_pairs(cls, data, offset, count):
+		if len(data) < offset + count * cls.PAIR.size:
+			return None
+
+		values = struct.unpack_from('<' + str(count * 2) + 'Q', data, offset)
+		return Ranges.from_sorted(values[0::2], values[1::2])
+
+	@classmethod
+	def _migrate(cls, path, legacy_path):
+		try:
+			with __builtin__.open(legacy_path, 'rb') as f:
+				ranges = pickle.load(f)
+
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return cls(path)
+
+		debug('migrating coverage map', legacy_path, path)
+		result = cls(path, ranges)
+		result.flush()
+
+		os.remove(legacy_path)
+		return result
+
+	""" Apply a journal record read back from disk. """
+	def apply(self, kind, start, end):
+		self.journal_records += 1
+
+		if kind == self.RECORD_ADD:
+			self.ranges.add(start, end)
+		elif kind == self.RECORD_REMOVE:
+			self.ranges.remove(start, end)
+		elif kind == self.RECORD_DIRTY:
+			self.dirty.add(start, end)
+		elif kind == self.RECORD_CLEAN:
+			self.dirty.remove(start, end)
+		else:
+			raise ValueError('unknown coverage journal record kind ' + str(kind))
+
+	""" Mark start..end as present in the cache. Call flush() to persist. """
+	def add(self, start, end):
+		if self._working is None:
+			self._working = self.ranges.copy()
+
+		self._working.add(start, end)
+		self.pending.append((self.RECORD_ADD, start, end))
+
+	""" Mark start..end as no longer in the cache. Call flush() to persist. """
+	def remove(self, start, end):
+		if self._working is None:
+			self._working = self.ranges.copy()
+
+		self._working.remove(start, end)
+		self.pending.append((self.RECORD_REMOVE, start, end))
+
+	"""
+	# Mark start..end as present in the cache and written locally but not
+	# yet to the origin. Call flush() to persist.
+	"""
+	def mark_dirty(self, start, end):
+		self.add(start, end)
+
+		self.dirty.add(start, end)
+		self.pending.append((self.RECORD_DIRTY, start, end))
+
+	""" Mark start..end as written to the origin. Call flush() to persist. """
+	def mark_clean(self, start, end):
+		self.dirty.remove(start, end)
+		self.pending.append((self.RECORD_CLEAN, start, end))
+
+	""" Returns True if any of start..end has not been written to the origin. """
+	def is_dirty(self, start, end):
+		return self.dirty.overlaps(start, end)
+
+	"""
+	# Make changes since the last flush() visible in self.ranges and write
+	# them to disk, appending them to the journal or compacting the whole
+	# map as appropriate.
+	"""
+	def flush(self):
+		if self._working is not None:
+			self.ranges = self._working
+			self._working = None
+
+		journal_records = self.journal_records + len(self.pending)
+		limit = max(self.MIN_JOURNAL_RECORDS, len(self.ranges) + len(self.dirty))
+
+		if self.needs_compaction or journal_records > limit:
+			self.compact()
+
+		elif len(self.pending) > 0:
+			self._append_records(self.pending)
+			self.journal_records = journal_records
+
+		self.pending = []
+
+	""" Rewrite the map on disk as a single snapshot with an empty journal. """
+	def compact(self):
+		self._write_snapshot(self.pack_snapshot(self.ranges, self.dirty))
+
+		self.journal_records = 0
+		self.pending = []
+		self.needs_compaction = False
+
+	# The two methods below are all that touch the disk when saving a map;
+	# subclasses override them to keep maps somewhere other than a file of
+	# their own
+
+	""" Append the given (kind, start, end) records to the journal. """
+	def _append_records(self, records):
+		with __builtin__.open(self.path, 'ab') as f:
+			f.write(''.join([ self.RECORD.pack(*r) for r in records ]))
+
+	""" Replace the whole map with data, as returned by pack_snapshot(). """
+	def _write_snapshot(self, data):
+		# write to a temporary file and rename it over the original so the
+		# map on disk is never left half-written
+		tmp_path = self.path + '.tmp'
+		with __builtin__.open(tmp_path, 'wb') as f:
+			f.write(data)
+		os.rename(tmp_path, self.path)
+
+	"""
+	# Serialise ranges, and any dirty ranges, as a header and snapshot with
+	# an empty journal.
+	"""
+	@classmethod
+	def pack_snapshot(cls, ranges, dirty = None):
+		pairs = list(ranges.pairs())
+		version = cls.VERSION if dirty is None or len(dirty) == 0 else cls.DIRTY_VERSION
+
+		data = [ cls.HEADER.pack(cls.MAGIC, version, len(pairs)) ]
+		data.extend([ cls.PAIR.pack(s, e) for (s, e) in pairs ])
+
+		if version == cls.DIRTY_VERSION:
+			data.append(cls.COUNT.pack(len(dirty)))
+			data.extend([ cls.PAIR.pack(s, e) for (s, e) in dirty.pairs() ])
+
+		return ''.join(data)
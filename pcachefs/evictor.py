@@ -0,0 +1,317 @@
+#!/usr/bin/python
+
+"""
+   Cache size enforcement for pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from blockstore import BlockStore
+from pcachefsutil import debug
+
+# Returned by Cacher.discard() and Cacher.evict_file() when the data can't
+# be removed yet, because its file is open or has data not yet written back
+BUSY = 'busy'
+
+"""
+# Keeps the cache within a size limit (max_cache_size) and keeps a minimum
+# amount of space free on the disk holding it (min_free_space) by evicting
+# the least recently used blocks from cache.data files.
+#
+# Recency is tracked in memory only: touch() and added() are called by
+# Cacher as blocks are read and fetched, and just move entries within an
+# OrderedDict, so reads never cause extra disk writes. Blocks which were
+# cached before pCacheFS was started are found by scanning the cache
+# directory when the evictor starts, and are treated as older than
+# anything used since, ordered by the modification time of their cache.data.
+#
+# Eviction runs on a background thread, every interval seconds or as soon
+# as newly fetched data takes the cache over its limit. Blocks are evicted
+# with Cacher.discard(), which updates the coverage map and punches a hole
+# in cache.data (or unlinks the block from a BlockStore). Where the cache
+# filesystem cannot punch holes, the file the block belongs to is evicted
+# from the cache as a whole instead. Blocks which are busy are passed over
+# for the rest of the pass, and stay least recently used.
+#
+# added() checks the free space on the cache filesystem against a reading
+# taken at most FREE_SPACE_INTERVAL seconds or FREE_SPACE_BYTES added bytes
+# ago, less the bytes added since, rather than calling statvfs for every
+# block fetched. Eviction itself always takes a fresh reading.
+"""
+class Evictor(object):
+	DEFAULT_INTERVAL = 5
+
+	FREE_SPACE_INTERVAL = 1
+	FREE_SPACE_BYTES = 16 * 1024 * 1024
+
+	"""
+	# cacher the Cacher whose cache is to be kept in bounds
+	# max_cache_size the maximum number of bytes of file data to keep in the
+	#   cache (0 means no limit)
+	# min_free_space the number of bytes to keep free on the filesystem
+	#   holding the cache (0 means no limit)
+	"""
+	def __init__(self, cacher, max_cache_size = 0, min_free_space = 0, interval = DEFAULT_INTERVAL):
+		self.cacher = cacher
+		self.block_size = cacher.block_size
+		self.max_cache_size = max_cache_size
+		self.min_free_space = min_free_space
+		self.interval = interval
+
+		# bytes of file data currently held in the cache
+		self.usage = 0
+
+		# the last free space reading, when it was taken, and the bytes
+		# added to the cache since
+		self._free_space_reading = None
+		self._free_space_time = 0
+		self._added_since_reading = 0
+
+		self.evicted_blocks = 0
+		self.evicted_files = 0
+		self.evicted_bytes = 0
+
+		# (path, block index) -> None, least recently used first
+		self._blocks = OrderedDict()
+		self._lock = threading.Lock()
+
+		self._wakeup = threading.Event()
+		self._stopped = threading.Event()
+		self._thread = None
+
+	""" Scan the existing cache and start evicting in the background. """
+	def start(self):
+		self._thread = threading.Thread(target = self._run, name = 'pcachefs-evictor')
+		self._thread.daemon = True
+		self._thread.start()
+
+	""" Stop the background thread, once any eviction in progress is done. """
+	def stop(self):
+		self._stopped.set()
+		self._wakeup.set()
+
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	""" Record that start..end of path has been read. """
+	def touch(self, path, start, end):
+		with self._lock:
+			for i in self._block_indexes(start, end):
+				key = (path, i)
+				if self._blocks.pop(key, True) is None:
+					self._blocks[key] = None
+
+	"""
+	# Record that start..end of path has just been fetched into the cache,
+	# taking up allocated bytes of disk space (by default, end - start).
+	"""
+	def added(self, path, start, end, allocated = None):
+		if allocated is None:
+			allocated = end - start
+
+		with self._lock:
+			for i in self._block_indexes(start, end):
+				key = (path, i)
+				self._blocks.pop(key, None)
+				self._blocks[key] = None
+
+			self.usage += allocated
+			self._added_since_reading += allocated
+
+		if self._over_limit(fresh = False):
+			self._wakeup.set()
+
+	""" Stop tracking path, whose cached data has been removed. """
+	def forget(self, path, freed_bytes = 0):
+		with self._lock:
+			for key in [ k for k in self._blocks if k[0] == path ]:
+				del self._blocks[key]
+
+			self.usage = max(0, self.usage - freed_bytes)
+
+	def _block_indexes(self, start, end):
+		return xrange(start // self.block_size, -(-end // self.block_size))
+
+	# Returns the free space on the cache filesystem. Unless fresh is True,
+	# a recent enough reading is reused, less the bytes added since it was
+	# taken.
+	def _free_space(self, fresh = True):
+		now = time.time()
+
+		with self._lock:
+			if not fresh and self._free_space_reading is not None and \
+					now - self._free_space_time < self.FREE_SPACE_INTERVAL and \
+					self._added_since_reading < self.FREE_SPACE_BYTES:
+				return self._free_space_reading - self._added_since_reading
+
+		st = os.statvfs(self.cacher.cachedir)
+		free = st.f_bavail * st.f_frsize
+
+		with self._lock:
+			self._free_space_reading = free
+			self._free_space_time = now
+			self._added_since_reading = 0
+
+		return free
+
+	def _over_limit(self, fresh = True):
+		if self.max_cache_size > 0 and self.usage > self.max_cache_size:
+			return True
+
+		if self.min_free_space > 0 and self._free_space(fresh) < self.min_free_space:
+			return True
+
+		return False
+
+	def _run(self):
+		self._scan()
+
+		while not self._stopped.is_set():
+			try:
+				self.evict()
+			except Exception, e:
+				debug('evictor failed', e)
+
+			self._wakeup.wait(self.interval)
+			self._wakeup.clear()
+
+	"""
+	# Find the blocks already in the cache and work out how much space they
+	# use. They are placed behind any blocks used since the evictor started.
+	"""
+	def _scan(self):
+		found = []
+		usage = 0
+
+		# blocks may be added and evicted while the scan is running
+		with self._lock:
+			usage_before = self.usage
+
+		for (dirpath, dirnames, filenames) in os.walk(self.cacher.cachedir):
+			# cached data kept in the block store is found through each
+			# file's cache.blocks directory
+			for name in ('cache.blocks', BlockStore.DIRECTORY):
+				if name in dirnames:
+					dirnames.remove(name)
+
+			if 'cache.data' in filenames:
+				st = os.stat(os.path.join(dirpath, 'cache.data'))
+				usage += st.st_blocks * 512
+
+			elif os.path.isdir(os.path.join(dirpath, 'cache.blocks')):
+				blocks_dir = os.path.join(dirpath, 'cache.blocks')
+				st = os.stat(blocks_dir)
+				usage += self.cacher.block_store.allocated_bytes(blocks_dir)
+
+			else:
+				continue
+
+			path = '/' + os.path.relpath(dirpath, self.cacher.cachedir)
+			coverage = self.cacher.metadata.open_coverage(path)
+
+			for (start, end) in coverage.ranges.pairs():
+				for i in self._block_indexes(start, end):
+					found.append((st.st_mtime, path, i))
+
+		found.sort()
+
+		with self._lock:
+			blocks = OrderedDict()
+			for (mtime, path, i) in found:
+				blocks[(path, i)] = None
+
+			for key in self._blocks:
+				blocks.pop(key, None)
+				blocks[key] = None
+
+			self._blocks = blocks
+			self.usage = max(0, usage + self.usage - usage_before)
+
+		debug('evictor scanned cache', str(len(found)), 'blocks', str(usage), 'bytes')
+
+	""" Evict least recently used blocks until the cache is within its limits. """
+	def evict(self):
+		# blocks passed over, which go back at the least recently used end
+		# once the pass is over, however it ends
+		passed_over = []
+
+		try:
+			while not self._stopped.is_set() and self._over_limit():
+				with self._lock:
+					if len(self._blocks) == 0:
+						return
+
+					key = self._blocks.popitem(last = False)[0]
+
+				keep = True
+				try:
+					keep = not self._evict_block(key[0], key[1])
+				except EnvironmentError, e:
+					# e.g. the origin can't be reached to check the file;
+					# the block is dropped rather than put back, so that
+					# later passes don't stop at it again
+					debug('evictor cannot evict', key[0], 'block', str(key[1]), e)
+					keep = False
+				finally:
+					if keep:
+						passed_over.append(key)
+
+		finally:
+			if len(passed_over) > 0:
+				with self._lock:
+					blocks = OrderedDict.fromkeys([ k for k in passed_over if k not in self._blocks ])
+					blocks.update(self._blocks)
+					self._blocks = blocks
+
+	# Evict block i of path, returning False if it can't be evicted yet
+	def _evict_block(self, path, i):
+		start = i * self.block_size
+		freed = self.cacher.discard(path, start, start + self.block_size)
+		if freed == BUSY:
+			return False
+
+		if freed is not None:
+			self.evicted_blocks += 1
+		else:
+			# the cache filesystem can't punch holes, so get rid of the
+			# whole file instead
+			freed = self.cacher.evict_file(path)
+			if freed == BUSY:
+				return False
+
+			self.evicted_files += 1
+			self.forget(path)
+
+		self.evicted_bytes += freed
+		with self._lock:
+			self.usage = max(0, self.usage - freed)
+
+		return True
+
+	""" Return the tracked cache usage and how much has been evicted so far. """
+	def stats(self):
+		return {
+			'usage_bytes': self.usage,
+			'tracked_blocks': len(self._blocks),
+			'evicted_blocks': self.evicted_blocks,
+			'evicted_files': self.evicted_files,
+			'evicted_bytes': self.evicted_bytes,
+		}
@@ -1,4 +1,5 @@
+from pcachefsutil import debug
 
 def create(t, *args):
-	print 'create', str(t), str(args)
-	return t(args)
+	debug('create', str(t), str(args))
+	return t(*args)
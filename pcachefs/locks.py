@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+"""
+   Per-path locking used by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import threading
+
+from contextlib import contextmanager
+
+"""
+# A set of locks keyed by path, so that threads working on different files
+# never wait for each other while threads working on the same file take
+# turns.
+#
+# Locks are created when first needed and discarded once no thread holds or
+# is waiting for them, so memory use is proportional to the number of files
+# currently being worked on rather than the number ever seen.
+#
+# Usage:
+#   locks = PathLocks()
+#   with locks.hold('/some/file'):
+#       ... update cache files for /some/file ...
+"""
+class PathLocks(object):
+	def __init__(self):
+		# path -> [ lock, number of threads holding or waiting for it ]
+		self._locks = {}
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._locks)
+
+	@contextmanager
+	def hold(self, path):
+		with self._lock:
+			entry = self._locks.get(path)
+			if entry is None:
+				entry = [ threading.RLock(), 0 ]
+				self._locks[path] = entry
+
+			entry[1] += 1
+
+		try:
+			with entry[0]:
+				yield
+		finally:
+			with self._lock:
+				entry[1] -= 1
+				if entry[1] == 0:
+					del self._locks[path]
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+"""
+   Bounded in-memory LRU cache used by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+"""
+# A dict-like cache holding at most max_size items. When full, the least
+# recently used item is discarded to make room for a new one.
+#
+# If ttl is given (in seconds), items older than ttl are treated as missing
+# and discarded when next looked up. A ttl of None or 0 means items never
+# expire.
+#
+# Hit, miss and eviction counts are kept so the cache can be sized sensibly.
+"""
+class LRUCache(object):
+	def __init__(self, max_size, ttl = None):
+		if max_size < 0:
+			raise ValueError('max_size (' + str(max_size) + ') must not be negative')
+
+		self.max_size = max_size
+		self.ttl = ttl
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+		# key -> (value, time the value was stored)
+		self._items = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._items)
+
+	def __contains__(self, key):
+		return self.get(key, count = False) is not None
+
+	def __repr__(self):
+		return 'LRUCache ' + str(len(self)) + '/' + str(self.max_size)
+
+	"""
+	# Return the value stored for key, or default if there is none (or it
+	# has expired). Looking up a key marks it as most recently used.
+	"""
+	def get(self, key, default = None, count = True):
+		with self._lock:
+			entry = self._items.pop(key, None)
+
+			if entry is not None and self.ttl and time.time() - entry[1] > self.ttl:
+				entry = None
+
+			if entry is None:
+				if count:
+					self.misses += 1
+				return default
+
+			# re-insert to move key to the most recently used end
+			self._items[key] = entry
+
+			if count:
+				self.hits += 1
+			return entry[0]
+
+	"""
+	# Store value for key, discarding the least recently used item if the
+	# cache is full.
+	"""
+	def put(self, key, value):
+		if self.max_size == 0:
+			return
+
+		with self._lock:
+			self._items.pop(key, None)
+			self._items[key] = (value, time.time())
+
+			while len(self._items) > self.max_size:
+				self._items.popitem(last = False)
+				self.evictions += 1
+
+	""" Remove key from the cache, if it is present. """
+	def invalidate(self, key):
+		with self._lock:
+			self._items.pop(key, None)
+
+	""" Remove everything from the cache. Counters are left untouched. """
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+
+	""" Return the number of entries held, and the hits, misses and evictions since startup. """
+	def stats(self):
+		return {
+			'size': len(self._items),
+			'max_size': self.max_size,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+		}
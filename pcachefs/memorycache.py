@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+"""
+   In-memory cache of file data blocks for pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import threading
+
+from collections import OrderedDict
+
+"""
+# Holds blocks of file data, keyed by path and block index, in memory in
+# front of the on-disk cache, using no more than max_bytes. Subclasses
+# decide which blocks are kept when it is full.
+"""
+class MemoryCache(object):
+	# Name of the replacement policy, as given to --memory-cache-policy
+	policy = None
+
+	def __init__(self, max_bytes):
+		if max_bytes < 1:
+			raise ValueError('max_bytes (' + str(max_bytes) + ') must be at least 1')
+
+		self.max_bytes = max_bytes
+		self.bytes = 0
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+		# path -> set of the indexes of its blocks held in memory
+		self._paths = {}
+		self._lock = threading.Lock()
+
+	""" Return block index of path, or None if it is not held. """
+	def get(self, path, index):
+		with self._lock:
+			data = self._get((path, index))
+
+			if data is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+
+			return data
+
+	""" Offer block index of path to the cache, which may keep it. """
+	def put(self, path, index, data):
+		if len(data) > self.max_bytes:
+			return
+
+		with self._lock:
+			self._put((path, index), data)
+
+	""" Forget every block of path, because the file has changed. """
+	def invalidate(self, path):
+		with self._lock:
+			for index in list(self._paths.get(path, ())):
+				self._remove((path, index))
+
+	""" Return the bytes and blocks held in memory against the limit, and the hit rate. """
+	def stats(self):
+		with self._lock:
+			return {
+				'policy': self.policy,
+				'bytes': self.bytes,
+				'max_bytes': self.max_bytes,
+				'blocks': sum([ len(s) for s in self._paths.values() ]),
+				'files': len(self._paths),
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+			}
+
+	# Subclasses hold their resident blocks in one or more OrderedDicts, and
+	# call _added() and _removed() as blocks come and go
+	def _added(self, key, data):
+		self.bytes += len(data)
+		self._paths.setdefault(key[0], set()).add(key[1])
+
+	def _removed(self, key, data):
+		self.bytes -= len(data)
+
+		indexes = self._paths[key[0]]
+		indexes.discard(key[1])
+		if len(indexes) == 0:
+			del self._paths[key[0]]
+
+	def _get(self, key):
+		raise NotImplementedError()
+
+	def _put(self, key, data):
+		raise NotImplementedError()
+
+	def _remove(self, key):
+		raise NotImplementedError()
+
+"""
+# Discards the least recently used block when full.
+"""
+class LRUMemoryCache(MemoryCache):
+	policy = 'lru'
+
+	def __init__(self, max_bytes, block_size = None):
+		MemoryCache.__init__(self, max_bytes)
+		self._blocks = OrderedDict()
+
+	def _get(self, key):
+		data = self._blocks.pop(key, None)
+		if data is not None:
+			self._blocks[key] = data
+		return data
+
+	def _put(self, key, data):
+		self._remove(key)
+
+		self._blocks[key] = data
+		self._added(key, data)
+
+		while self.bytes > self.max_bytes:
+			(old_key, old_data) = self._blocks.popitem(last = False)
+			self._removed(old_key, old_data)
+			self.evictions += 1
+
+	def _remove(self, key):
+		data = self._blocks.pop(key, None)
+		if data is not None:
+			self._removed(key, data)
+
+"""
+# Adaptive Replacement Cache (Megiddo and Modha, 2003). Blocks seen once
+# are kept in t1 and blocks seen again in t2; the split between them adapts
+# using the keys of blocks recently dropped from each (b1 and b2), so that
+# a scan through many blocks which are read once cannot push out those
+# which are read over and over.
+#
+# The capacity is counted in blocks of block_size, so that the cache never
+# holds more than max_bytes.
+"""
+class ARCMemoryCache(MemoryCache):
+	policy = 'arc'
+
+	def __init__(self, max_bytes, block_size):
+		MemoryCache.__init__(self, max_bytes)
+
+		self.capacity = max(max_bytes // block_size, 1)
+
+		# target size of t1, in blocks
+		self.p = 0
+
+		self._t1 = OrderedDict()
+		self._t2 = OrderedDict()
+		self._b1 = OrderedDict()
+		self._b2 = OrderedDict()
+
+	def _get(self, key):
+		data = self._t1.pop(key, None)
+		if data is None:
+			data = self._t2.pop(key, None)
+
+		if data is not None:
+			self._t2[key] = data
+		return data
+
+	def _put(self, key, data):
+		c = self.capacity
+
+		if key in self._t1 or key in self._t2:
+			self._remove(key)
+			self._t2[key] = data
+
+		elif key in self._b1:
+			self.p = min(c, self.p + max(len(self._b2) // len(self._b1), 1))
+			del self._b1[key]
+			self._replace(key)
+			self._t2[key] = data
+
+		elif key in self._b2:
+			self.p = max(0, self.p - max(len(self._b1) // len(self._b2), 1))
+			del self._b2[key]
+			self._replace(key)
+			self._t2[key] = data
+
+		else:
+			l1 = len(self._t1) + len(self._b1)
+			total = l1 + len(self._t2) + len(self._b2)
+
+			if l1 >= c:
+				if len(self._t1) < c:
+					self._b1.popitem(last = False)
+					self._replace(key)
+				else:
+					(old_key, old_data) = self._t1.popitem(last = False)
+					self._removed(old_key, old_data)
+					self.evictions += 1
+			elif total >= c:
+				if total >= 2 * c:
+					self._b2.popitem(last = False)
+				self._replace(key)
+
+			self._t1[key] = data
+
+		self._added(key, data)
+
+	# Make room for key by moving the least recently used block of t1 or t2
+	# to b1 or b2, if the cache is full
+	def _replace(self, key):
+		if len(self._t1) + len(self._t2) < self.capacity:
+			return
+
+		t1 = len(self._t1)
+		if t1 > 0 and (len(self._t2) == 0 or t1 > self.p or (key in self._b2 and t1 == self.p)):
+			(old_key, old_data) = self._t1.popitem(last = False)
+			self._b1[old_key] = None
+		else:
+			(old_key, old_data) = self._t2.popitem(last = False)
+			self._b2[old_key] = None
+
+		self._removed(old_key, old_data)
+		self.evictions += 1
+
+	def _remove(self, key):
+		for blocks in (self._t1, self._t2):
+			data = blocks.pop(key, None)
+			if data is not None:
+				self._removed(key, data)
+
+	def stats(self):
+		result = MemoryCache.stats(self)
+		with self._lock:
+			result.update({
+				'recent_blocks': len(self._t1),
+				'frequent_blocks': len(self._t2),
+				'target_recent_blocks': self.p,
+			})
+		return result
+
+# Memory caches available by policy name, for --memory-cache-policy
+POLICIES = {
+	LRUMemoryCache.policy: LRUMemoryCache,
+	ARCMemoryCache.policy: ARCMemoryCache,
+}
+
+"""
+# Return a new MemoryCache with the given replacement policy, holding up to
+# max_bytes of blocks of block_size. Raises ValueError if there is no such
+# policy.
+"""
+def create_memory_cache(policy, max_bytes, block_size):
+	if policy not in POLICIES:
+		raise ValueError('Unknown memory cache policy ' + repr(policy) + '; choose from ' + ', '.join(sorted(POLICIES.keys())))
+
+	return POLICIES[policy](max_bytes, block_size)
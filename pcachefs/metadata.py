@@ -0,0 +1,432 @@
+#!/usr/bin/python
+
+"""
+   Metadata stores used by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import __builtin__
+import errno
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from coveragemap import CoverageMap
+from pcachefsutil import debug
+
+"""
+# Interface for the places where a Cacher keeps file metadata: stat results,
+# directory listings and coverage maps. File data itself always lives in
+# cache.data files in the cache directory.
+#
+# All methods may be called from several threads at once.
+"""
+class MetadataStore(object):
+	"""
+	# Return a (FuseStat, time stored) tuple for path, or None if nothing is
+	# stored for it. The time is seconds since the epoch, and is updated by
+	# put_stat() and touch_stat().
+	"""
+	def get_stat(self, path):
+		raise NotImplementedError()
+
+	def put_stat(self, path, stat):
+		raise NotImplementedError()
+
+	""" Store several stat results at once, given as (path, stat) tuples. """
+	def put_stats(self, items):
+		for (path, stat) in items:
+			self.put_stat(path, stat)
+
+	""" Record that the stat stored for path is still current. """
+	def touch_stat(self, path):
+		raise NotImplementedError()
+
+	""" Forget the stat stored for path. """
+	def remove_stat(self, path):
+		raise NotImplementedError()
+
+	"""
+	# Return a (list of Direntry objects, time stored) tuple for path, or None
+	# if nothing is stored for it.
+	"""
+	def get_listing(self, path):
+		raise NotImplementedError()
+
+	def put_listing(self, path, listing):
+		raise NotImplementedError()
+
+	"""
+	# Return the CoverageMap for path (empty if nothing has been stored for
+	# it). Callers must serialise changes to the same path's map.
+	"""
+	def open_coverage(self, path):
+		raise NotImplementedError()
+
+	""" Forget the coverage map for path. """
+	def remove_coverage(self, path):
+		raise NotImplementedError()
+
+	"""
+	# Return the set of paths which have data written in write-back mode
+	# that has not yet been written to the origin.
+	"""
+	def get_dirty_paths(self):
+		raise NotImplementedError()
+
+	""" Record whether path has data not yet written to the origin. """
+	def set_dirty(self, path, dirty):
+		raise NotImplementedError()
+
+	""" Make sure everything stored so far is on disk. """
+	def flush(self):
+		pass
+
+	def close(self):
+		self.flush()
+
+"""
+# Stores metadata in small files alongside each path's cache.data:
+#
+#   /cache/dir/filename.ext/cache.stat  # pickle'd stat object (from os.stat())
+#   /cache/dir/filename.ext/cache.data.coverage  # CoverageMap
+#   /cache/dir/cache.list # pickle'd directory listing (from os.listdir())
+#
+# This is the layout pCacheFS has always used. The paths with data not yet
+# written back to the origin are kept as a pickle'd set in a single
+# .pcachefs.dirty file at the top of the cache directory.
+"""
+class FileMetadataStore(MetadataStore):
+	DIRTY_NAME = '.pcachefs.dirty'
+
+	def __init__(self, cachedir):
+		self.cachedir = cachedir
+
+		# Serialises updates to the set of dirty paths
+		self._dirty_lock = threading.Lock()
+
+	def _cache_path(self, path, file):
+		if path[0] != '/':
+			raise ValueError("Expected leading slash")
+
+		return os.path.join(self.cachedir, path[1:], file)
+
+	# Returns (unpickled object, modification time of the file), or None.
+	# The file's modification time serves as the time the object was stored.
+	def _read_pickle(self, path):
+		try:
+			with __builtin__.open(path, 'rb') as f:
+				return (pickle.load(f), os.fstat(f.fileno()).st_mtime)
+
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return None
+
+	def _remove(self, path):
+		try:
+			os.remove(path)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+
+	"""
+	# Pickle obj into the file at path. The data is written to a temporary
+	# file which is then renamed over path, so that other threads reading
+	# path never see a partially written file.
+	"""
+	def _write_pickle(self, path, obj):
+		dirname = os.path.dirname(path)
+		if not os.path.exists(dirname):
+			try:
+				os.makedirs(dirname)
+			except OSError, e:
+				# another thread may have created it in the meantime
+				if e.errno != errno.EEXIST:
+					raise
+
+		tmp_path = path + '.tmp.' + str(threading.current_thread().ident)
+		with __builtin__.open(tmp_path, 'wb') as f:
+			pickle.dump(obj, f)
+
+		os.rename(tmp_path, path)
+
+	def get_stat(self, path):
+		return self._read_pickle(self._cache_path(path, 'cache.stat'))
+
+	def put_stat(self, path, stat):
+		self._write_pickle(self._cache_path(path, 'cache.stat'), stat)
+
+	def touch_stat(self, path):
+		os.utime(self._cache_path(path, 'cache.stat'), None)
+
+	def remove_stat(self, path):
+		self._remove(self._cache_path(path, 'cache.stat'))
+
+	def get_listing(self, path):
+		return self._read_pickle(self._cache_path(path, 'cache.list'))
+
+	def put_listing(self, path, listing):
+		self._write_pickle(self._cache_path(path, 'cache.list'), listing)
+
+	# Any cache.data.range file left by an older version of pCacheFS is
+	# converted when the map is first opened
+	def open_coverage(self, path):
+		return CoverageMap.open(
+			self._cache_path(path, 'cache.data.coverage'),
+			legacy_path = self._cache_path(path, 'cache.data.range'))
+
+	def remove_coverage(self, path):
+		for f in ('cache.data.coverage', 'cache.data.range'):
+			self._remove(self._cache_path(path, f))
+
+	def get_dirty_paths(self):
+		entry = self._read_pickle(os.path.join(self.cachedir, self.DIRTY_NAME))
+		if entry is None:
+			return set()
+
+		return entry[0]
+
+	def set_dirty(self, path, dirty):
+		with self._dirty_lock:
+			paths = self.get_dirty_paths()
+			if (path in paths) == dirty:
+				return
+
+			if dirty:
+				paths.add(path)
+			else:
+				paths.remove(path)
+
+			self._write_pickle(os.path.join(self.cachedir, self.DIRTY_NAME), paths)
+
+"""
+# Stores all metadata in a single SQLite database (pcachefs.db) in the
+# cache directory, rather than in a directory and several small files per
+# cached path. This keeps the number of inodes in the cache down and makes
+# cold starts on large libraries much quicker.
+#
+# Writes are batched: they are committed once batch_size of them are
+# outstanding, and otherwise at most commit_interval seconds after they are
+# made. Losing the last few of these in a crash only means some data is
+# fetched again next time. Writes which record that data has left the
+# cache, or that it has not yet been written back to the origin, are
+# committed before returning instead, as cache.data may be changed as soon
+# as they are made, and the origin brought up to date only from them.
+"""
+class SqliteMetadataStore(MetadataStore):
+	DB_NAME = 'pcachefs.db'
+
+	SCHEMA = [
+		'CREATE TABLE IF NOT EXISTS stat (path TEXT PRIMARY KEY, data BLOB NOT NULL, cached_at REAL NOT NULL DEFAULT 0)',
+		'CREATE TABLE IF NOT EXISTS listing (path TEXT PRIMARY KEY, data BLOB NOT NULL, cached_at REAL NOT NULL DEFAULT 0)',
+		'CREATE TABLE IF NOT EXISTS coverage (path TEXT PRIMARY KEY, data BLOB NOT NULL)',
+		'CREATE TABLE IF NOT EXISTS coverage_journal (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, kind INTEGER NOT NULL, range_start INTEGER NOT NULL, range_end INTEGER NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS coverage_journal_path ON coverage_journal (path)',
+		'CREATE TABLE IF NOT EXISTS dirty (path TEXT PRIMARY KEY)',
+	]
+
+	def __init__(self, cachedir, batch_size = 1000, commit_interval = 1.0):
+		if not os.path.exists(cachedir):
+			os.makedirs(cachedir)
+
+		self.db_path = os.path.join(cachedir, self.DB_NAME)
+		self.batch_size = batch_size
+		self.commit_interval = commit_interval
+
+		self._db = sqlite3.connect(self.db_path, check_same_thread = False)
+		self._db.text_factory = str
+		self._db.execute('PRAGMA journal_mode = WAL')
+		self._db.execute('PRAGMA synchronous = NORMAL')
+		for statement in self.SCHEMA:
+			self._db.execute(statement)
+
+		# databases created before entries were timestamped
+		for table in ('stat', 'listing'):
+			columns = [ row[1] for row in self._db.execute('PRAGMA table_info(' + table + ')') ]
+			if 'cached_at' not in columns:
+				self._db.execute('ALTER TABLE ' + table + ' ADD COLUMN cached_at REAL NOT NULL DEFAULT 0')
+
+		self._db.commit()
+
+		# One connection is shared by all threads
+		self._lock = threading.RLock()
+
+		# number of writes made since the last commit
+		self._uncommitted = 0
+		self._last_commit = time.time()
+
+		self._closed = threading.Event()
+		self._committer = threading.Thread(target = self._commit_periodically, name = 'pcachefs-sqlite-commit')
+		self._committer.daemon = True
+		self._committer.start()
+
+	def _query(self, sql, args = ()):
+		with self._lock:
+			return self._db.execute(sql, args).fetchall()
+
+	# If sync is True, the write is committed (with anything else pending)
+	# before returning rather than batched
+	def _write(self, sql, rows, sync = False):
+		with self._lock:
+			self._db.executemany(sql, rows)
+			self._uncommitted += len(rows)
+
+			if sync or self._uncommitted >= self.batch_size:
+				self._commit()
+
+	def _commit(self):
+		with self._lock:
+			if self._uncommitted > 0:
+				self._db.commit()
+				self._uncommitted = 0
+
+			self._last_commit = time.time()
+
+	def _commit_periodically(self):
+		while not self._closed.wait(self.commit_interval):
+			try:
+				with self._lock:
+					# close() may have run while we were waiting for the lock
+					if self._closed.is_set():
+						return
+
+					self._commit()
+			except sqlite3.Error, e:
+				debug('sqlite commit failed', e)
+
+	def _get_pickle(self, table, path):
+		rows = self._query('SELECT data, cached_at FROM ' + table + ' WHERE path = ?', (path,))
+		if len(rows) == 0:
+			return None
+
+		return (pickle.loads(str(rows[0][0])), rows[0][1])
+
+	def _put_pickles(self, table, items):
+		now = time.time()
+		self._write('INSERT OR REPLACE INTO ' + table + ' (path, data, cached_at) VALUES (?, ?, ?)',
+			[ (path, sqlite3.Binary(pickle.dumps(obj, 2)), now) for (path, obj) in items ])
+
+	def get_stat(self, path):
+		return self._get_pickle('stat', path)
+
+	def put_stat(self, path, stat):
+		self._put_pickles('stat', [ (path, stat) ])
+
+	def put_stats(self, items):
+		self._put_pickles('stat', items)
+
+	def touch_stat(self, path):
+		self._write('UPDATE stat SET cached_at = ? WHERE path = ?', [ (time.time(), path) ])
+
+	def remove_stat(self, path):
+		self._write('DELETE FROM stat WHERE path = ?', [ (path,) ])
+
+	def get_listing(self, path):
+		return self._get_pickle('listing', path)
+
+	def put_listing(self, path, listing):
+		self._put_pickles('listing', [ (path, listing) ])
+
+	def open_coverage(self, path):
+		return SqliteCoverageMap.load(self, path)
+
+	def remove_coverage(self, path):
+		with self._lock:
+			self._write('DELETE FROM coverage WHERE path = ?', [ (path,) ])
+			self._write('DELETE FROM coverage_journal WHERE path = ?', [ (path,) ], sync = True)
+
+	def get_dirty_paths(self):
+		return set([ row[0] for row in self._query('SELECT path FROM dirty') ])
+
+	def set_dirty(self, path, dirty):
+		if dirty:
+			self._write('INSERT OR IGNORE INTO dirty (path) VALUES (?)', [ (path,) ], sync = True)
+		else:
+			self._write('DELETE FROM dirty WHERE path = ?', [ (path,) ], sync = True)
+
+	def flush(self):
+		self._commit()
+
+	def close(self):
+		with self._lock:
+			self._closed.set()
+
+		self._committer.join()
+
+		with self._lock:
+			self._commit()
+			self._db.close()
+
+"""
+# A CoverageMap kept in a SqliteMetadataStore. The snapshot is stored as a
+# blob in the coverage table, in the same format as a cache.data.coverage
+# file, and journal records as rows of the coverage_journal table.
+"""
+class SqliteCoverageMap(CoverageMap):
+	def __init__(self, path, ranges = None, store = None):
+		CoverageMap.__init__(self, path, ranges)
+		self.store = store
+
+	@classmethod
+	def load(cls, store, path):
+		with store._lock:
+			snapshot = store._query('SELECT data FROM coverage WHERE path = ?', (path,))
+			journal = store._query('SELECT kind, range_start, range_end FROM coverage_journal WHERE path = ? ORDER BY id', (path,))
+
+		if len(snapshot) == 0:
+			result = cls(path, None, store)
+		else:
+			result = cls._parse(path, str(snapshot[0][0]), store)
+
+		for (kind, start, end) in journal:
+			result.apply(kind, start, end)
+
+		return result
+
+	# Records which must be committed at once; see SqliteMetadataStore
+	SYNC_RECORDS = (CoverageMap.RECORD_REMOVE, CoverageMap.RECORD_DIRTY)
+
+	def _must_sync(self, records):
+		return any([ kind in self.SYNC_RECORDS for (kind, start, end) in records ])
+
+	def _append_records(self, records):
+		self.store._write(
+			'INSERT INTO coverage_journal (path, kind, range_start, range_end) VALUES (?, ?, ?, ?)',
+			[ (self.path, kind, start, end) for (kind, start, end) in records ],
+			sync = self._must_sync(records))
+
+	# compact() calls this before clearing self.pending, so the changes the
+	# snapshot takes in are still known
+	def _write_snapshot(self, data):
+		with self.store._lock:
+			self.store._write('INSERT OR REPLACE INTO coverage (path, data) VALUES (?, ?)', [ (self.path, sqlite3.Binary(data)) ])
+			self.store._write('DELETE FROM coverage_journal WHERE path = ?', [ (self.path,) ],
+				sync = self._must_sync(self.pending))
+
+# Names accepted by create_store(), and the classes they map to
+STORES = {
+	'file': FileMetadataStore,
+	'sqlite': SqliteMetadataStore,
+}
+
+""" Create the MetadataStore called name (one of STORES) for the given cache directory. """
+def create_store(name, cachedir):
+	if name not in STORES:
+		raise ValueError('Unknown metadata store: ' + str(name) + ' (expected one of ' + ', '.join(sorted(STORES.keys())) + ')')
+
+	return STORES[name](cachedir)
@@ -20,21 +20,37 @@
 """
 
 import fuse
+import copy
 import stat
 import os
 import time
 import sys
 import pickle
+import threading
 import types
 import factory
 
 from datetime import datetime
 from ranges import (Ranges, Range)
+from lrucache import LRUCache
+from metadata import (FileMetadataStore, create_store)
+from readahead import Readahead
+from locks import PathLocks
+from cachedfile import CachedFile
+from blockstore import (BlockStore, BlockStoreCachedFile)
+from compression import (CODECS, create_codec)
+from memorycache import (POLICIES, create_memory_cache)
+from admission import (ADMISSION_POLICIES, create_admission_policy)
+from stats import (Stats, format_stats)
+from tracing import (Tracer, RingBufferSink, JsonLinesSink, SamplingProfiler)
+from evictor import (Evictor, BUSY)
+from writeback import WriteBack
+from workers import WorkerPool
 from optparse import OptionGroup
 from pcachefsutil import *
 
 # We explicitly refer to __builtin__ here so it can be mocked
-#import __builtin__
+import __builtin__
 
 import vfs
 
@@ -78,11 +94,41 @@ class PersistentCacheFs(fuse.Fuse):
 	def __init__(self, *args, **kw):
 		fuse.Fuse.__init__(self, *args, **kw)
 
-		# Currently we have to run in single-threaded mode to prevent the cache becoming corrupted
-		fuse_opts = self.parse(['-s'])
-
 		self.parser.add_option('-c', '--cache-dir', dest='cache_dir', help="Specifies the directory where cached data should be stored. This will be created if it does not exist.")
 		self.parser.add_option('-t', '--target-dir', dest='target_dir', help="The directory which we are caching. The content of this directory will be mirrored and all reads cached.")
+		self.parser.add_option('--stat-cache-size', dest='stat_cache_size', type='int', default=Cacher.DEFAULT_STAT_CACHE_SIZE, help="Maximum number of stat results to hold in memory in front of the on-disk cache. 0 disables the in-memory stat cache.")
+		self.parser.add_option('--block-size', dest='block_size', default=str(Cacher.DEFAULT_BLOCK_SIZE), help="Size of the blocks in which data is fetched from the target directory and cached, e.g. 1M. Reads that miss the cache are rounded out to whole blocks.")
+		self.parser.add_option('--readahead', dest='readahead', type='int', default=Cacher.DEFAULT_READAHEAD, help="Maximum number of blocks to prefetch in the background when a file is read sequentially. 0 disables readahead.")
+		self.parser.add_option('--readahead-threads', dest='readahead_threads', type='int', default=2, help="Number of threads used to prefetch blocks for readahead.")
+		self.parser.add_option('--dedup', dest='dedup', action='store_true', default=False, help="Store each distinct block of cached data only once, however many files it appears in, in a content-addressed block store in the cache directory. This saves disk space only: a copy of a file at another path is still read from the target directory, and only other paths to the same file (hard links or bind mounts, with the same device, inode, size and modification time) are served from data already cached. Switching this on or off discards previously cached file data.")
+		self.parser.add_option('--compress', dest='compress', default=None, help="Compress cached data with the given codec: " + ', '.join(sorted(CODECS.keys())) + ". Each file is checked when it is first cached, and files which don't compress well (such as media and archives) are left uncompressed. Compressed data is kept in the block store, so this implies --dedup.")
+		self.parser.add_option('--compress-threads', dest='compress_threads', type='int', default=2, help="Number of threads used to compress cached blocks. 0 compresses them on the thread which fetched them.")
+		self.parser.add_option('--fetch-threads', dest='fetch_threads', type='int', default=Cacher.DEFAULT_FETCH_THREADS, help="Number of threads used to fetch the missing parts of a read from the target directory at the same time. 0 fetches them one after another.")
+		self.parser.add_option('--memory-cache-size', dest='memory_cache_size', default='0', help="Amount of file data to keep in memory in front of the cache directory, e.g. 256M, so that the most frequently read blocks are served without touching the disk. 0 (the default) disables this.")
+		self.parser.add_option('--memory-cache-policy', dest='memory_cache_policy', default='arc', help="How blocks are chosen to stay in memory: " + ', '.join(sorted(POLICIES.keys())) + ". 'arc' (the default) keeps blocks which are read repeatedly in memory even while other files are read through once; 'lru' keeps the most recently read blocks.")
+		self.parser.add_option('--admission', dest='admission', default='always', help="Which files are cached when they are first read: " + ', '.join(sorted(ADMISSION_POLICIES.keys())) + ". 'always' (the default) caches every file; 'nth' caches a file once it has been opened --admission-count times; 'tinylfu' does the same, estimating how often each file has been opened recently in a fixed amount of memory. Files which are not cached are read straight from the target directory, so that a scan through files which are read once doesn't fill the cache.")
+		self.parser.add_option('--admission-count', dest='admission_count', type='int', default=2, help="Number of times a file must be opened before it is cached, with --admission nth or tinylfu.")
+		self.parser.add_option('--admission-max-file-size', dest='admission_max_file_size', default='0', help="Never cache files larger than this, e.g. 4G; they are read straight from the target directory. 0 (the default) means no limit.")
+		self.parser.add_option('--no-mmap', dest='mmap', action='store_false', default=True, help="Read cached data with ordinary reads rather than through a memory mapping of each open file's cached data.")
+		self.parser.add_option('--preallocate-hot', dest='preallocate_hot', type='int', default=0, help="Reserve disk space for the whole of a file's cache data once it has been opened this many times. 0 (the default) leaves cache data files sparse.")
+		self.parser.add_option('--max-cache-size', dest='max_cache_size', default='0', help="Maximum amount of file data to keep in the cache, e.g. 50G. Least recently used blocks are evicted to stay within it. 0 (the default) means no limit.")
+		self.parser.add_option('--min-free-space', dest='min_free_space', default='0', help="Amount of space to keep free on the filesystem holding the cache, e.g. 5G. Least recently used blocks are evicted to keep it free. 0 (the default) means no limit.")
+		self.parser.add_option('--metadata-store', dest='metadata_store', default='file', help="Where to keep cached metadata (stat results, directory listings and coverage maps): 'file' (the default) for small files next to each path's cached data, or 'sqlite' for a single database in the cache directory. Switching store discards previously cached metadata.")
+		self.parser.add_option('--stat-cache-ttl', dest='stat_cache_ttl', type='float', default=0, help="Seconds an in-memory stat result is used before it is re-read from the on-disk cache. 0 means results never expire.")
+		self.parser.add_option('--attr-ttl', dest='attr_ttl', type='float', default=0, help="Seconds a cached stat result is trusted before it is checked against the target directory. A file whose size, modification time or inode has changed has its cached data discarded. 0 (the default) means cached stat results are trusted forever.")
+		self.parser.add_option('--no-readdir-stats', dest='readdir_stats', action='store_false', default=True, help="Don't stat every entry of a directory when it is listed. By default, listing a directory also caches the stat results of its entries, so that a following 'ls -l' doesn't stat each one separately.")
+		self.parser.add_option('--readdir-stat-threads', dest='readdir_stat_threads', type='int', default=8, help="Number of threads used to stat the entries of a directory when it is listed. 0 stats them one at a time.")
+		self.parser.add_option('--negative-ttl', dest='negative_ttl', type='float', default=0, help="Seconds to remember that a path does not exist in the target directory, so that repeated lookups of missing files don't go to the target directory. While a path's parent directory listing is cached, it is also used to answer such lookups. 0 (the default) disables this.")
+		self.parser.add_option('--listing-ttl', dest='listing_ttl', type='float', default=0, help="Seconds a cached directory listing is trusted before it is re-read from the target directory. 0 (the default) means cached listings are trusted forever.")
+		self.parser.add_option('--write-back', dest='write_back', action='store_true', default=False, help="Allow existing files to be written to and truncated. Changes are made to the cache and written to the target directory in the background, adjacent changes being combined into large writes; fsync() writes a file's changes straight away. Files can't be created, removed or renamed. Can't be used with --dedup or --compress.")
+		self.parser.add_option('--write-back-interval', dest='write_back_interval', type='float', default=WriteBack.DEFAULT_INTERVAL, help="Seconds between writing changes made in --write-back mode to the target directory.")
+		self.parser.add_option('--trace-buffer', dest='trace_buffer', type='int', default=0, help="Record the timing of each operation and of its stages (metadata loads, origin reads, cache reads and writes), keeping the most recent this many in memory to be read as JSON lines from /.pcachefs.trace. 0 (the default) disables this.")
+		self.parser.add_option('--trace-file', dest='trace_file', default=None, help="Record the timing of each operation and of its stages, appending them to this file as JSON lines.")
+
+		# Replaced in main() if tracing is enabled
+		self.tracer = Tracer()
+		self.trace_buffer = None
+		self.profiler = SamplingProfiler()
 
 	def main(self, args=None):
 		options = self.cmdline[0]
@@ -92,6 +138,35 @@ class PersistentCacheFs(fuse.Fuse):
 				raise ValueError('Need to specify --cache-dir')
 			if options.target_dir == None:
 				raise ValueError('Need to specify --target-dir')
+
+			block_size = parse_size(options.block_size)
+			max_cache_size = parse_size(options.max_cache_size)
+			min_free_space = parse_size(options.min_free_space)
+
+			if not os.path.exists(options.cache_dir):
+				os.makedirs(options.cache_dir)
+			metadata = create_store(options.metadata_store, options.cache_dir)
+
+			codec = None
+			if options.compress is not None:
+				codec = create_codec(options.compress)
+
+			memory_cache = None
+			memory_cache_size = parse_size(options.memory_cache_size)
+			if memory_cache_size > 0:
+				memory_cache = create_memory_cache(options.memory_cache_policy, memory_cache_size, block_size)
+
+			admission = None
+			admission_max_file_size = parse_size(options.admission_max_file_size)
+			if options.admission != 'always' or admission_max_file_size > 0:
+				admission = create_admission_policy(options.admission, options.admission_count, admission_max_file_size)
+
+			if options.trace_buffer > 0:
+				self.trace_buffer = RingBufferSink(options.trace_buffer)
+				self.tracer.add_sink(self.trace_buffer)
+			if options.trace_file is not None:
+				self.tracer.add_sink(JsonLinesSink(options.trace_file))
+			self.tracer.enabled = len(self.tracer.sinks) > 0
 		except Exception, e:
 			print e
 			sys.exit(1)	
@@ -99,7 +174,32 @@ class PersistentCacheFs(fuse.Fuse):
 		self.cache_dir = options.cache_dir
 		self.target_dir = options.target_dir
 
-		self.cacher = Cacher(self.cache_dir, UnderlyingFs(self.target_dir))
+		ufs = UnderlyingFs(self.target_dir, options.readdir_stat_threads if options.readdir_stats else 0)
+
+		self.cacher = Cacher(self.cache_dir, ufs,
+			stat_cache_size = options.stat_cache_size,
+			stat_cache_ttl = options.stat_cache_ttl,
+			attr_ttl = options.attr_ttl,
+			listing_ttl = options.listing_ttl,
+			negative_ttl = options.negative_ttl,
+			readdir_stats = options.readdir_stats,
+			block_size = block_size,
+			readahead = options.readahead,
+			readahead_threads = options.readahead_threads,
+			fetch_threads = options.fetch_threads,
+			dedup = options.dedup,
+			codec = codec,
+			compress_threads = options.compress_threads,
+			mmap_reads = options.mmap,
+			memory_cache = memory_cache,
+			admission = admission,
+			preallocate_hot = options.preallocate_hot,
+			max_cache_size = max_cache_size,
+			min_free_space = min_free_space,
+			metadata = metadata,
+			tracer = self.tracer,
+			write_back = options.write_back,
+			write_back_interval = options.write_back_interval)
 		
 		# Initialise the VirtualFileFS, which contains 'virtual' files which
 		# can be used by user apps to read and change internal pcachefs state
@@ -109,56 +209,146 @@ class PersistentCacheFs(fuse.Fuse):
 				callback_on_true = self.cacher.cache_only_mode_enable,
 				callback_on_false = self.cacher.cache_only_mode_disable)
 		)
+		self.vfs.add_file(
+			vfs.SimpleVirtualFile('stat_cache', self._read_stat_cache_stats)
+		)
+		self.vfs.add_file(
+			vfs.SimpleVirtualFile('stats', self._read_stats)
+		)
+
+		# Tracing can be paused and resumed while mounted, if it was enabled
+		if len(self.tracer.sinks) > 0:
+			tracing = vfs.BooleanVirtualFile('tracing',
+				callback_on_true = self._enable_tracing,
+				callback_on_false = self._disable_tracing)
+			tracing.value = self.tracer.enabled
+			self.vfs.add_file(tracing)
+
+		if self.trace_buffer is not None:
+			self.vfs.add_file(
+				vfs.SimpleVirtualFile('trace', self.trace_buffer.format)
+			)
+
+		# Writing 1 to .pcachefs.profile starts sampling the stacks of
+		# every thread, and 0 stops it; the stacks seen can then be read
+		# from .pcachefs.profile_report
+		self.vfs.add_file(
+			vfs.BooleanVirtualFile('profile',
+				callback_on_true = self.profiler.start,
+				callback_on_false = self.profiler.stop)
+		)
+		self.vfs.add_file(
+			vfs.SimpleVirtualFile('profile_report', self.profiler.report)
+		)
 
 		fuse.Fuse.main(self, args)
 
+	# Called by FUSE when the filesystem is unmounted
+	def fsdestroy(self):
+		self.profiler.stop()
+		self.cacher.close()
+		self.tracer.close()
+
+	def _read_stat_cache_stats(self):
+		return format_stats(self.cacher.stat_cache.stats())
+
+	def _read_stats(self):
+		return format_stats(self.cacher.stats())
+
+	def _enable_tracing(self):
+		self.tracer.enabled = True
+
+	def _disable_tracing(self):
+		self.tracer.enabled = False
+
 	def getattr(self, path):
 		if self.vfs.contains(path):
 			return self.vfs.getattr(path)
 
-		return self.cacher.getattr(path)
+		with self.tracer.span('fuse.getattr', path):
+			return self.cacher.getattr(path)
 
 	def readdir(self, path, offset):
 		for f in self.vfs.readdir(path, offset):
 			yield f
 
-		for f in self.cacher.readdir(path, offset):
+		with self.tracer.span('fuse.readdir', path):
+			entries = self.cacher.readdir(path, offset)
+
+		for f in entries:
 			yield f
 
 	def open(self, path, flags):
 		if self.vfs.contains(path):
 			return self.vfs.open(path, flags)
 
-		# Only support for 'READ ONLY' flag
+		# Files can only be written in write-back mode
 		access_flags = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
-		if flags & access_flags != os.O_RDONLY:
+		if flags & access_flags != os.O_RDONLY and not self.cacher.write_back_enabled:
 			return E_PERM_DENIED
 		else:
-			return 0
+			# returning an object here makes FUSE pass it back to us as fh
+			with self.tracer.span('fuse.open', path):
+				return self.cacher.open(path, flags)
 
-	def read(self, path, size, offset):
+	def read(self, path, size, offset, fh=None):
 		if self.vfs.contains(path):
 			return self.vfs.read(path, size, offset)
 
-		return self.cacher.read(path, size, offset)
+		with self.tracer.span('fuse.read', path):
+			return self.cacher.read(path, size, offset, fh)
 
-	def write(self, path, buf, offset):
+	def write(self, path, buf, offset, fh=None):
 		if self.vfs.contains(path):
 			return self.vfs.write(path, buf, offset)
 
-		return E_NOT_IMPL
+		if not self.cacher.write_back_enabled:
+			return E_NOT_IMPL
+
+		with self.tracer.span('fuse.write', path):
+			return self.cacher.write(path, buf, offset, fh)
+
+	def truncate(self, path, size):
+		if self.vfs.contains(path):
+			return self.vfs.truncate(path, size)
+
+		return self.ftruncate(path, size)
+
+	def ftruncate(self, path, size, fh=None):
+		if self.vfs.contains(path):
+			return self.vfs.truncate(path, size)
+
+		if not self.cacher.write_back_enabled:
+			return E_PERM_DENIED
+
+		with self.tracer.span('fuse.truncate', path):
+			return self.cacher.truncate(path, size, fh)
 
-	def flush(self, path):
+	def flush(self, path, fh=None):
 		if self.vfs.contains(path):
 			return self.vfs.flush(path)
 
+		if fh is not None:
+			return self.cacher.flush(path, fh)
+
 		return 0 # success
 
-	def release(self, path, what):
+	def fsync(self, path, datasync, fh=None):
+		if self.vfs.contains(path) or fh is None:
+			return 0 # success
+
+		with self.tracer.span('fuse.fsync', path):
+			return self.cacher.fsync(path, fh)
+
+	def release(self, path, what, fh=None):
 		debug('release ' + str(path) + ', ' + str(what))
 		if self.vfs.contains(path):
 			return self.vfs.release(path)
 
+		if fh is not None:
+			with self.tracer.span('fuse.release', path):
+				return self.cacher.release(path, fh)
+
 		return 0 # success
 
 #	def _getattr_special(self, path):
@@ -202,9 +392,23 @@ class PersistentCacheFs(fuse.Fuse):
 			
 """ Implementation of FUSE operations that fetches data from the underlying FS """
 class UnderlyingFs:
-	def __init__(self, real_path):
+	"""
+	# real_path the directory being cached
+	# stat_threads the number of threads readdirplus() uses to stat the
+	#   entries of a directory concurrently (0 stats them one at a time)
+	"""
+	def __init__(self, real_path, stat_threads = 0):
 		self.real_path = real_path
 
+		self._stat_pool = None
+		if stat_threads > 0:
+			self._stat_pool = WorkerPool(stat_threads, 'pcachefs-stat')
+
+	""" Stop the threads used by readdirplus(). """
+	def close(self):
+		if self._stat_pool is not None:
+			self._stat_pool.shutdown()
+
 	def _get_real_path(self, path):
 		if path[0] != '/':
 			raise ValueError("Expected leading slash")
@@ -217,7 +421,7 @@ class UnderlyingFs:
 		return fuse.Direntry(os.path.basename(r))
 
 	def getattr(self, path):
-		print 'UFS GETATTR C_F_S'
+		debug('ufs.getattr', path)
 		return factory.create(FuseStat, os.stat(self._get_real_path(path)))
 
 	def readdir(self, path, offset):
@@ -232,15 +436,94 @@ class UnderlyingFs:
 		# return a generator over the entries in the directory		
 		return (fuse.Direntry(r) for r in dirents)
 
-	def read(self, path, size, offset):
-		real_path = self._get_real_path(path)
+	"""
+	# List the given directory and stat every entry in it in the same pass.
+	# Returns a list of Direntry objects, as readdir() would generate, and a
+	# list of (path, FuseStat) tuples for the entries. Entries which vanish
+	# before they can be stat'd are listed but have no stat.
+	"""
+	def readdirplus(self, path):
+		dirents = list(self.readdir(path, 0))
+		paths = [ os.path.join(path, d.name) for d in dirents if d.name not in ('.', '..') ]
+
+		if self._stat_pool is not None:
+			tasks = [ self._stat_pool.submit(self._getattr_if_exists, p) for p in paths ]
+			stats = [ t.result() for t in tasks ]
+		else:
+			stats = [ self._getattr_if_exists(p) for p in paths ]
+
+		return (dirents, [ (p, st) for (p, st) in zip(paths, stats) if st is not None ])
+
+	def _getattr_if_exists(self, path):
+		try:
+			return self.getattr(path)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return None
+
+	"""
+	Open the given path for reading, returning a file object which can be
+	passed to read() as fh.
+	"""
+	def open(self, path):
+		return __builtin__.open(self._get_real_path(path), 'rb')
 
-		with __builtin__.open(real_path, 'rb') as f:
-			f.seek(offset)
-			result = f.read(size)
+	"""
+	Read size bytes at offset from the given path. If fh (a file object
+	returned by open()) is given it is read from, otherwise the file is
+	opened just for this read.
+	"""
+	def read(self, path, size, offset, fh = None):
+		if fh is not None:
+			fh.seek(offset)
+			result = fh.read(size)
+
+		else:
+			real_path = self._get_real_path(path)
+
+			with __builtin__.open(real_path, 'rb') as f:
+				f.seek(offset)
+				result = f.read(size)
 
 		debug('ufs.read', path, str(size), str(offset))
 		return result
+
+	"""
+	Open the given path for writing, returning an unbuffered file object
+	which can be passed to write(), truncate() and fsync() as fh.
+	"""
+	def open_writable(self, path):
+		return __builtin__.open(self._get_real_path(path), 'r+b', 0)
+
+	"""
+	Write buf at offset in the given path, through fh (a file object returned
+	by open_writable()) if it is given.
+	"""
+	def write(self, path, buf, offset, fh = None):
+		debug('ufs.write', path, str(len(buf)), str(offset))
+
+		if fh is None:
+			with self.open_writable(path) as f:
+				return self.write(path, buf, offset, f)
+
+		fh.seek(offset)
+		fh.write(buf)
+		return len(buf)
+
+	""" Truncate or extend the given path to size bytes. """
+	def truncate(self, path, size, fh = None):
+		debug('ufs.truncate', path, str(size))
+
+		if fh is None:
+			with self.open_writable(path) as f:
+				return self.truncate(path, size, f)
+
+		os.ftruncate(fh.fileno(), size)
+
+	""" Make sure everything written through fh has reached the disk. """
+	def fsync(self, path, fh):
+		os.fsync(fh.fileno())
 """
 # Represents a cache, which caches entire files and their content. This class mimics
  the interface of a python Fuse object.
@@ -250,16 +533,45 @@ class UnderlyingFs:
 # Initially the implementation will copy *entire* files (incl metadata)
 # down into the cache when they are read.
 #
-# The cached files are stored as follows in the cache directory:
+# The cached file data is stored as follows in the cache directory:
 #   /cache/dir/filename.ext/cache.data   # copy of file data
-#   /cache/dir/filename.ext/cache.stat  # pickle'd stat object (from os.stat())
-#   /cache/dir/cache.list # pickle'd directory listing (from os.listdir())
 #
+# Metadata (stat results, directory listings and coverage maps recording
+# which parts of cache.data are populated) is kept by a MetadataStore;
+# see the metadata module for the available stores and their layouts.
 #
-# For writes to files in the cache, these are passed through to the
-# underlying filesystem without any caching.
+# Writes are only supported in write-back mode, where they are made to
+# cache.data and written through to the underlying filesystem later, in
+# the background; see write() and write_back().
 #"""
 class Cacher:
+	# Default number of FuseStat objects held in memory by the stat cache
+	DEFAULT_STAT_CACHE_SIZE = 10000
+
+	# Default unit (in bytes) in which data is fetched and cached
+	DEFAULT_BLOCK_SIZE = 128 * 1024
+
+	# Default maximum readahead window, in blocks
+	DEFAULT_READAHEAD = 16
+
+	# Default number of threads fetching parts of a read concurrently
+	DEFAULT_FETCH_THREADS = 4
+
+	# Maximum number of paths whose open count is remembered
+	MAX_OPEN_COUNTS = 10000
+
+	# Maximum number of nonexistent paths remembered
+	MAX_NEGATIVE_ENTRIES = 10000
+
+	# Largest single write made to underlying_fs when writing back
+	MAX_WRITE_BACK = 4 * 1024 * 1024
+
+	# Counters reported by stats() even before they are first updated
+	COUNTERS = [ 'getattr.hits', 'getattr.misses', 'getattr.negative_hits', 'getattr.revalidations',
+		'readdir.hits', 'readdir.misses', 'read.hits', 'read.misses', 'read.bytes',
+		'read.bytes_from_origin', 'origin.read_bytes', 'prefetch.bytes', 'write.bytes',
+		'write_back.bytes', 'write_back.writes', 'read.not_admitted',
+		'fetch.coalesced_blocks' ]
 
 	"""
 	# Initialise a new Cacher.
@@ -269,10 +581,125 @@ class Cacher:
 	# underlying_fs an object supporting the read(), readdir() and getattr() FUSE
 	#   operations. For any files/dirs not in the cache, this object's methods will
 	#   be called to retrieve the real data and populate the cache.
+	# stat_cache_size the maximum number of stat results to keep in memory in
+	#   front of the on-disk cache.stat files (0 disables the in-memory cache)
+	# stat_cache_ttl seconds after which an in-memory stat result is discarded
+	#   and re-read from cache.stat (0 or None means never)
+	# attr_ttl seconds after which a cached stat result is checked against
+	#   underlying_fs; if the file's size, mtime or inode has changed, its
+	#   cached data is discarded (0 or None means never)
+	# listing_ttl seconds after which a cached directory listing is re-read
+	#   from underlying_fs (0 or None means never)
+	# negative_ttl seconds for which to remember that a path does not exist
+	#   in underlying_fs; while this is enabled, paths missing from their
+	#   parent directory's cached listing are also taken not to exist
+	#   (0 or None disables this)
+	# readdir_stats if True and underlying_fs has a readdirplus() method,
+	#   the stat results it returns for a directory's entries are cached
+	#   whenever the directory's listing is fetched
+	# block_size the unit in bytes in which data is fetched from underlying_fs;
+	#   misses are rounded out to whole aligned blocks
+	# readahead the maximum number of blocks to prefetch in the background
+	#   when a file is being read sequentially (0 disables readahead)
+	# readahead_threads the number of threads used to run prefetches
+	# fetch_threads the number of threads used to fetch the uncached parts
+	#   of a read from underlying_fs concurrently (0 fetches them in turn)
+	# dedup if True, file data is kept in a content-addressed BlockStore,
+	#   storing identical blocks once, rather than in cache.data files. This
+	#   only saves disk space: copies at other origin paths are still read
+	#   from underlying_fs; only hard links to (or bind mounts of) an origin
+	#   file already cached are served from its blocks
+	# codec a Codec with which to compress file data, or None; as compressed
+	#   data is kept in the BlockStore, this implies dedup
+	# compress_threads the number of threads used to compress blocks
+	# mmap_reads if True, cached data is read through a memory mapping of
+	#   each open file's cache.data (not used with dedup)
+	# memory_cache a MemoryCache holding blocks of file data in memory in
+	#   front of the on-disk cache, or None
+	# admission an AdmissionPolicy deciding whether a file with nothing
+	#   cached is cached when it is opened; files which are not admitted are
+	#   read straight from underlying_fs. None admits every file.
+	# preallocate_hot reserve disk space for the whole of a file's cache.data
+	#   once it has been opened this many times (0 disables preallocation;
+	#   cache.data files are otherwise sparse)
+	# max_cache_size the number of bytes of file data the cache may hold
+	#   before least recently used blocks are evicted (0 means no limit)
+	# min_free_space the number of bytes to keep free on the filesystem
+	#   holding the cache, evicting blocks if necessary (0 means no limit)
+	# metadata the MetadataStore in which to keep stat results, listings and
+	#   coverage maps (by default, a FileMetadataStore in cachedir)
+	# tracer a Tracer to which to report the timing of each stage of reads
+	#   and metadata lookups (by default, a disabled one)
+	# write_back if True, write() and truncate() are supported: changes are
+	#   made to cache.data and written to underlying_fs in the background,
+	#   which must then support open_writable(), write(), truncate() and
+	#   fsync(). This can't be used with dedup or codec.
+	# write_back_interval seconds between background write-backs
 	"""
-	def __init__(self, cachedir, underlying_fs):
+	def __init__(self, cachedir, underlying_fs, stat_cache_size = DEFAULT_STAT_CACHE_SIZE, stat_cache_ttl = None, attr_ttl = None, listing_ttl = None, negative_ttl = None, readdir_stats = True, block_size = DEFAULT_BLOCK_SIZE, readahead = 0, readahead_threads = 2, fetch_threads = DEFAULT_FETCH_THREADS, dedup = False, codec = None, compress_threads = 2, mmap_reads = True, memory_cache = None, admission = None, preallocate_hot = 0, max_cache_size = 0, min_free_space = 0, metadata = None, tracer = None, write_back = False, write_back_interval = WriteBack.DEFAULT_INTERVAL):
+		if block_size < 1:
+			raise ValueError('block_size (' + str(block_size) + ') must be at least 1')
+
 		self.cachedir = cachedir
 		self.underlying_fs = underlying_fs
+		self.block_size = block_size
+
+		if tracer is None:
+			tracer = Tracer()
+		self.tracer = tracer
+
+		# Hit and miss counts, bytes served and origin latencies; see stats()
+		self.counters = Stats()
+		for name in self.COUNTERS:
+			self.counters.add(name, 0)
+
+		# In-memory LRU of (FuseStat, time stored) tuples keyed by path, so
+		# that repeated getattr() calls don't need to hit cache.stat on disk
+		self.stat_cache = LRUCache(stat_cache_size, stat_cache_ttl)
+
+		self.attr_ttl = attr_ttl
+		self.listing_ttl = listing_ttl
+		self.readdir_stats = readdir_stats
+
+		# Paths which recently turned out not to exist
+		self.negative_ttl = negative_ttl
+		self.negative_cache = LRUCache(self.MAX_NEGATIVE_ENTRIES if negative_ttl else 0, negative_ttl)
+
+		# Serialises updates to each file's cache.data and coverage map
+		# between FUSE threads and readahead threads. Reads of data which
+		# is already cached never take these locks.
+		self._path_locks = PathLocks()
+
+		# (path, block index) -> Event set once the block has been fetched,
+		# for every block being fetched from underlying_fs; see _fill()
+		self._in_flight = {}
+		self._in_flight_lock = threading.Lock()
+
+		# Number of times each recently used path has been opened, for
+		# deciding which files are hot enough to preallocate
+		self.preallocate_hot = preallocate_hot
+		self._open_counts = LRUCache(self.MAX_OPEN_COUNTS)
+
+		# path -> CachedFile for every file that is currently open
+		self._open_files = {}
+		self._open_files_lock = threading.Lock()
+
+		# Where file data is kept when dedup is enabled. It is also used to
+		# clear out blocks cached while dedup was enabled, once it is not.
+		self.dedup = dedup or codec is not None
+		self.block_store = BlockStore(cachedir, block_size, codec, compress_threads)
+
+		self.mmap_reads = mmap_reads
+		self.memory_cache = memory_cache
+		self.admission = admission
+
+		self._fetch_pool = None
+		if fetch_threads > 0:
+			self._fetch_pool = WorkerPool(fetch_threads, 'pcachefs-fetch')
+
+		self.readahead = None
+		if readahead > 0:
+			self.readahead = Readahead(self.prefetch, block_size, readahead, readahead_threads)
 
 		# If this is set to True, the cacher will fail if any
 		# requests are made for data that does not exist in the cache
@@ -285,6 +712,107 @@ class Cacher:
 		if not os.path.exists(self.cachedir):
 			self._mkdir(self.cachedir)
 
+		if metadata is None:
+			metadata = FileMetadataStore(self.cachedir)
+		self.metadata = metadata
+
+		# Paths with data written locally which has not yet been written to
+		# underlying_fs. Anything left from before pCacheFS was last stopped
+		# is written back, even if write-back is now switched off.
+		self._dirty_paths = self.metadata.get_dirty_paths()
+		self._dirty_lock = threading.Lock()
+
+		if self.dedup and (write_back or len(self._dirty_paths) > 0):
+			raise ValueError('Write-back cannot be used with dedup or compression' +
+				('' if write_back else '; the cache holds data not yet written back, so mount it with write-back enabled first'))
+
+		self.write_back_enabled = write_back
+		self.writer = None
+		if write_back or len(self._dirty_paths) > 0:
+			self.writer = WriteBack(self, write_back_interval)
+			self.writer.start()
+
+		self.evictor = None
+		if max_cache_size > 0 or min_free_space > 0:
+			self.evictor = Evictor(self, max_cache_size, min_free_space)
+			self.evictor.start()
+
+	"""
+	# Stop readahead and eviction, write back any dirty data, stop every
+	# worker thread (including underlying_fs's, if it has a close() method)
+	# and write out any outstanding metadata.
+	"""
+	def close(self):
+		if self.readahead is not None:
+			self.readahead.shutdown()
+
+		if self.evictor is not None:
+			self.evictor.stop()
+
+		if self.writer is not None:
+			self.writer.stop()
+			self.writer.write_back_all()
+
+		if self._fetch_pool is not None:
+			self._fetch_pool.shutdown()
+
+		self.block_store.close()
+
+		close = getattr(self.underlying_fs, 'close', None)
+		if close is not None:
+			close()
+
+		self.metadata.close()
+
+	"""
+	# Return a dict of statistics about the cache, as reported by the
+	# .pcachefs.stats virtual file:
+	#
+	# getattr/readdir/read.hits and .misses count operations answered
+	#   entirely from the cache, and those which needed the origin
+	# read.bytes is the number of bytes returned by read(), of which
+	#   read.bytes_from_origin were not cached when they were asked for and
+	#   read.bytes_from_cache were
+	# origin.getattr/readdir/read/open are histograms of the time taken by
+	#   calls to underlying_fs (in whole blocks, for reads), and
+	#   origin.read_bytes the number of bytes those reads fetched
+	# read.not_admitted counts reads of files not admitted to the cache,
+	#   which were served straight from the origin
+	# prefetch.bytes is the number of bytes fetched ahead of being read
+	# fetch.coalesced_blocks counts blocks which were already being fetched
+	#   when another read or prefetch wanted them, and so were waited for
+	#   rather than fetched again
+	# write.bytes is the number of bytes written in write-back mode, and
+	#   write_back.bytes and write_back.writes the number of bytes and
+	#   writes it took to write them to the origin; origin.write is a
+	#   histogram of the time taken by those writes
+	#
+	# followed by the statistics of the stat cache, negative lookup cache,
+	# memory cache, admission policy, readahead, evictor, write-back and
+	# block store, where they are in use.
+	"""
+	def stats(self):
+		result = self.counters.values()
+		result['read.bytes_from_cache'] = result['read.bytes'] - result['read.bytes_from_origin']
+
+		components = [
+			('stat_cache', self.stat_cache),
+			('negative_cache', self.negative_cache),
+			('memory_cache', self.memory_cache),
+			('admission', self.admission),
+			('readahead', self.readahead),
+			('evictor', self.evictor),
+			('write_back', self.writer),
+			('block_store', self.block_store if self.dedup else None),
+		]
+
+		for (prefix, component) in components:
+			if component is not None:
+				for (k, v) in component.stats().items():
+					result[prefix + '.' + k] = v
+
+		return result
+
 	def cache_only_mode_enable(self):
 		debug('cacher cache_only_mode enabled')
 		self.cache_only_mode = True
@@ -293,108 +821,595 @@ class Cacher:
 		debug('cacher cache_only_mode disabled')
 		self.cache_only_mode = False
 
+	"""
+	# Open the given path, returning a CachedFile to be passed to read() and
+	# release(). Every open handle on the same path shares one CachedFile.
+	"""
+	def open(self, path, flags):
+		fh = self._acquire(path)
+		self._admit(fh)
+
+		if self.preallocate_hot > 0:
+			opens = self._open_counts.get(path, 0, count = False) + 1
+			self._open_counts.put(path, opens)
+
+			if opens == self.preallocate_hot:
+				self._preallocate(fh)
+
+		return fh
+
+	"""
+	# Release a CachedFile returned by open(). Once every handle on the path
+	# has been released, its cache.data and origin files are closed.
+	"""
+	def release(self, path, fh):
+		self._release(fh)
+		return 0 # success
+
+	"""
+	# Remove start..end of path from the cache, punching a hole in cache.data
+	# to free the disk space it used where possible. Returns the number of
+	# bytes of disk space freed, None if holes cannot be punched, or BUSY if
+	# the range holds data not yet written back.
+	"""
+	def discard(self, path, start, end):
+		fh = self._acquire(path)
+		try:
+			with self._path_locks.hold(path):
+				if fh.coverage.is_dirty(start, end):
+					return BUSY
+
+				return fh.discard(start, end)
+		finally:
+			self._release(fh)
+
+	"""
+	# Remove all cached data for path (but not its metadata), unless it is
+	# currently open or has data not yet written back. Returns the number of
+	# bytes of disk space freed, or BUSY if the file is open or dirty.
+	"""
+	def evict_file(self, path):
+		cache_data = self._get_cache_dir(path, 'cache.data')
+		cache_blocks = self._get_cache_dir(path, 'cache.blocks')
+
+		with self._path_locks.hold(path):
+			with self._open_files_lock:
+				if path in self._open_files:
+					return BUSY
+
+			if self.is_dirty(path):
+				return BUSY
+
+			try:
+				freed = os.stat(cache_data).st_blocks * 512
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+				freed = None
+
+			has_blocks = os.path.isdir(cache_blocks)
+			if freed is None and not has_blocks:
+				return 0
+
+			# remove the coverage map first, so that if we are interrupted
+			# nothing claims data is cached which is no longer there
+			self.metadata.remove_coverage(path)
+
+			if freed is None:
+				freed = 0
+			else:
+				os.remove(cache_data)
+
+			if has_blocks:
+				freed += self.block_store.remove_all(cache_blocks)
+
+			return freed
+
+	"""
+	# Forget everything cached for path because it has changed at the origin.
+	# If stat is given it becomes path's cached stat; otherwise the path is
+	# taken to no longer exist and its cached stat is removed too. If the
+	# file is open, its cache.data is emptied rather than removed.
+	"""
+	def invalidate(self, path, stat = None):
+		debug('cacher.invalidate', path)
+
+		self.stat_cache.invalidate(path)
+		if stat is None:
+			self.metadata.remove_stat(path)
+		else:
+			self.metadata.put_stat(path, stat)
+
+		with self._path_locks.hold(path):
+			with self._open_files_lock:
+				fh = self._open_files.get(path)
+
+			if fh is not None:
+				freed = fh.invalidate(stat or fh.stat)
+			else:
+				freed = self.evict_file(path)
+				if freed == BUSY:
+					freed = 0
+
+			# after cache.data, so that no read can put old blocks back
+			if self.memory_cache is not None:
+				self.memory_cache.invalidate(path)
+
+		if self.readahead is not None:
+			self.readahead.forget(path)
+
+		if self.evictor is not None:
+			self.evictor.forget(path, freed)
+
+	# Reserve disk space for the whole of a frequently opened file's cache.data
+	def _preallocate(self, fh):
+		with self._path_locks.hold(fh.path):
+			if not fh.has_data_file():
+				self._create_cache_dir(fh.path)
+				fh.create_data_file()
+
+			debug('preallocating', fh.path, fh.preallocate())
+
+	def _acquire(self, path):
+		with self._path_locks.hold(path):
+			with self._open_files_lock:
+				fh = self._open_files.get(path)
+
+			if fh is None:
+				# data cached with dedup switched the other way, or with a
+				# different block size, can't be used
+				if self.dedup:
+					stale = os.path.exists(self._get_cache_dir(path, 'cache.data')) or \
+						self.block_store.is_stale(self._get_cache_dir(path, 'cache.blocks'))
+				else:
+					stale = os.path.isdir(self._get_cache_dir(path, 'cache.blocks'))
+
+				if stale:
+					self.evict_file(path)
+
+				if self.dedup:
+					fh = BlockStoreCachedFile(path,
+						self._get_cache_dir(path, 'cache.blocks'),
+						self._open_coverage(path),
+						self.getattr(path),
+						lambda: self._open_underlying(path),
+						self.block_store)
+				else:
+					fh = CachedFile(path,
+						self._get_cache_dir(path, 'cache.data'),
+						self._open_coverage(path),
+						self.getattr(path),
+						lambda: self._open_underlying(path),
+						self.mmap_reads)
+
+				# files with data cached already were admitted before
+				fh.admitted = self.admission is None or fh.has_data_file() or len(fh.coverage.ranges) > 0
+
+				with self._open_files_lock:
+					self._open_files[path] = fh
+
+			with self._open_files_lock:
+				fh.refcount += 1
+
+		return fh
+
+	# Ask the admission policy whether to start caching a file which has not
+	# been admitted yet, as it is being opened
+	def _admit(self, fh):
+		if not fh.admitted and self.admission.admit(fh.path, fh.stat):
+			debug('cacher admitting', fh.path)
+			fh.admitted = True
+
+	def _release(self, fh):
+		with self._path_locks.hold(fh.path):
+			with self._open_files_lock:
+				fh.refcount -= 1
+				if fh.refcount > 0:
+					return
+
+				del self._open_files[fh.path]
+
+			fh.close()
+
 	"""
 	Read the given data from the given path on the filesystem.
 	
 	Any parts which are requested and are not in the cache are read
-	from the underlying filesystem
+	from the underlying filesystem.
+
+	fh is the CachedFile returned by open(); if it is not given, the file is
+	opened just for the duration of this read.
 	"""
-	def read(self, path, size, offset):
+	def read(self, path, size, offset, fh = None):
 		debug('cacher.read', path, str(size), str(offset))
-		cache_data = self._get_cache_dir(path, 'cache.data')
-		data_cache_range = self._get_cache_dir(path, 'cache.data.range')
-
-		# list of Range objects indicating which chunks of the requested data
-		# we have not yet cached and will need to get from the underlying fs
-		blocks_to_read = []
-
-		# Ranges object indicating which chunks of the file we have cached
-		cached_blocks = None
-		if os.path.exists(data_cache_range):
-			with __builtin__.open(data_cache_range, 'rb') as f:
-				debug('  loading cached_blocks from file')
-				cached_blocks = pickle.load(f)
+
+		if fh is None:
+			fh = self._acquire(path)
+			try:
+				self._admit(fh)
+				return self.read(path, size, offset, fh)
+			finally:
+				self._release(fh)
+
+		# Reads never extend beyond the end of the file
+		end = min(offset + size, fh.stat.st_size)
+		if offset >= end:
+			return ''
+
+		if not fh.admitted:
+			result = self._read_uncached(fh, offset, end)
+
+			self.counters.add('read.not_admitted')
+			self.counters.add('read.misses')
+			self.counters.add('read.bytes', len(result))
+			self.counters.add('read.bytes_from_origin', len(result))
+			return result
+
+		missing = 0
+		if not fh.is_cached(offset, end):
+			missing = sum([ e - s for (s, e) in fh.coverage.ranges.uncovered(offset, end) ])
+
+		# Make sure everything we've been asked for is in the cache. Data
+		# which is already cached is read without taking the path lock.
+		result = None
+		while result is None:
+			# the file may have shrunk since the last pass, if it was
+			# truncated or invalidated meanwhile, and the read stops at its
+			# new end
+			end = min(offset + size, fh.stat.st_size)
+			if offset >= end:
+				return ''
+
+			if not fh.is_cached(offset, end):
+				self._fill(fh, offset, end)
+
+			# Now we have loaded all the data we need to into the cache, we do the read
+			# from the cached file
+			result = self._read_cached(fh, offset, end)
+
+			# If part of what we read was discarded from the cache while we
+			# were reading it, it may have read back as zeroes; try again
+			if not fh.is_cached(offset, end):
+				result = None
+
+		if self.readahead is not None and not self.cache_only_mode:
+			self.readahead.record(path, offset, end, fh.stat.st_size)
+
+		if self.evictor is not None:
+			self.evictor.touch(path, offset, end)
+
+		self.counters.add('read.misses' if missing else 'read.hits')
+		self.counters.add('read.bytes', end - offset)
+		self.counters.add('read.bytes_from_origin', min(missing, end - offset))
+
+		debug('  returning result from cache', type(result), len(result))
+		return result
+
+	"""
+	# Read offset..end of the given CachedFile straight from underlying_fs,
+	# leaving the cache untouched, for files not admitted to the cache.
+	"""
+	def _read_uncached(self, fh, offset, end):
+		origin = fh.acquire_origin()
+		try:
+			started = time.time()
+			with self.tracer.span('origin.read', fh.path):
+				result = self.underlying_fs.read(fh.path, end - offset, offset, origin)
+
+			self.counters.record('origin.read', time.time() - started)
+			self.counters.add('origin.read_bytes', len(result))
+			return result
+		finally:
+			fh.release_origin(origin)
+
+	"""
+	# Read offset..end of the given CachedFile, which is in the cache. With a
+	# memory cache, each block is taken from memory if it is held there, and
+	# otherwise read whole from cache.data and offered to the memory cache.
+	"""
+	def _read_cached(self, fh, offset, end):
+		if self.memory_cache is None:
+			with self.tracer.span('cache.read', fh.path):
+				return fh.read(offset, end - offset)
+
+		bs = self.block_size
+		stat = fh.stat
+		parts = []
+
+		for index in xrange(offset // bs, (end - 1) // bs + 1):
+			block_start = index * bs
+			block_end = min(block_start + bs, stat.st_size)
+			start = max(offset, block_start)
+
+			block = self.memory_cache.get(fh.path, index)
+
+			if block is None and fh.is_cached(block_start, block_end):
+				with self.tracer.span('cache.read', fh.path):
+					block = fh.read(block_start, block_end - block_start)
+
+				# if the block was discarded, or the file invalidated, while
+				# it was being read, it may not be what is cached any more
+				if fh.stat is stat and fh.is_cached(block_start, block_end):
+					self.memory_cache.put(fh.path, index, block)
+
+			if block is None:
+				with self.tracer.span('cache.read', fh.path):
+					parts.append(fh.read(start, min(end, block_end) - start))
+			else:
+				parts.append(block[start - block_start:min(end, block_end) - block_start])
+
+		return ''.join(parts)
+
+	"""
+	# Fetch any parts of start..end of the given CachedFile that are not yet
+	# cached from the underlying filesystem and write them into cache.data.
+	#
+	# This is used both by FUSE threads and by readahead worker threads, so
+	# several may want the same blocks at once. Each block being fetched is
+	# recorded in self._in_flight, and a thread wanting a block which is
+	# already being fetched waits for that fetch rather than fetching it
+	# again. The path lock is only held while deciding what to fetch and
+	# while writing what arrives, so fetches of different blocks of the same
+	# file go ahead at the same time.
+	#
+	# Once this returns, start..end has been cached unless the file was
+	# invalidated or written to meanwhile, or a fetch waited for failed;
+	# callers check and try again.
+	#
+	# Returns the number of bytes fetched from the underlying filesystem.
+	"""
+	def _fill(self, fh, start, end):
+		path = fh.path
+
+		with self.tracer.span('cacher.fill', path):
+			with self._path_locks.hold(path):
+				requested_range = Range(start, end)
+
+				debug('   requested_range', requested_range)
+				debug('   cached_blocks', fh.coverage.ranges)
+
+				# list of Range objects indicating which chunks of the requested data
+				# we have not yet cached and will need to get from the underlying fs
+				stat = fh.stat
+				with self.tracer.span('cacher.find_gaps', path):
+					blocks_to_read = self._align_to_blocks(
+						fh.coverage.ranges.get_uncovered_portions(requested_range), stat.st_size)
+
+				# Another thread may have fetched the data while we waited for the lock
+				if len(blocks_to_read) == 0:
+					return 0
+
+				(blocks_to_read, flight, others) = self._claim_blocks(path, blocks_to_read)
+				debug('   blocks_to_read', blocks_to_read)
+
+				# First, create the cache file if it does not exist already
+				if len(blocks_to_read) > 0 and not fh.has_data_file():
+					self._create_cache_dir(path)
+					fh.create_data_file()
+
+			try:
+				fetched = self._fetch_blocks(fh, blocks_to_read, stat)
+			finally:
+				self._finish_blocks(path, blocks_to_read, flight)
+
+			if len(others) > 0:
+				self.counters.add('fetch.coalesced_blocks', len(others))
+				with self.tracer.span('cacher.wait_in_flight', path):
+					for other in set(others):
+						other.wait()
+
+			if self.evictor is not None:
+				for (block, nbytes) in fetched:
+					self.evictor.added(path, block.start, block.end, nbytes)
+
+			return sum([ block.size for (block, nbytes) in fetched ])
+
+	"""
+	# Claim the blocks making up the given Ranges of path for fetching by
+	# this thread, except those which another thread is already fetching.
+	# Returns a list of the Ranges claimed, an Event to be set once they have
+	# been fetched (by _finish_blocks()), and a list of the Events of the
+	# fetches of the blocks not claimed, one per block.
+	"""
+	def _claim_blocks(self, path, ranges):
+		bs = self.block_size
+		flight = threading.Event()
+		claimed = []
+		others = []
+
+		with self._in_flight_lock:
+			for r in ranges:
+				for i in xrange(r.start // bs, -(-r.end // bs)):
+					other = self._in_flight.get((path, i))
+					if other is not None:
+						others.append(other)
+						continue
+
+					self._in_flight[(path, i)] = flight
+
+					block = Range(i * bs, min((i + 1) * bs, r.end))
+					if len(claimed) > 0 and claimed[-1].end == block.start:
+						claimed[-1] = Range(claimed[-1].start, block.end)
+					else:
+						claimed.append(block)
+
+		return (claimed, flight, others)
+
+	# Release blocks claimed by _claim_blocks() and wake anyone waiting for them
+	def _finish_blocks(self, path, ranges, flight):
+		bs = self.block_size
+
+		with self._in_flight_lock:
+			for r in ranges:
+				for i in xrange(r.start // bs, -(-r.end // bs)):
+					del self._in_flight[(path, i)]
+
+		flight.set()
+
+	"""
+	# Fetch the given Ranges of a file from the underlying filesystem into
+	# cache.data and add them to its coverage map. If there is more than
+	# one, they are fetched concurrently on the fetch pool and each written
+	# into cache.data as soon as it arrives.
+	#
+	# Anything arriving once the file's stat is no longer stat (because it
+	# has been invalidated, or written to in write-back mode) is dropped.
+	#
+	# Returns a list of (Range, bytes of disk space used) tuples for the
+	# Ranges which were cached, with None where the space used is not known.
+	"""
+	def _fetch_blocks(self, fh, blocks, stat):
+		if self._fetch_pool is None or len(blocks) < 2:
+			results = [ (block, self._fetch_block(fh, block, stat)) for block in blocks ]
+
 		else:
-			cached_blocks = Ranges()
+			tasks = [ (block, self._fetch_pool.submit(self._fetch_block, fh, block, stat)) for block in blocks ]
+
+			# wait for every fetch, even if one fails, so none is still
+			# writing into cache.data once the blocks are released
+			results = []
+			error = None
+			for (block, task) in tasks:
+				try:
+					results.append((block, task.result()))
+				except Exception:
+					if error is None:
+						error = sys.exc_info()
+
+			if error is not None:
+				raise error[0], error[1], error[2]
+
+		return [ (block, nbytes) for (block, (cached, nbytes)) in results if cached ]
+
+	# Fetch block into cache.data, returning a (cached, bytes of disk space
+	# used) tuple
+	def _fetch_block(self, fh, block, stat):
+		path = fh.path
+
+		with self._path_locks.hold(path):
+			if fh.stat is not stat:
+				return (False, 0)
+
+			if fh.fill_locally(block.start, block.end):
+				self._commit_block(fh, block)
+				return (True, 0)
+
+		origin = fh.acquire_origin()
+		try:
+			started = time.time()
+			with self.tracer.span('origin.read', path):
+				block_data = self.underlying_fs.read(path, block.size, block.start, origin)
 
-		requested_range = Range(offset, offset+size)
-		
-		debug('   read', 'path=' + path, 'size=' + str(size), 'offset=' + str(offset))
-		debug('   requested_range', requested_range)
-		debug('   cached_blocks', cached_blocks)
+			self.counters.record('origin.read', time.time() - started)
+			self.counters.add('origin.read_bytes', len(block_data))
+		finally:
+			fh.release_origin(origin)
 
-		blocks_to_read = cached_blocks.get_uncovered_portions(requested_range)
+		with self._path_locks.hold(path):
+			if fh.stat is not stat:
+				return (False, 0)
 
-		debug('   blocks_to_read', blocks_to_read)
+			with self.tracer.span('cache.write', path):
+				allocated = fh.write(block.start, block_data) # overwrites existing data in the file
 
-		# First, create the cache file if it does not exist already
-		if not os.path.exists(cache_data):
-			# We create a file full of zeroes the same size as the real file
-			file_stat = self.getattr(path)
-			self._create_cache_dir(path)
+			self._commit_block(fh, block)
+			return (True, allocated)
 
-			with __builtin__.open(cache_data, 'wb') as f:
-				debug('  creating blank file, size', str(file_stat.st_size))
-				f.seek(file_stat.st_size - 1)
-				f.write('\0')
+	# Record that block has been written into cache.data. Callers must hold
+	# the path lock.
+	def _commit_block(self, fh, block):
+		# cache.data must reach the disk before the coverage map that says
+		# it is there
+		with self.tracer.span('cache.flush', fh.path):
+			fh.flush()
 
-				#for i in range(1, file_stat.st_size):
-				#	f.write('\0')
+		fh.coverage.add(block.start, block.end)
+		with self.tracer.span('metadata.flush_coverage', fh.path):
+			fh.coverage.flush()
 
-		# If there are no blocks_to_read, then don't bother opening
-		# the cache_data file for updates or dumping our cached_blocks.
-		# This will slightly improve performance when getting data which
-		# is already in the cache.
-		if len(blocks_to_read) > 0:
+	"""
+	# Bring start..end of path into the cache without reading it back, as
+	# done by readahead worker threads and pcachefs-warm. The file is cached
+	# whatever the admission policy would say. Returns the number of bytes
+	# fetched from the underlying filesystem.
+	"""
+	def prefetch(self, path, start, end):
+		fh = self._acquire(path)
+		try:
+			fh.admitted = True
+			end = min(end, fh.stat.st_size)
+			if start >= end or fh.is_cached(start, end):
+				return 0
 
-			# Now open it up in update mode so we can add data to it as
-			# we read the data from the underlying filesystem
-			with __builtin__.open(cache_data, 'r+b') as cache_data_file:
+			fetched = self._fill(fh, start, end)
+			self.counters.add('prefetch.bytes', fetched)
+			return fetched
+		finally:
+			self._release(fh)
 
-				# Now loop through all the blocks we need to get 
-				# and append them to the cached file as we go
-				for block in blocks_to_read:
-					block_data = self.underlying_fs.read(path, block.size, block.start)
-					
-					cached_blocks.add_range(block)
+	"""
+	# Round each of the given Ranges out to whole blocks of self.block_size
+	# (never going beyond file_size), merging any that end up adjacent, so
+	# that the underlying filesystem is asked for a few large aligned reads
+	# rather than many small ones. Ranges lying wholly beyond file_size
+	# (which has shrunk since they were found) are dropped.
+	"""
+	def _align_to_blocks(self, ranges, file_size):
+		bs = self.block_size
+		result = []
 
-					cache_data_file.seek(block.start)
-					cache_data_file.write(block_data) # overwrites existing data in the file
+		for r in ranges:
+			start = (r.start // bs) * bs
+			end = min(-(-r.end // bs) * bs, file_size)
 
-			# update our cached_blocks file
-			with __builtin__.open(data_cache_range, 'wb') as f:
-				pickle.dump(cached_blocks, f)
+			# all of the range is beyond the end of the file
+			if start >= end:
+				continue
 
-		# Now we have loaded all the data we need to into the cache, we do the read
-		# from the cached file
-		result = None
-		with __builtin__.open(cache_data, 'rb') as f:
-			f.seek(offset)
-			result = f.read(size)
+			if len(result) > 0 and result[-1].end >= start:
+				result[-1] = Range(result[-1].start, max(result[-1].end, end))
+			else:
+				result.append(Range(start, end))
 
-		debug('  returning result from cache', type(result), len(result))
 		return result
 
 	"""
 	List the given directory, from the cache
 	"""
 	def readdir(self, path, offset):
-		cache_dir = self._get_cache_dir(path, 'cache.list')
+		with self.tracer.span('metadata.get_listing', path):
+			entry = self.metadata.get_listing(path)
 
-		result = None
-		if os.path.exists(cache_dir):
+		if entry is not None and not self._expired(entry[1], self.listing_ttl):
 			debug('cacher.readdir getting from cache', path)
-			with __builtin__.open(cache_dir, 'rb') as list_cache_file:
-				result = pickle.load(list_cache_file)
+			result = entry[0]
+			self.counters.add('readdir.hits')
 
 		else:
 			debug('cacher.readdir asking ufs for listing', path)
-			result_generator = self.underlying_fs.readdir(path, offset)
-			result = list(result_generator)
+			self.counters.add('readdir.misses')
+			readdirplus = getattr(self.underlying_fs, 'readdirplus', None)
 
-			self._create_cache_dir(path)
-			with __builtin__.open(cache_dir, 'wb') as list_cache_file:
-				pickle.dump(result, list_cache_file)
+			started = time.time()
+			if self.readdir_stats and readdirplus is not None:
+				with self.tracer.span('origin.readdirplus', path):
+					(result, stats) = readdirplus(path)
+				self.counters.record('origin.readdir', time.time() - started)
+
+				with self.tracer.span('metadata.put_stats', path):
+					self._put_listed_stats(stats)
+
+			else:
+				with self.tracer.span('origin.readdir', path):
+					result_generator = self.underlying_fs.readdir(path, offset)
+					result = list(result_generator)
+				self.counters.record('origin.readdir', time.time() - started)
+
+			with self.tracer.span('metadata.put_listing', path):
+				self.metadata.put_listing(path, result)
+
+			for e in result:
+				self.negative_cache.invalidate(os.path.join(path, e.name))
 
 		# Return a new generator over our list of items
 		return (x for x in result)
@@ -403,26 +1418,428 @@ class Cacher:
 	Retrieve stat information for a particular file from the cache
 	"""
 	def getattr(self, path):
-		cache_dir = self._get_cache_dir(path, 'cache.stat')
+		entry = self.stat_cache.get(path)
 
-		result = None
-		if os.path.exists(cache_dir):
-			with __builtin__.open(cache_dir, 'rb') as stat_cache_file:
-				result = pickle.load(stat_cache_file)
+		if entry is None:
+			with self.tracer.span('metadata.get_stat', path):
+				entry = self.metadata.get_stat(path)
+
+			if entry is not None:
 				debug('cacher.getattr', 'fetching from cache', path)
+				self.counters.add('getattr.hits')
+
+			else:
+				self._check_missing(path)
+
+				self.counters.add('getattr.misses')
+				entry = (self._getattr_underlying(path), time.time())
+				debug('cacher.getattr getting from filesystem', path)
+
+				with self.tracer.span('metadata.put_stat', path):
+					self.metadata.put_stat(path, entry[0])
+
+			self.stat_cache.put(path, entry)
 
 		else:
-			result = self.underlying_fs.getattr(path)
-			debug('cacher.getattr getting from filesystem', path)
+			self.counters.add('getattr.hits')
 
-			self._create_cache_dir(path)
-			with __builtin__.open(cache_dir, 'wb') as stat_cache_file:
-				pickle.dump(result, stat_cache_file)
+		if self._expired(entry[1], self.attr_ttl):
+			self.counters.add('getattr.revalidations')
+			entry = self._revalidate(path, entry[0])
+			self.stat_cache.put(path, entry)
+
+		return entry[0]
+
+	"""
+	# Check a cached stat result which has outlived attr_ttl against
+	# underlying_fs, discarding path's cached data if the file has changed.
+	# Returns a new (FuseStat, time stored) tuple.
+	"""
+	def _revalidate(self, path, stat):
+		now = time.time()
+
+		# with no origin to check against, stale results are better than none;
+		# and until a file's changes are written back, ours are the latest
+		if self.cache_only_mode or self.is_dirty(path):
+			return (stat, now)
+
+		try:
+			current = self._getattr_underlying(path)
+		except OSError, e:
+			if e.errno == errno.ENOENT:
+				self.invalidate(path)
+			raise
+
+		if self._changed(stat, current):
+			debug('cacher.getattr', path, 'has changed, invalidating')
+			self.invalidate(path, current)
+			return (current, now)
+
+		self.metadata.touch_stat(path)
+		return (stat, now)
+
+	"""
+	# Cache stat results returned by underlying_fs.readdirplus(), as a
+	# batch. Files which have changed since their stat was cached have
+	# their cached data invalidated, as if revalidated by getattr().
+	"""
+	def _put_listed_stats(self, stats):
+		now = time.time()
+		new = []
+
+		for (path, stat) in stats:
+			# the origin's stat of a file with changes not yet written back
+			# is out of date
+			if self.is_dirty(path):
+				continue
+
+			entry = self.stat_cache.get(path, count = False)
+			if entry is None:
+				entry = self.metadata.get_stat(path)
+
+			if entry is None:
+				new.append((path, stat))
+			elif self._changed(entry[0], stat):
+				self.invalidate(path, stat)
+				continue
+			elif not self._expired(entry[1], self.attr_ttl):
+				continue
+			else:
+				self.metadata.touch_stat(path)
+
+			self.stat_cache.put(path, (stat, now))
+
+		self.metadata.put_stats(new)
+
+	# Returns True if the file described by stat differs from when old was taken
+	def _changed(self, old, stat):
+		return (stat.st_size, stat.st_mtime, stat.st_ino) != (old.st_size, old.st_mtime, old.st_ino)
+
+	"""
+	# Raise ENOENT if path is known not to exist, either because looking it
+	# up recently failed or because it is missing from its parent's cached
+	# listing.
+	"""
+	def _check_missing(self, path):
+		if not self.negative_ttl:
+			return
+
+		if self.negative_cache.get(path) is None:
+			(parent, name) = os.path.split(path)
+			if name == '':
+				return
+
+			entry = self.metadata.get_listing(parent)
+			if entry is None or self._expired(entry[1], self.listing_ttl):
+				return
+
+			if name in [ e.name for e in entry[0] ]:
+				return
+
+			self.negative_cache.put(path, True)
+
+		debug('cacher.getattr', path, 'is known not to exist')
+		self.counters.add('getattr.negative_hits')
+		raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+	# getattr() on underlying_fs, remembering paths which do not exist
+	def _getattr_underlying(self, path):
+		started = time.time()
+		try:
+			with self.tracer.span('origin.getattr', path):
+				return self.underlying_fs.getattr(path)
+		except OSError, e:
+			if e.errno == errno.ENOENT:
+				self.negative_cache.put(path, True)
+			raise
+		finally:
+			self.counters.record('origin.getattr', time.time() - started)
+
+	# Open path on underlying_fs, for a CachedFile
+	def _open_underlying(self, path):
+		started = time.time()
+		try:
+			with self.tracer.span('origin.open', path):
+				return self.underlying_fs.open(path)
+		finally:
+			self.counters.record('origin.open', time.time() - started)
+
+	# Returns True if something stored at cached_at has outlived ttl
+	def _expired(self, cached_at, ttl):
+		return bool(ttl) and time.time() - cached_at > ttl
+
+	"""
+	# Write buf at offset in path, in write-back mode. The data is written to
+	# cache.data and marked dirty in the coverage map, to be written to
+	# underlying_fs later by write_back(), and the file's cached stat is
+	# updated to match. Returns the number of bytes written.
+	#
+	# fh is the CachedFile returned by open(); if it is not given, the file is
+	# opened just for the duration of this write.
+	"""
+	def write(self, path, buf, offset, fh = None):
+		if not self.write_back_enabled:
+			return -errno.ENOSYS
+
+		if fh is None:
+			fh = self._acquire(path)
+			try:
+				return self.write(path, buf, offset, fh)
+			finally:
+				self._release(fh)
+
+		end = offset + len(buf)
+		fh.admitted = True
+
+		with self.tracer.span('cacher.write', path):
+			written = False
+			while not written:
+				for (start, stop) in self._partial_blocks(fh.stat.st_size, offset, end):
+					self._fill(fh, start, stop)
+
+				with self._path_locks.hold(path):
+					written = self._write_locally(fh, buf, offset)
+
+		self.counters.add('write.bytes', len(buf))
+		return len(buf)
+
+	"""
+	# Return the parts of the blocks which offset..end covers only partly
+	# which lie outside it but within a file of the given size, as a list of
+	# (start, end) tuples.
+	#
+	# Reads fetch whole blocks, so any block holding dirty data must be
+	# cached in full, or a fetch of the rest of it would overwrite the
+	# dirty data. These parts must be cached before offset..end is written.
+	"""
+	def _partial_blocks(self, size, offset, end):
+		bs = self.block_size
+		head = (offset // bs) * bs
+		tail = min(-(-end // bs) * bs, size)
+
+		result = []
+		if head < min(offset, size):
+			result.append((head, min(offset, size)))
+		if end < tail:
+			result.append((end, tail))
 
 		return result
 
-	def write(self, path, buf, offset):
-		return -errno.ENOSYS
+	# Write buf at offset into the given CachedFile and mark it dirty,
+	# returning False (having written nothing) if the partly covered blocks
+	# around it are not all cached. Callers must hold the path lock.
+	def _write_locally(self, fh, buf, offset):
+		path = fh.path
+		size = fh.stat.st_size
+		end = offset + len(buf)
+
+		for (start, stop) in self._partial_blocks(size, offset, end):
+			if not fh.is_cached(start, stop):
+				return False
+
+		if not fh.has_data_file():
+			self._create_cache_dir(path)
+			fh.create_data_file()
+
+		with self.tracer.span('cache.write', path):
+			fh.write(offset, buf)
+
+		# anything skipped over by writing beyond the end reads as zeroes
+		if offset > size:
+			fh.coverage.mark_dirty(size, offset)
+		fh.coverage.mark_dirty(offset, end)
+
+		with self.tracer.span('cache.flush', path):
+			fh.flush()
+		with self.tracer.span('metadata.flush_coverage', path):
+			fh.coverage.flush()
+
+		self._set_local_stat(fh, max(size, end))
+		self._set_dirty(path, True)
+
+		if self.evictor is not None:
+			self.evictor.added(path, offset, end, max(0, end - max(size, offset)))
+
+		return True
+
+
+	"""
+	# Truncate or extend path to size bytes, in write-back mode. As with
+	# write(), underlying_fs is only changed by write_back().
+	"""
+	def truncate(self, path, size, fh = None):
+		if not self.write_back_enabled:
+			return -errno.ENOSYS
+
+		if fh is None:
+			fh = self._acquire(path)
+			try:
+				return self.truncate(path, size, fh)
+			finally:
+				self._release(fh)
+
+		fh.admitted = True
+
+		with self.tracer.span('cacher.truncate', path), self._path_locks.hold(path):
+			old_size = fh.stat.st_size
+
+			if size < old_size:
+				fh.coverage.remove(size, old_size)
+				fh.coverage.mark_clean(size, old_size)
+			elif size > old_size:
+				fh.coverage.mark_dirty(old_size, size)
+
+			fh.truncate(size)
+			fh.coverage.flush()
+
+			self._set_local_stat(fh, size)
+			self._set_dirty(path, True)
+
+		return 0 # success
+
+	"""
+	# Make sure everything written to path so far would survive pCacheFS
+	# stopping, as done when a file is closed. Dirty data is written to
+	# underlying_fs later as usual.
+	"""
+	def flush(self, path, fh):
+		fh.flush()
+
+		if self.is_dirty(path):
+			with self._path_locks.hold(path):
+				fh.coverage.flush()
+			self.metadata.flush()
+
+		return 0 # success
+
+	"""
+	# Write everything written to path so far to underlying_fs straight
+	# away, and make sure it has reached the disk there.
+	"""
+	def fsync(self, path, fh):
+		self.flush(path, fh)
+
+		if self.is_dirty(path):
+			self.write_back(path, sync = True)
+
+		return 0 # success
+
+	""" Returns True if path has data which has not been written back. """
+	def is_dirty(self, path):
+		return path in self._dirty_paths
+
+	""" Return a list of the paths with data which has not been written back. """
+	def dirty_paths(self):
+		with self._dirty_lock:
+			return list(self._dirty_paths)
+
+	"""
+	# Write the data written to path and not yet to underlying_fs there,
+	# along with any change in its size, and mark it clean. Adjacent dirty
+	# ranges go in a single write of up to MAX_WRITE_BACK bytes, however many
+	# writes they were made up of. If sync is True, the file is then fsync'd
+	# on underlying_fs. Returns the number of bytes written.
+	#
+	# The path lock is held for each write to underlying_fs but not between
+	# them, so reads and writes of the file carry on while it is written back.
+	"""
+	def write_back(self, path, sync = False):
+		fh = self._acquire(path)
+		try:
+			with self.tracer.span('cacher.write_back', path):
+				origin = self.underlying_fs.open_writable(path)
+				try:
+					written = self._write_back(fh, origin)
+
+					if sync:
+						with self.tracer.span('origin.fsync', path):
+							self.underlying_fs.fsync(path, origin)
+				finally:
+					origin.close()
+
+			return written
+		finally:
+			self._release(fh)
+
+	def _write_back(self, fh, origin):
+		path = fh.path
+		origin_size = self._getattr_underlying(path).st_size
+		written = 0
+
+		while True:
+			with self._path_locks.hold(path):
+				size = fh.stat.st_size
+				if size != origin_size:
+					with self.tracer.span('origin.truncate', path):
+						self.underlying_fs.truncate(path, size, origin)
+					origin_size = size
+
+				dirty = fh.coverage.dirty
+				if len(dirty) == 0:
+					self._set_dirty(path, False)
+					break
+
+				start = dirty.start
+				end = min(next(dirty.pairs())[1], start + self.MAX_WRITE_BACK)
+
+				with self.tracer.span('cache.read', path):
+					data = fh.read(start, end - start)
+
+				started = time.time()
+				with self.tracer.span('origin.write', path):
+					self.underlying_fs.write(path, data, start, origin)
+				self.counters.record('origin.write', time.time() - started)
+
+				fh.coverage.mark_clean(start, end)
+				fh.coverage.flush()
+
+				written += len(data)
+				self.counters.add('write_back.bytes', len(data))
+				self.counters.add('write_back.writes')
+
+		# take the origin's stat, so that it is not taken to have changed
+		# since it was cached
+		current = self._getattr_underlying(path)
+		with self._path_locks.hold(path):
+			if not self.is_dirty(path) and current.st_size == fh.stat.st_size:
+				fh.stat = current
+				self.metadata.put_stat(path, current)
+				self.stat_cache.put(path, (current, time.time()))
+
+		return written
+
+	# Replace fh's stat with a copy giving the file size bytes, modified now
+	def _set_local_stat(self, fh, size):
+		stat = copy.copy(fh.stat)
+		stat.st_size = size
+		stat.st_mtime = stat.st_ctime = int(time.time())
+
+		fh.stat = stat
+		self.metadata.put_stat(fh.path, stat)
+		self.stat_cache.put(fh.path, (stat, time.time()))
+
+		# after fh.stat, so that no read can put old blocks back
+		if self.memory_cache is not None:
+			self.memory_cache.invalidate(fh.path)
+
+	def _set_dirty(self, path, dirty):
+		with self._dirty_lock:
+			if (path in self._dirty_paths) == dirty:
+				return
+
+			if dirty:
+				self._dirty_paths.add(path)
+			else:
+				self._dirty_paths.remove(path)
+
+			self.metadata.set_dirty(path, dirty)
+
+	"""
+	# Load the CoverageMap for the given path
+	"""
+	def _open_coverage(self, path):
+		with self.tracer.span('metadata.open_coverage', path):
+			return self.metadata.open_coverage(path)
 
 	"""
 	# For a given path, return the name of the directory used to cache data for that path
@@ -449,7 +1866,12 @@ class Cacher:
 	def _mkdir(self, path):
 		debug('mkdir, os: ' + str(type(os)))
 		if not os.path.exists(path):
-			os.makedirs(path)
+			try:
+				os.makedirs(path)
+			except OSError, e:
+				# another thread may have created it in the meantime
+				if e.errno != errno.EEXIST:
+					raise
 
 if __name__ == '__main__':
 	usage="""
@@ -16,3 +16,25 @@ E_READ_ONLY = -errno.EROFS
 E_NOT_IMPL= -errno.ENOSYS
 E_INVALID_ARG = -errno.EINVAL
 
+
+# Multipliers for the suffixes accepted by parse_size()
+SIZE_SUFFIXES = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 }
+
+"""
+Parse a size given on the command line, such as '4096', '128K' or '1M', and
+return it as a number of bytes.
+"""
+def parse_size(s):
+	s = str(s).strip().upper()
+	if s.endswith('B'):
+		s = s[:-1]
+
+	multiplier = 1
+	if s[-1:] in SIZE_SUFFIXES:
+		multiplier = SIZE_SUFFIXES[s[-1]]
+		s = s[:-1]
+
+	try:
+		return int(float(s) * multiplier)
+	except ValueError:
+		raise ValueError('Invalid size: ' + str(s))
@@ -19,10 +19,20 @@
 
 """
 
+from array import array
+from bisect import (bisect_left, bisect_right)
+
+# Typecode used for the arrays backing Ranges. We need 64-bit offsets for
+# large files; where a C long is only 32 bits wide fall back to doubles,
+# which represent integers exactly up to 2^53.
+_TYPECODE = 'l' if array('l').itemsize >= 8 else 'd'
+
 """
 # Represents a range of integers (i.e. a start and an end)
 """
 class Range(object):
+	__slots__ = ('start', 'end', 'size')
+
 	def __init__(self, start, end):
 		if start >= end:
 			raise ValueError('start (' + str(start) + ') must be smaller than end (' + str(end) + ')')
@@ -46,6 +56,18 @@ class Range(object):
 				return cmp(self.end, other)
 			return cmp(self.start, other)
 
+	# Range objects pickled by older versions of pCacheFS carry a
+	# __dict__, so accept either form of state
+	def __getstate__(self):
+		return (self.start, self.end)
+
+	def __setstate__(self, state):
+		if isinstance(state, dict):
+			state = (state['start'], state['end'])
+
+		self.start, self.end = state
+		self.size = self.end - self.start
+
 	def contains(self, i):
 		if type(i) == Range:
 			return i.start >= self.start and i.end <= self.end
@@ -55,8 +77,8 @@ class Range(object):
 """
 # A group of ranges.
 # 
-# This class is a list with special awareness of Range objects. It will
-# re-jig its contents as new Ranges are added to ensure that Ranges never
+# This class behaves like a list with special awareness of Range objects. It
+# will re-jig its contents as new Ranges are added to ensure that Ranges never
 # overlap and are in order.
 #
 # For example:
@@ -88,50 +110,138 @@ class Range(object):
 #   # ranges = (0,16)
 #   # (1,3) is already included in our range so it is effectively ignored
 #
+# Internally the ranges are held as two sorted arrays of start and end
+# points rather than as one Range object per interval, so lookups and
+# inserts are a binary search away and fragmented files stay compact in
+# memory. Range objects are only created when asked for.
 """
 class Ranges(object):
-	def __init__(self):
-		self.ranges = []
+	__slots__ = ('_starts', '_ends')
 
-		# start and end of the entire range (ie the start point of the 
-		# starting range to the end point of the finishing range)
-		self.start = 0
-		self.end = 0
+	def __init__(self):
+		self._starts = array(_TYPECODE)
+		self._ends = array(_TYPECODE)
 
 	def __repr__(self):
 		return str(self.ranges)
 
-	def _cleanup(self):
-		old_ranges = list(self.ranges)
-		old_ranges.sort()
+	def __len__(self):
+		return len(self._starts)
 
-		i = 0
-		while i < (len(old_ranges)-1):
-			# get the next item, compare it with the item that follows it
-			item = old_ranges[i]
-			next_item = old_ranges[i+1]
+	def __iter__(self):
+		for (start, end) in self.pairs():
+			yield Range(start, end)
 
-			if item.end >= next_item.start:
-				old_ranges.pop(i)
-				old_ranges.pop(i) # effectively this removes item at i+1
+	"""
+	# Build a Ranges from parallel sequences of start and end points, which
+	# must already be sorted, non-overlapping and non-touching (as produced
+	# by pairs()).
+	"""
+	@classmethod
+	def from_sorted(cls, starts, ends):
+		result = cls()
+		result._starts.extend(starts)
+		result._ends.extend(ends)
+		return result
+
+	""" Return a new Ranges holding the same ranges as this one. """
+	def copy(self):
+		return Ranges.from_sorted(self._starts, self._ends)
+
+	""" Generator over (start, end) tuples of the ranges in this Ranges. """
+	def pairs(self):
+		for i in xrange(len(self._starts)):
+			yield (int(self._starts[i]), int(self._ends[i]))
+
+	# Ranges pickled by older versions of pCacheFS were a plain object
+	# holding a list of Range objects; accept either form of state
+	def __getstate__(self):
+		return (list(self._starts), list(self._ends))
+
+	def __setstate__(self, state):
+		self._starts = array(_TYPECODE)
+		self._ends = array(_TYPECODE)
+
+		if isinstance(state, dict):
+			for r in state['ranges']:
+				self.add_range(r)
+		else:
+			self._starts.extend(state[0])
+			self._ends.extend(state[1])
+
+	""" List of Range objects making up this Ranges, in order. """
+	@property
+	def ranges(self):
+		return list(self)
+
+	# start and end of the entire range (ie the start point of the 
+	# starting range to the end point of the finishing range)
+	@property
+	def start(self):
+		if len(self._starts) == 0:
+			return 0
+		return int(self._starts[0])
+
+	@property
+	def end(self):
+		if len(self._ends) == 0:
+			return 0
+		return int(self._ends[-1])
+
+	""" Total number of integers covered by all ranges in this Ranges. """
+	def total(self):
+		return int(sum(self._ends) - sum(self._starts))
 
-				new_range = Range(item.start, max(item.end, next_item.end))
-				old_ranges.append(new_range)
-				old_ranges.sort()
+	def add_range(self, range):
+		self.add(range.start, range.end)
 
-			else:
-				# only move to the next item of the list if we didn't modify
-				# the current item
-				i += 1
+	"""
+	# Add the range start..end, merging it with any ranges it overlaps or
+	# touches.
+	"""
+	def add(self, start, end):
+		starts = self._starts
+		ends = self._ends
 
-		self.ranges = old_ranges
+		# ranges lo..hi-1 overlap or touch start..end
+		lo = bisect_left(ends, start)
+		hi = bisect_right(starts, end)
 
-		self.start = self.ranges[0].start
-		self.end = self.ranges[-1].end
+		if lo < hi:
+			start = min(start, starts[lo])
+			end = max(end, ends[hi-1])
 
-	def add_range(self, range):
-		self.ranges.append(range)
-		self._cleanup()
+		starts[lo:hi] = array(_TYPECODE, [ start ])
+		ends[lo:hi] = array(_TYPECODE, [ end ])
+
+	"""
+	# Remove start..end from this Ranges, trimming or splitting any ranges
+	# which partly overlap it.
+	"""
+	def remove(self, start, end):
+		starts = self._starts
+		ends = self._ends
+
+		# ranges lo..hi-1 overlap start..end
+		lo = bisect_right(ends, start)
+		hi = bisect_left(starts, end)
+
+		if lo >= hi:
+			return
+
+		remainder_starts = array(_TYPECODE)
+		remainder_ends = array(_TYPECODE)
+
+		if starts[lo] < start:
+			remainder_starts.append(starts[lo])
+			remainder_ends.append(start)
+
+		if ends[hi-1] > end:
+			remainder_starts.append(end)
+			remainder_ends.append(ends[hi-1])
+
+		starts[lo:hi] = remainder_starts
+		ends[lo:hi] = remainder_ends
 
 	"""
 	# Determines if i is contained within this list of ranges.
@@ -145,11 +255,21 @@ class Ranges(object):
 	#
 	"""
 	def contains(self, i):
-		for r in self.ranges:
-			if r.contains(i):
-				return True
+		if type(i) == Range:
+			return self.covers(i.start, i.end)
 
-		return False
+		idx = bisect_right(self._starts, i) - 1
+		return idx >= 0 and i <= self._ends[idx]
+
+	""" Returns True if start..end lies entirely within a single range. """
+	def covers(self, start, end):
+		idx = bisect_right(self._starts, start) - 1
+		return idx >= 0 and end <= self._ends[idx]
+
+	""" Returns True if any part of start..end lies within one of the ranges. """
+	def overlaps(self, start, end):
+		i = bisect_right(self._ends, start)
+		return i < len(self._starts) and self._starts[i] < end
 
 	"""
 	# Determine which parts of range are not covered by ranges within this Ranges object.
@@ -160,85 +280,34 @@ class Ranges(object):
 	# and I call:
 	#  get_uncovered_portions(Range(2, 13))
 	#
-	# I get back a new Ranges object:
-	#  (3,4) (10,12)
+	# I get back a list of Range objects:
+	#  (3,5) (10,12)
 	#
 	"""
 	def get_uncovered_portions(self, range):
+		return [ Range(s, e) for (s, e) in self.uncovered(range.start, range.end) ]
+
+	"""
+	# Same as get_uncovered_portions(), but takes start and end points and
+	# returns a list of (start, end) tuples.
+	"""
+	def uncovered(self, start, end):
+		starts = self._starts
+		ends = self._ends
 		portions = []
 
-		# if we have no ranges added then none of the given range will be covered
-		if len(self.ranges) == 0:
-			return [ range ]
-
-		# if the search range doesn't overlap any items in this range this nothing
-		# in this range will cover any of the search range
-		if range.end <= self.start or range.start >= self.end:
-			return [ range ]
-		
-		search_range = Range(range.start, range.end)
-		i = 0
-		while i < len(self.ranges):
-			item = self.ranges[i]
-			
-			if item.contains(search_range):
-				# if search_range is entirely contained, exit loop (return empty list)
-				break
-
-			elif not item.contains(search_range.start):
-				# if search_range.start doesn't fall within this item, either
-				# search_range begins before item.start, or after item.end
-
-				if search_range.start < item.start:
-
-					if search_range.end < item.start:
-						# if search_range ends before this item (ie never overlaps)
-						# then add a portion representing the entire search_range and
-						# exit the loop, since we've now gone as far as the end of the
-						# search_range
-						portions.append(Range(search_range.start, search_range.end))
-						break
-
-					else:
-						# if search_range begins before this item starts (and it overlaps
-						# with this item), add a portion to account for the space between
-						# search_range.start and item.start, move beginning of search_range
-						# to item.start, and re-run loop without moving to the next item
-
-						portions.append(Range(search_range.start, item.start))
-						search_range = Range(item.start, search_range.end)
-
-				else:
-					# if this item does not overlap search range at all, ignore this item
-					i += 1 # move to next item
-
-			else:
-				# if overlaps, then move the search_range up to begin at
-				# the end of this item (since it is 'covered' up to the end of this
-				# item)
-				search_range = Range(item.end, search_range.end)
-
-				# get the next item (because of _cleanup, we know that there will be
-				# space between item and next_item)
-				next_item = None
-				if i < len(self.ranges)-1:
-					next_item = self.ranges[i+1]
-
-				if next_item == None or search_range.end <= next_item.start:
-					# if our search_range finishes before we get to the next item, then add a
-					# portion for search_range, and exit (since we've finished)
-
-					portions.append(Range(search_range.start, search_range.end))
-					break
-
-				else:
-					# if our search_range strays into the next_item range, add a portion
-					# to cover the space up to the beginning of the next item, then move
-					# the beginning of search_range up to the next item and re-run loop
-					
-					portions.append(Range(search_range.start, next_item.start))
-					search_range = Range(next_item.start, search_range.end)
-					
-					i += 1 # move to next item
+		# skip straight to the first range that ends after start
+		i = bisect_right(ends, start)
+		pos = start
+
+		while i < len(starts) and starts[i] < end:
+			if starts[i] > pos:
+				portions.append((pos, int(starts[i])))
+
+			pos = max(pos, int(ends[i]))
+			i += 1
+
+		if pos < end:
+			portions.append((pos, end))
 
 		return portions
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+"""
+   Sequential access detection and readahead for pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import threading
+
+from lrucache import LRUCache
+from pcachefsutil import debug
+from workers import WorkerPool
+
+"""
+# Access pattern state kept for each file being read.
+"""
+class AccessState(object):
+	__slots__ = ('last_end', 'sequential_reads', 'window', 'prefetched_until', 'generation', 'tasks')
+
+	def __init__(self):
+		# end offset of the most recent read
+		self.last_end = None
+
+		# number of consecutive reads that followed on from the previous one
+		self.sequential_reads = 0
+
+		# current readahead window, in blocks
+		self.window = 0
+
+		# offset up to which prefetches have already been queued
+		self.prefetched_until = 0
+
+		# bumped whenever the access pattern turns random, so that queued
+		# prefetches from an earlier sequential run know to give up
+		self.generation = 0
+
+		# prefetch Tasks queued for this file and not yet known to be done
+		self.tasks = []
+
+"""
+# Watches the reads made against each file and, once a file is being read
+# sequentially, asks for the blocks following the current read to be fetched
+# in the background so that they are already cached when the client gets to
+# them.
+#
+# The readahead window starts at one block and doubles with each further
+# sequential read, up to max_window blocks. As soon as a read does not follow
+# on from the one before it, the window is reset and any prefetches for that
+# file that have not started yet are cancelled.
+#
+# fetch is called as fetch(path, start, end) on a worker thread for each
+# block to be prefetched.
+"""
+class Readahead(object):
+	# Number of sequential reads that must be seen before readahead starts
+	MIN_SEQUENTIAL_READS = 2
+
+	# Maximum number of files whose access pattern is tracked at once
+	MAX_TRACKED_FILES = 1024
+
+	def __init__(self, fetch, block_size, max_window, num_threads = 2):
+		if max_window < 1:
+			raise ValueError('max_window (' + str(max_window) + ') must be at least 1')
+
+		self.fetch = fetch
+		self.block_size = block_size
+		self.max_window = max_window
+
+		self.prefetched_blocks = 0
+		self.cancelled_blocks = 0
+
+		self._states = LRUCache(self.MAX_TRACKED_FILES)
+		self._lock = threading.Lock()
+		self._pool = WorkerPool(num_threads, name = 'pcachefs-readahead')
+		self._stopped = False
+
+	"""
+	# Record a read of offset..end from path (a file of file_size bytes), and
+	# queue any prefetches that this read makes worthwhile.
+	"""
+	def record(self, path, offset, end, file_size):
+		if self._stopped:
+			return
+
+		with self._lock:
+			state = self._states.get(path, count = False)
+			if state is None:
+				state = AccessState()
+				self._states.put(path, state)
+
+			if self._is_sequential(state, offset):
+				state.sequential_reads += 1
+			else:
+				self._cancel(state)
+				state.sequential_reads = 0
+
+			state.last_end = end
+
+			if state.sequential_reads < self.MIN_SEQUENTIAL_READS:
+				return
+
+			state.window = min(max(state.window * 2, 1), self.max_window)
+			self._schedule(path, state, end, file_size)
+
+	""" Cancel any queued prefetches for path and forget its access pattern. """
+	def forget(self, path):
+		with self._lock:
+			state = self._states.get(path, count = False)
+			if state is not None:
+				self._cancel(state)
+				self._states.invalidate(path)
+
+	""" Wait until every prefetch queued so far has finished. """
+	def wait(self):
+		self._pool.join()
+
+	"""
+	# Stop the worker threads, skipping any prefetches which have not
+	# started yet. No more are queued afterwards.
+	"""
+	def shutdown(self):
+		self._stopped = True
+		self._pool.shutdown()
+
+	def _is_sequential(self, state, offset):
+		# allow a little slack either side so that reads which arrive
+		# slightly out of order still count as sequential
+		return state.last_end is not None and \
+			state.last_end - self.block_size <= offset <= state.last_end + self.block_size
+
+	def _cancel(self, state):
+		state.generation += 1
+		state.window = 0
+		state.prefetched_until = 0
+
+		for task in state.tasks:
+			if not task.done():
+				task.cancel()
+				self.cancelled_blocks += 1
+
+		state.tasks = []
+
+	def _schedule(self, path, state, end, file_size):
+		bs = self.block_size
+
+		# prefetch whole blocks, starting with the block after the one
+		# containing the end of this read
+		first_block = -(-end // bs)
+		start = max(state.prefetched_until, first_block * bs)
+		limit = min((first_block + state.window) * bs, file_size)
+
+		state.tasks = [ t for t in state.tasks if not t.done() ]
+
+		while start < limit:
+			block_end = min(start + bs, file_size)
+			task = self._pool.submit(self._prefetch, path, state, state.generation, start, block_end)
+			state.tasks.append(task)
+
+			start = block_end
+
+		state.prefetched_until = max(state.prefetched_until, start)
+
+	def _prefetch(self, path, state, generation, start, end):
+		# the access pattern changed since this prefetch was queued, or
+		# readahead is shutting down
+		if state.generation != generation or self._stopped:
+			return
+
+		debug('readahead', path, str(start), str(end))
+		self.fetch(path, start, end)
+
+		with self._lock:
+			self.prefetched_blocks += 1
+
+	""" Return how many blocks have been prefetched, cancelled and are still queued. """
+	def stats(self):
+		return {
+			'prefetched_blocks': self.prefetched_blocks,
+			'cancelled_blocks': self.cancelled_blocks,
+			'queued_blocks': self._pool.pending(),
+		}
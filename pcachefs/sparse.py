@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+"""
+   Sparse file helpers used by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+
+from pcachefsutil import debug
+
+# Flags for fallocate(2), from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# Errors meaning the filesystem or kernel cannot do what we asked, as
+# opposed to something having gone wrong
+_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL)
+
+# fallocate() and posix_fallocate() are not exposed by the os module, so
+# they are called through libc. Either may be None if libc lacks them.
+_fallocate = None
+_posix_fallocate = None
+
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+
+	for name in ('fallocate64', 'fallocate'):
+		if hasattr(_libc, name):
+			_fallocate = getattr(_libc, name)
+			_fallocate.argtypes = [ ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64 ]
+			_fallocate.restype = ctypes.c_int
+			break
+
+	for name in ('posix_fallocate64', 'posix_fallocate'):
+		if hasattr(_libc, name):
+			_posix_fallocate = getattr(_libc, name)
+			_posix_fallocate.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64 ]
+			_posix_fallocate.restype = ctypes.c_int
+			break
+
+except OSError, e:
+	debug('sparse: cannot load libc', e)
+
+"""
+Create or resize the file open as fd to size bytes without allocating any
+disk space for it; the file reads as zeroes until data is written to it.
+"""
+def allocate_sparse(fd, size):
+	os.ftruncate(fd, size)
+
+"""
+Reserve disk space for offset..offset+length of the file open as fd, so
+that later writes there do not fail for lack of space and are laid out
+contiguously. Returns False if this is not supported here.
+"""
+def preallocate(fd, offset, length):
+	if _posix_fallocate is None or length <= 0:
+		return False
+
+	# posix_fallocate() returns an error number rather than setting errno
+	result = _posix_fallocate(fd, offset, length)
+	if result == 0:
+		return True
+
+	if result in _UNSUPPORTED:
+		return False
+
+	raise OSError(result, os.strerror(result))
+
+"""
+Free the disk space used by offset..offset+length of the file open as fd,
+leaving the file's size unchanged; that part of the file then reads as
+zeroes. Returns False if this is not supported here, in which case the
+file is left as it was.
+"""
+def punch_hole(fd, offset, length):
+	if _fallocate is None or length <= 0:
+		return False
+
+	if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+		return True
+
+	e = ctypes.get_errno()
+	if e in _UNSUPPORTED:
+		return False
+
+	raise OSError(e, os.strerror(e))
+
+""" Number of bytes of disk space actually used by the file open as fd. """
+def allocated_bytes(fd):
+	return os.fstat(fd).st_blocks * 512
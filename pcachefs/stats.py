@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+"""
+   Counters and latency histograms kept by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import bisect
+import threading
+
+"""
+# Counts how many of a series of durations fall into each of a fixed set of
+# buckets, along with their number and total.
+"""
+class Histogram(object):
+	# Upper bounds of the buckets, in seconds; durations beyond the last
+	# fall into a final unbounded bucket
+	BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self, bounds = BOUNDS):
+		self.bounds = bounds
+		self.counts = [ 0 ] * (len(bounds) + 1)
+		self.count = 0
+		self.total = 0.0
+
+	def record(self, seconds):
+		self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+
+	"""
+	# Return a dict of the histogram's values, with keys starting with
+	# prefix. Buckets are cumulative: prefix.le_1ms is the number of
+	# durations of at most 1ms.
+	"""
+	def values(self, prefix):
+		result = {
+			prefix + '.count': self.count,
+			prefix + '.sum_ms': int(self.total * 1000),
+		}
+
+		cumulative = 0
+		for (bound, n) in zip(self.bounds, self.counts):
+			cumulative += n
+			result[prefix + '.le_' + _format_ms(bound)] = cumulative
+
+		result[prefix + '.le_inf'] = self.count
+		return result
+
+def _format_ms(seconds):
+	ms = seconds * 1000
+	if ms == int(ms):
+		return str(int(ms)) + 'ms'
+	return str(ms) + 'ms'
+
+"""
+# A set of named counters and latency histograms, which may be updated from
+# any thread. Updating a counter or histogram costs one uncontended lock
+# acquisition, so they can be updated on every operation.
+"""
+class Stats(object):
+	def __init__(self):
+		self._counters = {}
+		self._histograms = {}
+		self._lock = threading.Lock()
+
+	""" Add n to the named counter. """
+	def add(self, name, n = 1):
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + n
+
+	""" Record a duration, in seconds, in the named histogram. """
+	def record(self, name, seconds):
+		with self._lock:
+			histogram = self._histograms.get(name)
+			if histogram is None:
+				histogram = self._histograms[name] = Histogram()
+
+			histogram.record(seconds)
+
+	""" Current value of the named counter. """
+	def get(self, name):
+		return self._counters.get(name, 0)
+
+	""" Return a dict of every counter and histogram value. """
+	def values(self):
+		with self._lock:
+			result = dict(self._counters)
+
+			for (name, histogram) in self._histograms.items():
+				result.update(histogram.values(name))
+
+		return result
+
+"""
+# Format a dict of statistics as text, one 'name value' line each, sorted by
+# name, as read from pCacheFS's statistics virtual files.
+"""
+def format_stats(stats):
+	return ''.join([ k + ' ' + str(stats[k]) + '\n' for k in sorted(stats.keys()) ])
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+"""
+   Tracing and profiling of pCacheFS operations
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+"""
+# A timed stage of an operation, used as a context manager:
+#
+#   with tracer.span('cacher.read', path):
+#       ...
+#
+# When it exits, it is passed to each of the Tracer's sinks. Spans started
+# while another is open on the same thread record it as their parent.
+"""
+class Span(object):
+	def __init__(self, tracer, name, path):
+		self.tracer = tracer
+		self.name = name
+		self.path = path
+		self.id = None
+		self.parent = None
+		self.thread = None
+		self.start = None
+		self.duration = None
+		self.error = None
+
+	def __enter__(self):
+		stack = self.tracer._stack()
+
+		self.id = next(self.tracer._ids)
+		if len(stack) > 0:
+			self.parent = stack[-1].id
+		self.thread = threading.current_thread().name
+
+		stack.append(self)
+		self.start = time.time()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.duration = time.time() - self.start
+		if type is not None:
+			self.error = type.__name__
+
+		self.tracer._stack().pop()
+		self.tracer._emit(self)
+		return False
+
+	def to_dict(self):
+		return {
+			'id': self.id,
+			'parent': self.parent,
+			'name': self.name,
+			'path': self.path,
+			'thread': self.thread,
+			'start': self.start,
+			'duration_ms': self.duration * 1000,
+			'error': self.error,
+		}
+
+"""
+# Returned by Tracer.span() while tracing is disabled, so that instrumented
+# code costs no more than a method call.
+"""
+class _NullSpan(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		return False
+
+NULL_SPAN = _NullSpan()
+
+"""
+# Creates Spans and hands them to a set of sinks: objects with an
+# emit(span) method, called on the thread which ran the span, and a
+# close() method. Tracing is enabled while enabled is True.
+"""
+class Tracer(object):
+	def __init__(self, sinks = []):
+		self.sinks = list(sinks)
+		self.enabled = len(self.sinks) > 0
+
+		self._ids = itertools.count(1)
+		self._local = threading.local()
+
+	def add_sink(self, sink):
+		self.sinks.append(sink)
+
+	""" Return a context manager timing the named stage of an operation on path. """
+	def span(self, name, path = None):
+		if not self.enabled:
+			return NULL_SPAN
+
+		return Span(self, name, path)
+
+	def close(self):
+		for sink in self.sinks:
+			sink.close()
+
+	# Spans currently open on this thread, innermost last
+	def _stack(self):
+		stack = getattr(self._local, 'stack', None)
+		if stack is None:
+			stack = self._local.stack = []
+		return stack
+
+	def _emit(self, span):
+		for sink in self.sinks:
+			sink.emit(span)
+
+"""
+# Keeps the most recent spans in memory, for reading back from the
+# .pcachefs.trace virtual file.
+"""
+class RingBufferSink(object):
+	def __init__(self, size):
+		self._spans = collections.deque(maxlen = size)
+		self._lock = threading.Lock()
+
+	def emit(self, span):
+		with self._lock:
+			self._spans.append(span.to_dict())
+
+	""" Return the buffered spans, oldest first, as dicts. """
+	def spans(self):
+		with self._lock:
+			return list(self._spans)
+
+	""" Return the buffered spans as JSON lines, oldest first. """
+	def format(self):
+		return ''.join([ json.dumps(s, sort_keys = True) + '\n' for s in self.spans() ])
+
+	def close(self):
+		pass
+
+"""
+# Appends each span to a file as a line of JSON.
+"""
+class JsonLinesSink(object):
+	def __init__(self, path):
+		self._file = open(path, 'a')
+		self._lock = threading.Lock()
+
+	def emit(self, span):
+		line = json.dumps(span.to_dict(), sort_keys = True) + '\n'
+
+		with self._lock:
+			self._file.write(line)
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+"""
+# Periodically samples the stack of every other thread while it is running,
+# counting how often each stack is seen. report() returns the counts in the
+# 'collapsed' format read by flame graph tools: one line per stack, with
+# its frames outermost first separated by ';', followed by its count.
+"""
+class SamplingProfiler(object):
+	# Default seconds between samples
+	DEFAULT_INTERVAL = 0.005
+
+	def __init__(self, interval = DEFAULT_INTERVAL):
+		self.interval = interval
+
+		self._counts = {}
+		self._lock = threading.Lock()
+		self._thread = None
+		self._stop = threading.Event()
+
+	def is_running(self):
+		return self._thread is not None
+
+	""" Start sampling, discarding any samples already taken. """
+	def start(self):
+		with self._lock:
+			if self._thread is not None:
+				return
+
+			self._counts = {}
+			self._stop.clear()
+
+			self._thread = threading.Thread(target = self._run, name = 'pcachefs-profiler')
+			self._thread.daemon = True
+			self._thread.start()
+
+	""" Stop sampling, keeping the samples taken for report(). """
+	def stop(self):
+		with self._lock:
+			thread = self._thread
+			self._thread = None
+
+		if thread is not None:
+			self._stop.set()
+			thread.join()
+
+	def report(self):
+		with self._lock:
+			counts = self._counts.items()
+
+		counts.sort(key = lambda (stack, n): (-n, stack))
+		return ''.join([ stack + ' ' + str(n) + '\n' for (stack, n) in counts ])
+
+	def _run(self):
+		me = threading.current_thread().ident
+
+		while not self._stop.wait(self.interval):
+			self.sample(exclude = me)
+
+	""" Take one sample of every thread but exclude. """
+	def sample(self, exclude = None):
+		stacks = []
+		for (ident, frame) in sys._current_frames().items():
+			if ident != exclude:
+				stacks.append(_collapse(frame))
+
+		with self._lock:
+			for stack in stacks:
+				self._counts[stack] = self._counts.get(stack, 0) + 1
+
+# Describe the stack ending at frame as 'file:function;file:function...',
+# outermost frame first
+def _collapse(frame):
+	frames = []
+	while frame is not None:
+		code = frame.f_code
+		frames.append(os.path.basename(code.co_filename) + ':' + code.co_name)
+		frame = frame.f_back
+
+	frames.reverse()
+	return ';'.join(frames)
@@ -152,7 +152,8 @@ class SimpleVirtualFile(VirtualFile):
 
 	def release(self):
 		# convert list to string and return it
-		self.callback_on_change(self._get_content())
+		if self.callback_on_change != None:
+			self.callback_on_change(self._get_content())
 
 		# clear cache
 		self.content = None
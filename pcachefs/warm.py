@@ -0,0 +1,224 @@
+#!/usr/bin/python
+
+"""
+   pcachefs-warm: pre-populates a pCacheFS cache
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import glob
+import os
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+
+import pcachefsutil
+
+from pcachefs import (Cacher, UnderlyingFs)
+from pcachefsutil import (debug, parse_size)
+from metadata import create_store
+from compression import create_codec
+from workers import WorkerPool
+
+USAGE = """%prog -c CACHE_DIR -t TARGET_DIR [options] [PATH|GLOB ...]
+
+Fill a pCacheFS cache directly, without going through a mount. Paths and
+globs are relative to TARGET_DIR; directories are warmed recursively. Use
+--from-file to read further paths from a file (or '-' for stdin), one per
+line.
+
+The cache is filled exactly as the mount would fill it, so use the same
+--block-size as the mount. Avoid warming files which the mount is reading
+at the same time.
+
+A cache holding data which a write-back mount has not yet written to the
+origin is refused, as warming must never write back on the mount's behalf."""
+
+"""
+# Counts progress made by a Warmer, and prints it periodically.
+"""
+class Progress(object):
+	def __init__(self, total_files, out = sys.stderr):
+		self.total_files = total_files
+		self.out = out
+
+		self.files_done = 0
+		self.files_failed = 0
+		self.bytes_fetched = 0
+
+		self.started = time.time()
+		self._lock = threading.Lock()
+
+	def file_done(self, fetched, failed = False):
+		with self._lock:
+			self.files_done += 1
+			self.bytes_fetched += fetched
+
+			if failed:
+				self.files_failed += 1
+
+	def report(self):
+		elapsed = max(time.time() - self.started, 0.001)
+		rate = self.bytes_fetched / elapsed / (1024 * 1024)
+
+		self.out.write('%d/%d files, %d failed, %.1f MiB fetched in %.1fs (%.2f MiB/s)\n' % (
+			self.files_done, self.total_files, self.files_failed,
+			self.bytes_fetched / (1024.0 * 1024), elapsed, rate))
+		self.out.flush()
+
+"""
+# Fills the cache for a list of files using a pool of worker threads.
+#
+# cacher the Cacher to fill
+# threads the number of files to warm at once
+# max_bytes the number of bytes from the start of each file to cache (0
+#   means the whole file)
+# chunk_size the number of bytes fetched by each call to Cacher.prefetch()
+"""
+class Warmer(object):
+	def __init__(self, cacher, threads = 4, max_bytes = 0, chunk_size = None):
+		self.cacher = cacher
+		self.threads = threads
+		self.max_bytes = max_bytes
+		self.chunk_size = chunk_size or cacher.block_size * 8
+
+	"""
+	# Warm each of the given paths (which must be files, relative to the root
+	# of the cached filesystem and starting with '/'). Progress is reported
+	# every report_interval seconds (0 to disable). Returns a Progress.
+	"""
+	def warm(self, paths, report_interval = 5):
+		progress = Progress(len(paths))
+		pool = WorkerPool(self.threads, name = 'pcachefs-warm')
+
+		tasks = [ pool.submit(self._warm_file, path, progress) for path in paths ]
+
+		for task in tasks:
+			while not task.wait(report_interval or None):
+				progress.report()
+
+		pool.shutdown()
+		return progress
+
+	def _warm_file(self, path, progress):
+		fetched = 0
+		try:
+			size = self.cacher.getattr(path).st_size
+			if self.max_bytes > 0:
+				size = min(size, self.max_bytes)
+
+			for offset in xrange(0, size, self.chunk_size):
+				fetched += self.cacher.prefetch(path, offset, min(offset + self.chunk_size, size))
+
+		except (IOError, OSError), e:
+			sys.stderr.write('%s: %s\n' % (path, e))
+			progress.file_done(fetched, failed = True)
+			return
+
+		debug('warmed', path, str(fetched))
+		progress.file_done(fetched)
+
+"""
+# Expand the given paths, globs and directories (relative to target_dir)
+# into a sorted list of the files they name, as paths starting with '/'.
+"""
+def find_files(target_dir, patterns):
+	found = set()
+
+	for pattern in patterns:
+		pattern = pattern.strip().lstrip('/')
+		if pattern == '':
+			pattern = '.'
+
+		for match in glob.glob(os.path.join(target_dir, pattern)):
+			if os.path.isdir(match):
+				for (dirpath, dirnames, filenames) in os.walk(match):
+					for f in filenames:
+						found.add(os.path.join(dirpath, f))
+			elif os.path.isfile(match):
+				found.add(match)
+
+	return sorted([ '/' + os.path.relpath(f, target_dir) for f in found ])
+
+def main(argv = None):
+	parser = OptionParser(usage = USAGE)
+	parser.add_option('-c', '--cache-dir', dest='cache_dir', help="The cache directory to fill, as given to the mount.")
+	parser.add_option('-t', '--target-dir', dest='target_dir', help="The directory being cached, as given to the mount.")
+	parser.add_option('-f', '--from-file', dest='from_file', help="Read paths or globs to warm from this file, one per line ('-' for stdin).")
+	parser.add_option('-j', '--threads', dest='threads', type='int', default=4, help="Number of files to warm at once (default 4).")
+	parser.add_option('--max-bytes', dest='max_bytes', default='0', help="Only cache this much of the start of each file, e.g. 10M. 0 (the default) caches whole files.")
+	parser.add_option('--block-size', dest='block_size', default=str(Cacher.DEFAULT_BLOCK_SIZE), help="Block size used by the mount.")
+	parser.add_option('--metadata-store', dest='metadata_store', default='file', help="Metadata store used by the mount ('file' or 'sqlite').")
+	parser.add_option('--dedup', dest='dedup', action='store_true', default=False, help="Give this if the mount uses --dedup.")
+	parser.add_option('--compress', dest='compress', default=None, help="Codec used by the mount, if it uses --compress.")
+	parser.add_option('--report-interval', dest='report_interval', type='float', default=5, help="Seconds between progress reports (default 5, 0 disables).")
+	parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False, help="Print debugging output.")
+
+	(options, args) = parser.parse_args(argv)
+
+	if options.cache_dir is None or options.target_dir is None:
+		parser.error('Need to specify --cache-dir and --target-dir')
+
+	pcachefsutil.DEBUG = options.verbose
+
+	patterns = list(args)
+	if options.from_file is not None:
+		if options.from_file == '-':
+			patterns.extend(sys.stdin.read().splitlines())
+		else:
+			with open(options.from_file) as f:
+				patterns.extend(f.read().splitlines())
+
+	if len(patterns) == 0:
+		parser.error('Nothing to warm: give some paths or --from-file')
+
+	try:
+		block_size = parse_size(options.block_size)
+		max_bytes = parse_size(options.max_bytes)
+	except ValueError, e:
+		parser.error(str(e))
+
+	paths = find_files(options.target_dir, patterns)
+
+	try:
+		metadata = create_store(options.metadata_store, options.cache_dir)
+
+		codec = None
+		if options.compress is not None:
+			codec = create_codec(options.compress)
+	except ValueError, e:
+		parser.error(str(e))
+
+	# a Cacher opened on dirty paths would start writing them back itself,
+	# racing the mount which owns them
+	dirty = metadata.get_dirty_paths()
+	if len(dirty) > 0:
+		metadata.close()
+		sys.stderr.write('%s holds %d file(s) not yet written back to the origin; unmount it or wait for write-back before warming\n' % (
+			options.cache_dir, len(dirty)))
+		return 1
+
+	cacher = Cacher(options.cache_dir, UnderlyingFs(options.target_dir), block_size = block_size, dedup = options.dedup, codec = codec, metadata = metadata)
+	warmer = Warmer(cacher, threads = options.threads, max_bytes = max_bytes)
+
+	progress = warmer.warm(paths, report_interval = options.report_interval)
+	progress.report()
+	cacher.close()
+
+	if progress.files_failed > 0:
+		return 1
+
+	return 0
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+"""
+   Background worker threads used by pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import sys
+import threading
+import Queue
+
+from pcachefsutil import debug
+
+"""
+# A unit of work submitted to a WorkerPool. Callers can wait() for it to
+# finish and collect its result(), or cancel() it if it has not started yet.
+"""
+class Task(object):
+	def __init__(self, fn, args, kw):
+		self.fn = fn
+		self.args = args
+		self.kw = kw
+
+		self.cancelled = False
+		self.value = None
+		self.exc_info = None
+
+		self._done = threading.Event()
+
+	def run(self):
+		if not self.cancelled:
+			try:
+				self.value = self.fn(*self.args, **self.kw)
+			except Exception:
+				self.exc_info = sys.exc_info()
+				debug('task failed', self.fn, self.exc_info[1])
+
+		self._done.set()
+
+	""" Prevent this task from running if a worker has not picked it up yet. """
+	def cancel(self):
+		self.cancelled = True
+
+	def done(self):
+		return self._done.is_set()
+
+	""" Block until this task has run (or been skipped because it was cancelled). """
+	def wait(self, timeout = None):
+		self._done.wait(timeout)
+		return self._done.is_set()
+
+	"""
+	# Wait for this task and return the value its function returned, re-raising
+	# any exception it raised.
+	"""
+	def result(self):
+		self.wait()
+
+		if self.exc_info is not None:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+		return self.value
+
+"""
+# A fixed number of daemon threads which run Tasks taken from a queue, in
+# the order they were submitted.
+"""
+class WorkerPool(object):
+	def __init__(self, num_threads, name = 'pcachefs-worker'):
+		if num_threads < 1:
+			raise ValueError('num_threads (' + str(num_threads) + ') must be at least 1')
+
+		self.num_threads = num_threads
+		self._queue = Queue.Queue()
+
+		self._threads = []
+		for i in range(num_threads):
+			t = threading.Thread(target = self._work, name = name + '-' + str(i))
+			t.daemon = True
+			t.start()
+
+			self._threads.append(t)
+
+	def _work(self):
+		while True:
+			task = self._queue.get()
+			if task is None:
+				return
+
+			task.run()
+			self._queue.task_done()
+
+	""" Number of tasks waiting for a worker. """
+	def pending(self):
+		return self._queue.qsize()
+
+	""" Queue fn(*args, **kw) to be run by a worker thread and return its Task. """
+	def submit(self, fn, *args, **kw):
+		task = Task(fn, args, kw)
+		self._queue.put(task)
+		return task
+
+	""" Wait until every task submitted so far has been run. """
+	def join(self):
+		self._queue.join()
+
+	""" Stop all workers once the tasks already queued have been run. """
+	def shutdown(self, wait = True):
+		for t in self._threads:
+			self._queue.put(None)
+
+		if wait:
+			for t in self._threads:
+				t.join()
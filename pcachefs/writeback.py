@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+"""
+   Background write-back of locally written data for pCacheFS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+"""
+
+import threading
+
+from pcachefsutil import debug
+
+"""
+# Writes data written to the cache in write-back mode through to the origin
+# in the background.
+#
+# Writes only reach cache.data and are marked dirty in the file's coverage
+# map; the path is added to the metadata store's set of dirty paths. Every
+# interval seconds, each dirty path is passed to Cacher.write_back(), which
+# writes its dirty ranges to the origin as a few large sequential writes,
+# however many small writes they were made up of. Anything which cannot be
+# written (because the origin is unavailable, say) stays dirty and is tried
+# again next time.
+"""
+class WriteBack(object):
+	DEFAULT_INTERVAL = 5
+
+	"""
+	# cacher the Cacher whose dirty data is to be written back
+	# interval seconds between passes over the dirty paths
+	"""
+	def __init__(self, cacher, interval = DEFAULT_INTERVAL):
+		self.cacher = cacher
+		self.interval = interval
+
+		self.files_written = 0
+		self.errors = 0
+
+		self._stopped = threading.Event()
+		self._thread = None
+
+	""" Start writing back in the background. """
+	def start(self):
+		self._thread = threading.Thread(target = self._run, name = 'pcachefs-write-back')
+		self._thread.daemon = True
+		self._thread.start()
+
+	""" Stop the background thread, once any pass in progress is done. """
+	def stop(self):
+		self._stopped.set()
+
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def _run(self):
+		while not self._stopped.wait(self.interval):
+			self.write_back_all()
+
+	"""
+	# Write back every dirty path now. Returns the number of paths which
+	# could not be written back.
+	"""
+	def write_back_all(self):
+		failed = 0
+
+		for path in sorted(self.cacher.dirty_paths()):
+			try:
+				self.cacher.write_back(path)
+				self.files_written += 1
+			except Exception, e:
+				debug('write-back failed', path, e)
+				self.errors += 1
+				failed += 1
+
+		return failed
+
+	""" Return how many paths are dirty, and how many write-backs succeeded and failed. """
+	def stats(self):
+		return {
+			'dirty_files': len(self.cacher.dirty_paths()),
+			'files_written': self.files_written,
+			'errors': self.errors,
+		}
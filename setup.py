@@ -126,7 +126,7 @@ setup(name='pCacheFS',
 	url='http://code.google.com/p/pcachefs',
 	license='Apache 2.0',
 
-	scripts=['scripts/pcachefs'],
+	scripts=['scripts/pcachefs', 'scripts/pcachefs-warm', 'scripts/pcachefs-bench'],
 	packages=['pcachefs'],
 
 	cmdclass = { 'test': TestCommand, 'clean': CleanCommand }
@@ -0,0 +1,70 @@
+import unittest
+
+from pcachefs.admission import (AlwaysAdmit, NthAccessAdmission, TinyLFUAdmission, create_admission_policy)
+
+class Stat(object):
+	def __init__(self, st_size):
+		self.st_size = st_size
+
+class AdmissionPolicyTest(unittest.TestCase):
+	def test_alwaysAdmitShouldAdmitEverythingWithinMaxFileSize(self):
+		policy = AlwaysAdmit(max_file_size = 100)
+
+		self.assertTrue(policy.admit('/a', Stat(100)))
+		self.assertFalse(policy.admit('/b', Stat(101)))
+		self.assertEqual(policy.stats()['admitted'], 1)
+		self.assertEqual(policy.stats()['rejected'], 1)
+
+	def test_nthAccessShouldAdmitOnNthOpen(self):
+		policy = NthAccessAdmission(count = 3)
+
+		self.assertFalse(policy.admit('/a', Stat(10)))
+		self.assertFalse(policy.admit('/b', Stat(10)))
+		self.assertFalse(policy.admit('/a', Stat(10)))
+		self.assertTrue(policy.admit('/a', Stat(10)))
+		self.assertEqual(policy.stats()['tracked_files'], 1)
+
+	def test_nthAccessShouldForgetLeastRecentlyOpenedFiles(self):
+		policy = NthAccessAdmission(count = 2, max_paths = 1)
+
+		policy.admit('/a', Stat(10))
+		policy.admit('/b', Stat(10))
+
+		self.assertFalse(policy.admit('/a', Stat(10)))
+
+	def test_tinyLFUShouldAdmitOnNthOpen(self):
+		policy = TinyLFUAdmission(count = 2, width = 1024)
+
+		self.assertFalse(policy.admit('/a', Stat(10)))
+		self.assertFalse(policy.admit('/b', Stat(10)))
+		self.assertTrue(policy.admit('/a', Stat(10)))
+
+	def test_tinyLFUShouldAgeCounts(self):
+		policy = TinyLFUAdmission(count = 2, width = 16)
+		policy.admit('/a', Stat(10))
+
+		for i in range(policy.sample_size):
+			policy.admit('/other' + str(i % 3), Stat(10))
+
+		self.assertEqual(policy.stats()['resets'], 1)
+		self.assertFalse(policy.admit('/a', Stat(10)))
+
+	def test_tinyLFUShouldHalveEveryCounterOnReset(self):
+		policy = TinyLFUAdmission(count = 2, width = 16)
+		policy._rows[0][3] = 15
+		policy._rows[1][4] = 1
+		policy._rows[2][5] = 6
+
+		policy._reset_due = True
+		policy._maintain()
+
+		self.assertEqual(policy._rows[0][3], 7)
+		self.assertEqual(policy._rows[1][4], 0)
+		self.assertEqual(policy._rows[2][5], 3)
+		self.assertEqual(sum([ sum(row) for row in policy._rows ]), 10)
+		self.assertEqual(policy._rows[0].typecode, 'B')
+
+	def test_createShouldRejectUnknownPolicy(self):
+		self.assertRaises(ValueError, create_admission_policy, 'never')
+		self.assertRaises(ValueError, create_admission_policy, 'nth', 0)
+		self.assertEqual(create_admission_policy('nth', 4).count, 4)
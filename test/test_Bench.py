@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from mock import Mock
+
+import pcachefs
+from pcachefs.bench import (Benchmark, Dataset, SlowUnderlyingFs, SCENARIOS)
+
+class BenchTest(unittest.TestCase):
+	def setUp(self):
+		self.data_dir = tempfile.mkdtemp()
+		self.dataset = Dataset(self.data_dir, files = 2, file_size = 1000, read_size = 100,
+			random_reads = 5, tree_fanout = 2, tree_depth = 2, dir_entries = 10)
+		self.dataset.create()
+
+	def tearDown(self):
+		shutil.rmtree(self.data_dir)
+
+	def test_slowUnderlyingFsShouldCountRequests(self):
+		ufs = SlowUnderlyingFs(self.data_dir, latency = 0.001)
+
+		ufs.getattr('/sequential/file-0')
+		ufs.read('/sequential/file-0', 10, 0)
+
+		self.assertEqual(ufs.requests.values(), { 'getattr': 1, 'read': 1 })
+		self.assertEqual(ufs.total_requests(), 2)
+
+	def test_runCacherShouldRunEachScenarioColdThenWarm(self):
+		def create_cacher(cachedir, ufs):
+			return pcachefs.Cacher(cachedir, ufs, block_size = 100)
+
+		results = Benchmark(self.dataset, create_cacher).run_cacher()
+
+		self.assertEqual([ (r['scenario'], r['phase']) for r in results ],
+			[ (s, p) for s in SCENARIOS for p in [ 'cold', 'warm' ] ])
+
+		for r in results:
+			if r['phase'] == 'cold':
+				self.assertTrue(r['origin_requests'] > 0)
+			else:
+				self.assertEqual(r['origin_requests'], 0)
+
+		self.assertEqual(results[0]['bytes'], 2000)
+
+	def test_runCacherShouldNotLeaveThreadsRunning(self):
+		def create_cacher(cachedir, ufs):
+			return pcachefs.Cacher(cachedir, ufs, block_size = 100, readahead = 2, max_cache_size = 10000)
+
+		before = set(threading.enumerate())
+
+		Benchmark(self.dataset, create_cacher, stat_threads = 2).run_cacher()
+
+		self.assertEqual(set(threading.enumerate()) - before, set())
+
+	def test_runCacherShouldCloseCacherIfScenarioFails(self):
+		cachers = []
+
+		def create_cacher(cachedir, ufs):
+			cacher = pcachefs.Cacher(cachedir, ufs, block_size = 100, readahead = 2)
+			cacher.read = Mock(side_effect = IOError('origin unavailable'))
+			cacher.close = Mock(wraps = cacher.close)
+			cachers.append(cacher)
+			return cacher
+
+		before = set(threading.enumerate())
+
+		self.assertRaises(IOError, Benchmark(self.dataset, create_cacher).run_cacher, [ 'sequential_read' ])
+
+		self.assertEqual(len(cachers), 1)
+		self.assertTrue(cachers[0].close.called)
+		self.assertEqual(set(threading.enumerate()) - before, set())
+
+	def test_createShouldReuseAnExistingDataset(self):
+		path = os.path.join(self.data_dir, 'sequential', 'file-0')
+		os.utime(path, (0, 0))
+
+		self.dataset.create()
+
+		self.assertEqual(os.stat(path).st_mtime, 0)
@@ -0,0 +1,158 @@
+import unittest
+from mock import Mock
+import os, shutil, tempfile, threading
+
+from pcachefs.blockstore import (BlockStore, BlockStoreCachedFile)
+from pcachefs.compression import ZlibCodec
+from pcachefs.coveragemap import CoverageMap
+
+class BlockStoreTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.store = BlockStore(self.dir, 4)
+
+		self.a = os.path.join(self.dir, 'a')
+		self.b = os.path.join(self.dir, 'b')
+		self.store.create(self.a)
+		self.store.create(self.b)
+		self.store.write_marker(self.a, None)
+		self.store.write_marker(self.b, None)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _stored(self):
+		return sum([ len(files) for (d, dirs, files) in os.walk(self.store.root) ])
+
+	def test_putShouldStoreIdenticalBlocksOnce(self):
+		self.store.put(self.a, 0, 'abcd')
+		self.store.put(self.b, 3, 'abcd')
+		self.store.put(self.b, 4, 'efgh')
+
+		self.assertEqual(self._stored(), 2)
+		self.assertEqual(self.store.stats()['stored_blocks'], 2)
+		self.assertEqual(self.store.stats()['shared_blocks'], 1)
+		self.assertEqual(open(os.path.join(self.b, '3')).read(), 'abcd')
+
+	def test_statsShouldCountEveryPutFromConcurrentThreads(self):
+		def put(t):
+			for i in range(50):
+				self.store.put(self.a if t % 2 else self.b, t * 50 + i, str(i % 5).ljust(4))
+
+		threads = [ threading.Thread(target = put, args = (t,)) for t in range(4) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		stats = self.store.stats()
+		self.assertEqual(stats['stored_blocks'], 5)
+		self.assertEqual(stats['stored_blocks'] + stats['shared_blocks'], 200)
+
+	def test_removeShouldKeepBlocksStillInUse(self):
+		self.store.put(self.a, 0, 'abcd')
+		self.store.put(self.b, 0, 'abcd')
+
+		self.assertEqual(self.store.remove(self.a, 0), 0)
+		self.assertEqual(self._stored(), 1)
+
+		self.assertTrue(self.store.remove(self.b, 0) > 0)
+		self.assertEqual(self._stored(), 0)
+
+	def test_removeAllShouldRemoveDirectory(self):
+		self.store.put(self.a, 0, 'abcd')
+		self.store.put(self.a, 1, 'ef')
+
+		self.store.remove_all(self.a)
+
+		self.assertFalse(os.path.exists(self.a))
+		self.assertEqual(self._stored(), 0)
+
+	def test_isStaleShouldDetectChangedBlockSize(self):
+		self.assertFalse(self.store.is_stale(self.a))
+		self.assertFalse(self.store.is_stale(os.path.join(self.dir, 'missing')))
+		self.assertTrue(BlockStore(self.dir, 8).is_stale(self.a))
+
+	def test_isStaleShouldDetectUnavailableCodec(self):
+		with open(os.path.join(self.a, 'block_size'), 'w') as f:
+			f.write('4 nonsense')
+
+		self.assertTrue(self.store.is_stale(self.a))
+
+	def test_linkTwinShouldShareBlocksOfSameOriginFile(self):
+		stat = Mock(st_dev = 1, st_ino = 2, st_size = 8, st_mtime = 3)
+		self.store.register(stat, self.a)
+		self.store.put(self.a, 0, 'abcd')
+
+		self.assertTrue(self.store.link_twin(stat, self.b, 0))
+		self.assertFalse(self.store.link_twin(stat, self.b, 1))
+		self.assertEqual(open(os.path.join(self.b, '0')).read(), 'abcd')
+
+class BlockStoreCachedFileTest(unittest.TestCase):
+	def create_store(self):
+		return BlockStore(self.dir, 4)
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.store = self.create_store()
+
+		self.fh = self._create_file(self.store, 'f', 10)
+
+	def _create_file(self, store, name, size):
+		coverage = CoverageMap.open(os.path.join(self.dir, name + '.coverage'))
+		stat = Mock(st_dev = 1, st_ino = 2, st_size = size, st_mtime = 3)
+
+		fh = BlockStoreCachedFile('/' + name, os.path.join(self.dir, name + '.blocks'),
+			coverage, stat, None, store)
+		fh.create_data_file()
+
+		return fh
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_readShouldReturnWrittenBlocks(self):
+		self.fh.write(0, 'abcdefgh')
+		self.fh.write(8, 'ij')
+
+		self.assertEqual(self.fh.read(2, 8), 'cdefghij')
+
+	def test_readShouldReturnZeroesForMissingBlocks(self):
+		self.fh.write(4, 'efgh')
+
+		self.assertEqual(self.fh.read(2, 8), '\0\0efgh\0\0')
+
+	def test_writeShouldRejectUnalignedOffsets(self):
+		self.assertRaises(ValueError, self.fh.write, 2, 'cd')
+
+	def test_discardShouldOnlyRemoveWholeBlocks(self):
+		self.fh.write(0, 'abcdefghij')
+		self.fh.coverage.add(0, 10)
+
+		self.fh.discard(2, 10)
+
+		self.assertEqual(self.store.indexes(self.fh.data_path), [ 0 ])
+		self.assertEqual(list(self.fh.coverage.ranges.pairs()), [ (0, 2) ])
+
+class CompressedBlockStoreCachedFileTest(BlockStoreCachedFileTest):
+	def create_store(self):
+		return BlockStore(os.path.join(self.dir), 4, ZlibCodec(), threads = 2)
+
+	def test_writeShouldCompressCompressibleFiles(self):
+		store = BlockStore(self.dir, 100, ZlibCodec())
+		fh = self._create_file(store, 'g', 200)
+
+		fh.write(0, 'a' * 200)
+
+		self.assertEqual(store.read_marker(fh.data_path), (100, 'zlib'))
+		self.assertEqual(store.stats()['compressed_files'], 1)
+		self.assertEqual(fh.read(50, 100), 'a' * 100)
+
+	def test_writeShouldNotCompressIncompressibleFiles(self):
+		store = BlockStore(self.dir, 100, ZlibCodec())
+		fh = self._create_file(store, 'g', 200)
+
+		fh.write(0, os.urandom(200))
+
+		self.assertEqual(store.read_marker(fh.data_path), (100, None))
+		self.assertEqual(store.stats()['uncompressed_files'], 1)
@@ -0,0 +1,181 @@
+import unittest
+from mock import (Mock, patch)
+import mmap, os, shutil, tempfile
+
+from pcachefs import sparse
+
+from pcachefs.cachedfile import CachedFile
+from pcachefs.coveragemap import CoverageMap
+
+class CachedFileTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _create_file(self, size, use_mmap = True, open_origin = None):
+		coverage = CoverageMap.open(os.path.join(self.dir, 'f.coverage'))
+		stat = Mock(st_size = size)
+
+		fh = CachedFile('/f', os.path.join(self.dir, 'cache.data'), coverage, stat, open_origin, use_mmap)
+		fh.create_data_file()
+
+		return fh
+
+	def test_readShouldUseMappingOfCacheData(self):
+		fh = self._create_file(10)
+		fh.write(0, 'abcdefghij')
+
+		self.assertEqual(fh.read(2, 4), 'cdef')
+		self.assertNotEqual(fh._map, None)
+
+	def test_readShouldSeeWritesMadeAfterMapping(self):
+		fh = self._create_file(10)
+		fh.write(0, 'abcde')
+		fh.read(0, 5)
+
+		fh.write(5, 'fghij')
+
+		self.assertEqual(fh.read(3, 7), 'defghij')
+
+	def test_invalidateShouldUnmapBeforeTruncating(self):
+		fh = self._create_file(10)
+		fh.write(0, 'abcdefghij')
+		fh.read(0, 10)
+
+		fh.invalidate(Mock(st_size = 4))
+		fh.write(0, 'wxyz')
+
+		self.assertEqual(fh.read(0, 4), 'wxyz')
+
+	def test_readShouldFallBackWhenMappingFails(self):
+		fh = self._create_file(10)
+		fh.write(0, 'abcdefghij')
+
+		with patch.object(mmap, 'mmap', Mock(side_effect = EnvironmentError('not supported'))):
+			self.assertEqual(fh.read(2, 4), 'cdef')
+
+		self.assertEqual(fh._map, None)
+		self.assertEqual(fh.read(6, 4), 'ghij')
+
+	def test_readShouldNotMapWhenDisabled(self):
+		fh = self._create_file(10, use_mmap = False)
+		fh.write(0, 'abcdefghij')
+
+		self.assertEqual(fh.read(2, 4), 'cdef')
+		self.assertEqual(fh._map, None)
+
+	def test_closeShouldUnmap(self):
+		fh = self._create_file(10)
+		fh.write(0, 'abcdefghij')
+		fh.read(0, 10)
+		m = fh._map
+
+		fh.close()
+
+		self.assertRaises(ValueError, len, m)
+
+	def test_openShouldForgetCoverageWithoutCacheData(self):
+		fh = self._create_file(10)
+		fh.write(0, 'abcdefghij')
+		fh.coverage.mark_dirty(0, 10)
+		fh.close()
+		os.remove(os.path.join(self.dir, 'cache.data'))
+
+		coverage = CoverageMap.open(os.path.join(self.dir, 'f.coverage'))
+		fh = CachedFile('/f', os.path.join(self.dir, 'cache.data'), coverage, Mock(st_size = 10), None)
+
+		self.assertFalse(fh.is_cached(0, 10))
+		self.assertFalse(fh.coverage.is_dirty(0, 10))
+		self.assertEqual(list(CoverageMap.open(os.path.join(self.dir, 'f.coverage')).ranges.pairs()), [])
+
+	def test_readShouldRaiseIOErrorWithoutCacheData(self):
+		coverage = CoverageMap.open(os.path.join(self.dir, 'f.coverage'))
+		fh = CachedFile('/f', os.path.join(self.dir, 'cache.data'), coverage, Mock(st_size = 10), None)
+
+		self.assertRaises(IOError, fh.read, 0, 5)
+
+	def test_acquireOriginShouldReuseReleasedOrigins(self):
+		open_origin = Mock(side_effect = lambda: Mock())
+		fh = self._create_file(10, open_origin = open_origin)
+
+		first = fh.acquire_origin()
+		fh.release_origin(first)
+
+		self.assertTrue(fh.acquire_origin() is first)
+		self.assertEqual(open_origin.call_count, 1)
+
+	def test_acquireOriginShouldOpenAnotherWhileOneIsInUse(self):
+		open_origin = Mock(side_effect = lambda: Mock())
+		fh = self._create_file(10, open_origin = open_origin)
+
+		first = fh.acquire_origin()
+		second = fh.acquire_origin()
+
+		self.assertFalse(first is second)
+		self.assertEqual(open_origin.call_count, 2)
+
+	def test_closeShouldCloseOriginsAndCacheData(self):
+		fh = self._create_file(10, open_origin = lambda: Mock())
+		origins = [ fh.acquire_origin(), fh.acquire_origin() ]
+		for origin in origins:
+			fh.release_origin(origin)
+
+		fh.close()
+
+		for origin in origins:
+			self.assertTrue(origin.close.called)
+		self.assertFalse(fh.has_data_file())
+
+	def test_invalidateShouldCloseOriginsSoTheyAreReopened(self):
+		open_origin = Mock(side_effect = lambda: Mock())
+		fh = self._create_file(10, open_origin = open_origin)
+		origin = fh.acquire_origin()
+		fh.release_origin(origin)
+
+		fh.invalidate(Mock(st_size = 10))
+
+		self.assertTrue(origin.close.called)
+		self.assertFalse(fh.acquire_origin() is origin)
+		self.assertEqual(open_origin.call_count, 2)
+
+	def test_createDataFileShouldCreateSparseFile(self):
+		fh = self._create_file(1024 * 1024)
+
+		st = os.stat(fh.data_path)
+		self.assertEqual(st.st_size, 1024 * 1024)
+		self.assertTrue(st.st_blocks * 512 < 256 * 1024)
+
+	def test_createDataFileShouldHandleZeroLengthFiles(self):
+		fh = self._create_file(0)
+
+		self.assertTrue(fh.has_data_file())
+		self.assertEqual(os.stat(fh.data_path).st_size, 0)
+		self.assertEqual(fh.read(0, 0), '')
+
+	def test_discardShouldClearCoverageAndFreeSpace(self):
+		fh = self._create_file(65536)
+		fh.write(0, 'x' * 65536)
+		fh.coverage.add(0, 65536)
+		fh.coverage.flush()
+		fh.flush()
+		os.fsync(fh._data_file.fileno())
+
+		freed = fh.discard(0, 32768)
+
+		self.assertEqual(list(fh.coverage.ranges.pairs()), [ (32768, 65536) ])
+		if freed is None:
+			self.skipTest('the filesystem holding ' + self.dir + ' cannot punch holes')
+		self.assertTrue(freed >= 32768)
+		self.assertEqual(fh.read(0, 4), '\0' * 4)
+
+	def test_discardShouldClearCoverageWhenHolesCannotBePunched(self):
+		fh = self._create_file(10)
+		fh.write(0, 'abcdefghij')
+		fh.coverage.add(0, 10)
+
+		with patch.object(sparse, 'punch_hole', Mock(return_value = False)):
+			self.assertEqual(fh.discard(0, 5), None)
+
+		self.assertEqual(list(fh.coverage.ranges.pairs()), [ (5, 10) ])
@@ -1,8 +1,17 @@
 import unittest
 from mockito import (when, mock, verify, any)
+from mock import Mock
 
-import os, pcachefs
+import errno, os, shutil, tempfile, threading, time, pcachefs
 import pcachefs.pcachefs as pcachefsinternal
+from pcachefs.tracing import (Tracer, RingBufferSink)
+from pcachefs.memorycache import LRUMemoryCache
+from pcachefs.admission import NthAccessAdmission
+from pcachefs.ranges import Range
+from pcachefs.compression import ZlibCodec
+from pcachefs import sparse
+from pcachefs.evictor import BUSY
+from pcachefs.metadata import SqliteMetadataStore
 
 class CacherTest(unittest.TestCase):
 	def test_shouldCreateCacheDirectoryOnInitIfNoneExists(self):
@@ -58,3 +67,770 @@ class CacherTest(unittest.TestCase):
 		self.assertTrue(False) ## TODO
 
 		data_range = file_handle_mocks()
+
+# Base for tests of a Cacher over real origin and cache directories, which
+# are created afresh for each test and removed afterwards
+class CacherFsTestCase(unittest.TestCase):
+	def setUp(self):
+		# undo the module patching done by CacherTest
+		import __builtin__
+		pcachefsinternal.os = os
+		pcachefsinternal.__builtin__ = __builtin__
+
+		self.origin = tempfile.mkdtemp()
+		self.cachedir = tempfile.mkdtemp()
+		self._cachers = []
+
+	def tearDown(self):
+		for cacher in self._cachers:
+			cacher.close()
+
+		shutil.rmtree(self.origin)
+		shutil.rmtree(self.cachedir)
+
+	def _write(self, path, data):
+		with open(self.origin + path, 'wb') as f:
+			f.write(data)
+
+	# Return a Cacher over the cache directory, reading from ufs (the origin
+	# directory by default), which is closed when the test finishes
+	def _cacher(self, ufs = None, **kw):
+		if ufs is None:
+			ufs = pcachefs.UnderlyingFs(self.origin)
+
+		cacher = pcachefs.Cacher(self.cachedir, ufs, **kw)
+		self._cachers.append(cacher)
+		return cacher
+
+class CacherAlignTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self.cacher = self._cacher(block_size = 10)
+
+	def _align(self, pairs, file_size = 100):
+		ranges = [ Range(start, end) for (start, end) in pairs ]
+		return [ (r.start, r.end) for r in self.cacher._align_to_blocks(ranges, file_size) ]
+
+	def test_alignShouldWidenRangeWithinOneBlockToThatBlock(self):
+		self.assertEqual(self._align([ (12, 15) ]), [ (10, 20) ])
+		self.assertEqual(self._align([ (10, 20) ]), [ (10, 20) ])
+
+	def test_alignShouldCoverEveryBlockARangeCrosses(self):
+		self.assertEqual(self._align([ (15, 25) ]), [ (10, 30) ])
+		self.assertEqual(self._align([ (19, 21) ]), [ (10, 30) ])
+
+	def test_alignShouldStopAtEndOfFile(self):
+		self.assertEqual(self._align([ (92, 95) ], 97), [ (90, 97) ])
+		self.assertEqual(self._align([ (5, 10) ], 7), [ (0, 7) ])
+
+	def test_alignShouldMergeRangesInAdjacentOrSameBlocks(self):
+		self.assertEqual(self._align([ (0, 5), (10, 15) ]), [ (0, 20) ])
+		self.assertEqual(self._align([ (1, 2), (5, 6) ]), [ (0, 10) ])
+		self.assertEqual(self._align([ (0, 5), (30, 35) ]), [ (0, 10), (30, 40) ])
+
+	def test_alignShouldDropRangesBeyondEndOfFile(self):
+		self.assertEqual(self._align([ (50, 100) ], 50), [])
+		self.assertEqual(self._align([ (0, 5), (60, 70) ], 50), [ (0, 10) ])
+
+class CacherOpenFileTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'abcdefghij' * 10)
+
+		self.ufs = Mock(wraps = pcachefs.UnderlyingFs(self.origin))
+		self.cacher = self._cacher(self.ufs, block_size = 10)
+
+	def test_openShouldShareOneCachedFilePerPath(self):
+		fh = self.cacher.open('/f', os.O_RDONLY)
+		other = self.cacher.open('/f', os.O_RDONLY)
+
+		self.assertTrue(fh is other)
+		self.assertEqual(fh.refcount, 2)
+
+		self.cacher.release('/f', other)
+		self.cacher.release('/f', fh)
+
+	def test_releaseShouldCloseFileOnlyAfterLastHandle(self):
+		fh = self.cacher.open('/f', os.O_RDONLY)
+		self.cacher.open('/f', os.O_RDONLY)
+		self.cacher.read('/f', 5, 0, fh)
+
+		self.cacher.release('/f', fh)
+
+		self.assertTrue(fh.has_data_file())
+		self.assertEqual(self.cacher.read('/f', 5, 0, fh), 'abcde')
+
+		self.cacher.release('/f', fh)
+
+		self.assertFalse(fh.has_data_file())
+		self.assertEqual(fh.refcount, 0)
+		self.assertFalse('/f' in self.cacher._open_files)
+		self.assertFalse(self.cacher.open('/f', os.O_RDONLY) is fh)
+
+	def test_readsShouldShareOneOriginFile(self):
+		fh = self.cacher.open('/f', os.O_RDONLY)
+
+		self.cacher.read('/f', 5, 0, fh)
+		self.cacher.read('/f', 5, 50, fh)
+
+		self.assertEqual(self.ufs.open.call_count, 1)
+
+		origin = fh.acquire_origin()
+		fh.release_origin(origin)
+		self.cacher.release('/f', fh)
+
+		self.assertTrue(origin.closed)
+
+	def test_cachedReadsShouldNotOpenOrigin(self):
+		self.cacher.read('/f', 100, 0)
+		self.ufs.open.reset_mock()
+
+		fh = self.cacher.open('/f', os.O_RDONLY)
+		self.assertEqual(self.cacher.read('/f', 10, 20, fh), 'abcdefghij')
+		self.cacher.release('/f', fh)
+
+		self.assertFalse(self.ufs.open.called)
+
+	def test_readShouldRefetchWhenCacheDataIsMissing(self):
+		self.cacher.read('/f', 100, 0)
+		os.remove(os.path.join(self.cachedir, 'f', 'cache.data'))
+
+		self.assertEqual(self.cacher.read('/f', 10, 20), 'abcdefghij')
+		self.assertTrue(os.path.exists(os.path.join(self.cachedir, 'f', 'cache.data')))
+
+	def test_readWithoutHandleShouldReleaseItsReference(self):
+		self.cacher.read('/f', 5, 0)
+
+		self.assertEqual(self.cacher._open_files, {})
+
+class CacherCloseTest(CacherFsTestCase):
+	def _assertCloseStopsEveryThread(self, metadata = None):
+		self._write('/f', 'abcdefghij' * 10)
+		before = set(threading.enumerate())
+
+		if metadata is not None:
+			metadata = metadata(self.cachedir)
+
+		cacher = self._cacher(pcachefs.UnderlyingFs(self.origin, stat_threads = 2), block_size = 10,
+			readahead = 2, fetch_threads = 2, max_cache_size = 1000, write_back = True,
+			write_back_interval = 3600, metadata = metadata)
+		for offset in range(0, 100, 10):
+			cacher.read('/f', 10, offset)
+		list(cacher.readdir('/', 0))
+
+		cacher.close()
+
+		self.assertEqual(set(threading.enumerate()) - before, set())
+		self.assertEqual([ t.name for t in threading.enumerate() if t.name.startswith('pcachefs-') ], [])
+
+	def test_closeShouldStopEveryThread(self):
+		self._assertCloseStopsEveryThread()
+
+	def test_closeShouldStopEveryThreadWithSqliteStore(self):
+		self._assertCloseStopsEveryThread(SqliteMetadataStore)
+
+	def test_closeShouldStopCompressThreads(self):
+		before = set(threading.enumerate())
+
+		cacher = self._cacher(block_size = 10, codec = ZlibCodec())
+		cacher.close()
+
+		self.assertEqual(set(threading.enumerate()) - before, set())
+
+class CacherSparseTest(CacherFsTestCase):
+	SIZE = 1024 * 1024
+
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'abcdefgh' * (self.SIZE / 8))
+		self._write('/empty', '')
+
+		self.ufs = Mock(wraps = pcachefs.UnderlyingFs(self.origin))
+
+	def _allocated(self):
+		return os.stat(os.path.join(self.cachedir, 'f', 'cache.data')).st_blocks * 512
+
+	def test_cacheDataShouldOnlyUseSpaceForCachedBlocks(self):
+		cacher = self._cacher(self.ufs, block_size = 4096)
+
+		self.assertEqual(cacher.read('/f', 8, 8192), 'abcdefgh')
+
+		self.assertEqual(os.path.getsize(os.path.join(self.cachedir, 'f', 'cache.data')), self.SIZE)
+		self.assertTrue(self._allocated() < self.SIZE / 4)
+
+	def test_readShouldHandleZeroLengthFiles(self):
+		cacher = self._cacher(self.ufs, block_size = 4096)
+
+		self.assertEqual(cacher.read('/empty', 10, 0), '')
+		self.assertEqual(cacher.prefetch('/empty', 0, 10), 0)
+
+	def test_readShouldRefetchDiscardedData(self):
+		cacher = self._cacher(self.ufs, block_size = 4096)
+		cacher.read('/f', 8192, 0)
+		reads = self.ufs.read.call_count
+
+		cacher.discard('/f', 0, 4096)
+
+		self.assertEqual(list(cacher._open_coverage('/f').ranges.pairs()), [ (4096, 8192) ])
+		self.assertEqual(cacher.read('/f', 8, 4096), 'abcdefgh')
+		self.assertEqual(self.ufs.read.call_count, reads)
+
+		self.assertEqual(cacher.read('/f', 8, 8), 'abcdefgh')
+		self.assertEqual(self.ufs.read.call_count, reads + 1)
+
+	def test_openShouldPreallocateHotFiles(self):
+		cacher = self._cacher(self.ufs, block_size = 4096, preallocate_hot = 2)
+
+		fh = cacher.open('/f', os.O_RDONLY)
+		cacher.read('/f', 8, 0, fh)
+		cacher.release('/f', fh)
+		self.assertTrue(self._allocated() < self.SIZE / 4)
+
+		with open(os.path.join(self.cachedir, 'scratch'), 'wb') as f:
+			if not sparse.preallocate(f.fileno(), 0, 4096):
+				self.skipTest('the filesystem holding ' + self.cachedir + ' cannot preallocate')
+
+		fh = cacher.open('/f', os.O_RDONLY)
+
+		self.assertTrue(self._allocated() >= self.SIZE)
+		cacher.release('/f', fh)
+
+class CacherReadaheadTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'abcdefghij' * 20)
+
+		self.cacher = self._cacher(block_size = 10, readahead = 4, readahead_threads = 2)
+
+	def _cached(self):
+		return list(self.cacher._open_coverage('/f').ranges.pairs())
+
+	def test_sequentialReadsShouldPrefetchFollowingBlocks(self):
+		# the window opens at the third sequential read, and doubles with
+		# each read after that
+		for offset in range(0, 50, 10):
+			self.cacher.read('/f', 10, offset)
+			self.cacher.readahead.wait()
+
+		self.assertEqual(self._cached(), [ (0, 90) ])
+		self.assertEqual(self.cacher.stats()['prefetch.bytes'], 60)
+		self.assertEqual(self.cacher.stats()['readahead.prefetched_blocks'], 6)
+		self.assertEqual(self.cacher.read('/f', 40, 50), 'abcdefghij' * 4)
+
+	def test_randomReadsShouldNotPrefetch(self):
+		for offset in [ 150, 20, 110, 60, 0 ]:
+			self.cacher.read('/f', 10, offset)
+		self.cacher.readahead.wait()
+
+		self.assertEqual(self._cached(), [ (0, 10), (20, 30), (60, 70), (110, 120), (150, 160) ])
+		self.assertEqual(self.cacher.stats()['prefetch.bytes'], 0)
+
+class CacherRevalidationTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'abcdef')
+
+		self.cacher = self._cacher(stat_cache_size = 0, attr_ttl = 10, listing_ttl = 10)
+
+	def _expire(self, path):
+		os.utime(os.path.join(self.cachedir, path[1:], 'cache.stat'), (0, 0))
+
+	def test_getattrShouldServeCachedStatWithinTtl(self):
+		self.cacher.read('/f', 6, 0)
+		self._write('/f', 'abcdefgh')
+
+		self.assertEqual(self.cacher.getattr('/f').st_size, 6)
+		self.assertEqual(self.cacher.read('/f', 10, 0), 'abcdef')
+
+	def test_getattrShouldInvalidateChangedFileAfterTtl(self):
+		self.cacher.read('/f', 6, 0)
+		self._write('/f', 'ghijklmn')
+		self._expire('/f')
+
+		self.assertEqual(self.cacher.getattr('/f').st_size, 8)
+		self.assertEqual(self.cacher.read('/f', 10, 0), 'ghijklmn')
+
+	def test_getattrShouldKeepUnchangedFileAfterTtl(self):
+		self.cacher.read('/f', 6, 0)
+		self._expire('/f')
+
+		self.cacher.getattr('/f')
+
+		self.assertEqual(list(self.cacher._open_coverage('/f').ranges.pairs()), [ (0, 6) ])
+		self.assertTrue(time.time() - self.cacher.metadata.get_stat('/f')[1] < 10)
+
+	def test_getattrShouldForgetFileRemovedAfterTtl(self):
+		self.cacher.read('/f', 6, 0)
+		os.remove(self.origin + '/f')
+		self._expire('/f')
+
+		self.assertRaises(OSError, self.cacher.getattr, '/f')
+		self.assertEqual(self.cacher.metadata.get_stat('/f'), None)
+		self.assertFalse(os.path.exists(os.path.join(self.cachedir, 'f', 'cache.data')))
+
+	def test_getattrShouldInvalidateOpenFile(self):
+		fh = self.cacher.open('/f', os.O_RDONLY)
+		self.cacher.read('/f', 6, 0, fh)
+		self._write('/f', 'ghi')
+		self._expire('/f')
+
+		self.cacher.getattr('/f')
+
+		self.assertEqual(self.cacher.read('/f', 10, 0, fh), 'ghi')
+		self.cacher.release('/f', fh)
+
+	def test_readShouldStopAtNewEndIfInvalidatedMeanwhile(self):
+		fh = self.cacher.open('/f', os.O_RDONLY)
+		read_cached = self.cacher._read_cached
+
+		# the file shrinks at the origin and is invalidated after the data
+		# is read, and before the read checks it is still cached
+		def invalidate_then_read(fh, offset, end):
+			result = read_cached(fh, offset, end)
+			if fh.stat.st_size == 6:
+				self._write('/f', 'xyz')
+				self.cacher.invalidate('/f', self.cacher.underlying_fs.getattr('/f'))
+			return result
+
+		self.cacher._read_cached = invalidate_then_read
+
+		self.assertEqual(self.cacher.read('/f', 6, 0, fh), 'xyz')
+		self.assertEqual(self.cacher.read('/f', 2, 4, fh), '')
+		self.cacher.release('/f', fh)
+
+	def test_readdirShouldRefetchListingAfterTtl(self):
+		list(self.cacher.readdir('/', 0))
+		self._write('/g', '')
+		os.utime(os.path.join(self.cachedir, 'cache.list'), (0, 0))
+
+		self.assertTrue('g' in [ e.name for e in self.cacher.readdir('/', 0) ])
+
+class CacherNegativeLookupTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		os.mkdir(self.origin + '/d')
+
+		self.ufs = Mock(wraps = pcachefs.UnderlyingFs(self.origin))
+		self.cacher = self._cacher(self.ufs, negative_ttl = 10)
+
+	def _assertMissing(self, path):
+		try:
+			self.cacher.getattr(path)
+			self.fail('expected ENOENT for ' + path)
+		except OSError, e:
+			self.assertEqual(e.errno, errno.ENOENT)
+
+	def test_getattrShouldRememberMissingPaths(self):
+		self._assertMissing('/d/missing')
+		self._assertMissing('/d/missing')
+
+		self.assertEqual(self.ufs.getattr.call_count, 1)
+
+	def test_getattrShouldAnswerFromParentListing(self):
+		list(self.cacher.readdir('/d', 0))
+
+		self._assertMissing('/d/missing')
+
+		self.assertFalse(self.ufs.getattr.called)
+
+	def test_readdirShouldForgetMissingPathsWhichNowExist(self):
+		self._assertMissing('/d/new')
+		open(self.origin + '/d/new', 'wb').close()
+
+		list(self.cacher.readdir('/d', 0))
+
+		self.assertEqual(self.cacher.getattr('/d/new').st_size, 0)
+
+	def test_getattrShouldNotRememberMissingPathsWhenDisabled(self):
+		self.cacher = self._cacher(self.ufs)
+		list(self.cacher.readdir('/d', 0))
+
+		self.assertRaises(OSError, self.cacher.getattr, '/d/missing')
+		self.assertRaises(OSError, self.cacher.getattr, '/d/missing')
+
+		self.assertEqual(self.ufs.getattr.call_count, 2)
+
+class CacherReaddirStatsTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/a', 'a')
+		self._write('/b', 'b')
+
+		self.ufs = Mock(wraps = pcachefs.UnderlyingFs(self.origin))
+
+	def test_readdirShouldCacheStatsOfEntries(self):
+		cacher = self._cacher(self.ufs)
+
+		list(cacher.readdir('/', 0))
+
+		self.assertEqual(cacher.getattr('/a').st_size, 1)
+		self.assertEqual(cacher.getattr('/b').st_size, 1)
+		self.assertFalse(self.ufs.getattr.called)
+
+	def test_readdirShouldInvalidateEntriesWhichHaveChanged(self):
+		cacher = self._cacher(self.ufs, listing_ttl = 10)
+		list(cacher.readdir('/', 0))
+		cacher.read('/a', 1, 0)
+
+		self._write('/a', 'xyz')
+		os.utime(os.path.join(self.cachedir, 'cache.list'), (0, 0))
+		list(cacher.readdir('/', 0))
+
+		self.assertEqual(cacher.getattr('/a').st_size, 3)
+		self.assertEqual(cacher.read('/a', 3, 0), 'xyz')
+
+	def test_readdirShouldNotStatEntriesWhenDisabled(self):
+		cacher = self._cacher(self.ufs, readdir_stats = False)
+
+		list(cacher.readdir('/', 0))
+		cacher.getattr('/a')
+
+		self.assertEqual(self.ufs.getattr.call_count, 1)
+
+class CacherFetchTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self.data = ''.join([ chr(i % 256) for i in range(100) ])
+		self._write('/f', self.data)
+
+		self.ufs = pcachefs.UnderlyingFs(self.origin)
+
+		# count the origin reads in progress at once
+		self.active = 0
+		self.max_active = 0
+		self.lock = threading.Lock()
+		read = self.ufs.read
+
+		def slow_read(path, size, offset, fh = None):
+			with self.lock:
+				self.active += 1
+				self.max_active = max(self.max_active, self.active)
+			time.sleep(0.05)
+			with self.lock:
+				self.active -= 1
+			return read(path, size, offset, fh)
+
+		self.ufs.read = slow_read
+
+	def _cacheEveryOtherBlock(self, cacher):
+		for offset in range(0, 100, 20):
+			cacher.read('/f', 1, offset)
+
+	def test_readShouldFetchGapsConcurrently(self):
+		cacher = self._cacher(self.ufs, block_size = 10, fetch_threads = 4)
+		self._cacheEveryOtherBlock(cacher)
+		self.max_active = 0
+
+		self.assertEqual(cacher.read('/f', 100, 0), self.data)
+		self.assertTrue(self.max_active > 1)
+
+	def test_readShouldFetchGapsInTurnWithoutFetchThreads(self):
+		cacher = self._cacher(self.ufs, block_size = 10, fetch_threads = 0)
+		self._cacheEveryOtherBlock(cacher)
+
+		self.assertEqual(cacher.read('/f', 100, 0), self.data)
+		self.assertEqual(self.max_active, 1)
+
+	def _readConcurrently(self, cacher, reads):
+		results = [ None ] * len(reads)
+
+		def read(i, size, offset):
+			results[i] = cacher.read('/f', size, offset)
+
+		threads = [ threading.Thread(target = read, args = (i, size, offset)) for (i, (size, offset)) in enumerate(reads) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		return results
+
+	def test_concurrentMissesShouldFetchEachBlockOnce(self):
+		cacher = self._cacher(self.ufs, block_size = 10, fetch_threads = 0)
+
+		results = self._readConcurrently(cacher, [ (100, 0) ] * 4 + [ (5, 42) ])
+
+		self.assertEqual(results, [ self.data ] * 4 + [ self.data[42:47] ])
+		self.assertEqual(cacher.stats()['origin.read_bytes'], 100)
+		self.assertTrue(cacher.stats()['fetch.coalesced_blocks'] > 0)
+
+	def test_missesOnDifferentBlocksOfAFileShouldBeFetchedTogether(self):
+		cacher = self._cacher(self.ufs, block_size = 10, fetch_threads = 0)
+
+		results = self._readConcurrently(cacher, [ (10, 0), (10, 50) ])
+
+		self.assertEqual(results, [ self.data[0:10], self.data[50:60] ])
+		self.assertEqual(self.max_active, 2)
+
+class CacherDedupTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/a', 'x' * 100)
+		os.link(self.origin + '/a', self.origin + '/b')
+
+		self.ufs = Mock(wraps = pcachefs.UnderlyingFs(self.origin))
+		self.cacher = self._cacher(self.ufs, block_size = 10, dedup = True)
+
+	def test_readShouldStoreIdenticalBlocksOnce(self):
+		self.assertEqual(self.cacher.read('/a', 100, 0), 'x' * 100)
+
+		self.assertEqual(self.cacher.block_store.stats()['stored_blocks'], 1)
+		self.assertEqual(self.cacher.block_store.stats()['shared_blocks'], 9)
+
+	def test_readShouldShareBlocksOfSameOriginFile(self):
+		self.cacher.read('/a', 100, 0)
+		reads = self.ufs.read.call_count
+
+		self.assertEqual(self.cacher.read('/b', 100, 0), 'x' * 100)
+		self.assertEqual(self.ufs.read.call_count, reads)
+
+	def test_evictFileShouldRemoveBlocks(self):
+		self.cacher.read('/a', 100, 0)
+
+		self.assertTrue(self.cacher.evict_file('/a') > 0)
+		self.assertFalse(os.path.exists(os.path.join(self.cachedir, 'a', 'cache.blocks')))
+		self.assertEqual(self.cacher.read('/a', 100, 0), 'x' * 100)
+
+class CacherStatsTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'x' * 100)
+
+		self.cacher = self._cacher(block_size = 10)
+
+	def test_statsShouldCountBytesFromCacheAndOrigin(self):
+		self.cacher.read('/f', 5, 0)
+		self.cacher.read('/f', 20, 0)
+
+		stats = self.cacher.stats()
+
+		self.assertEqual(stats['read.hits'], 0)
+		self.assertEqual(stats['read.misses'], 2)
+		self.assertEqual(stats['read.bytes'], 25)
+		self.assertEqual(stats['read.bytes_from_origin'], 15)
+		self.assertEqual(stats['read.bytes_from_cache'], 10)
+		self.assertEqual(stats['origin.read_bytes'], 20)
+		self.assertEqual(stats['origin.read.count'], 2)
+
+	def test_statsShouldCountOperationHitsAndMisses(self):
+		list(self.cacher.readdir('/', 0))
+		list(self.cacher.readdir('/', 0))
+		self.cacher.getattr('/f')
+
+		stats = self.cacher.stats()
+
+		self.assertEqual(stats['readdir.misses'], 1)
+		self.assertEqual(stats['readdir.hits'], 1)
+		self.assertEqual(stats['getattr.hits'], 1)
+		self.assertEqual(stats['stat_cache.hits'], 1)
+
+class CacherTracingTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'x' * 100)
+
+		self.sink = RingBufferSink(100)
+		self.cacher = self._cacher(block_size = 10, tracer = Tracer([ self.sink ]))
+
+	def test_readShouldTraceEachStage(self):
+		self.cacher.read('/f', 5, 0)
+
+		names = set([ s['name'] for s in self.sink.spans() ])
+		for name in [ 'metadata.get_stat', 'origin.getattr', 'metadata.open_coverage', 'cacher.fill',
+				'cacher.find_gaps', 'origin.open', 'origin.read', 'cache.write', 'cache.read' ]:
+			self.assertIn(name, names)
+
+	def test_readShouldNotTraceWhenDisabled(self):
+		self.cacher.tracer.enabled = False
+
+		self.cacher.read('/f', 5, 0)
+
+		self.assertEqual(self.sink.spans(), [])
+
+class CacherMemoryCacheTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'abcdefghij' * 10)
+
+		self.memory_cache = LRUMemoryCache(1000)
+		self.cacher = self._cacher(block_size = 10, memory_cache = self.memory_cache)
+
+	def test_readShouldServeHotBlocksFromMemory(self):
+		fh = self.cacher.open('/f', os.O_RDONLY)
+		self.assertEqual(self.cacher.read('/f', 15, 5, fh), 'fghijabcdefghij')
+
+		fh.read = Mock(side_effect = AssertionError('read cache.data'))
+
+		self.assertEqual(self.cacher.read('/f', 12, 3, fh), 'defghijabcde')
+		self.assertEqual(self.memory_cache.stats()['blocks'], 2)
+		self.assertEqual(self.cacher.stats()['memory_cache.hits'], 2)
+
+	def test_readShouldNotKeepPartlyCachedBlocks(self):
+		fh = self.cacher.open('/f', os.O_RDONLY)
+		self.cacher.read('/f', 10, 0, fh)
+		self.memory_cache.invalidate('/f')
+		fh.coverage.remove(5, 10)
+		fh.coverage.flush()
+
+		self.assertEqual(self.cacher.read('/f', 3, 2, fh), 'cde')
+		self.assertEqual(self.memory_cache.get('/f', 0), None)
+
+	def test_invalidateShouldForgetBlocksInMemory(self):
+		self.cacher.read('/f', 10, 0)
+
+		self.cacher.invalidate('/f', self.cacher.getattr('/f'))
+
+		self.assertEqual(self.memory_cache.stats()['blocks'], 0)
+
+class CacherWriteBackTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'abcdefghij' * 10)
+
+		self.cacher = self._writeBackCacher(write_back = True)
+
+	def _writeBackCacher(self, **kw):
+		return self._cacher(block_size = 10, write_back_interval = 3600, **kw)
+
+	def _origin(self):
+		with open(self.origin + '/f', 'rb') as f:
+			return f.read()
+
+	def test_writeShouldOnlyReachOriginWhenWrittenBack(self):
+		fh = self.cacher.open('/f', os.O_RDWR)
+
+		self.assertEqual(self.cacher.write('/f', 'XYZ', 12, fh), 3)
+
+		self.assertEqual(self.cacher.read('/f', 10, 10, fh), 'abXYZfghij')
+		self.assertEqual(self._origin(), 'abcdefghij' * 10)
+		self.assertEqual(self.cacher.dirty_paths(), [ '/f' ])
+
+		self.assertEqual(self.cacher.write_back('/f'), 3)
+
+		self.assertEqual(self._origin()[10:20], 'abXYZfghij')
+		self.assertEqual(self.cacher.dirty_paths(), [])
+		self.assertEqual(self.cacher.stats()['write_back.writes'], 1)
+
+	def test_writeBackShouldCoalesceAdjacentWrites(self):
+		fh = self.cacher.open('/f', os.O_RDWR)
+		for i in range(10):
+			self.cacher.write('/f', 'XYZ', 30 + i * 3, fh)
+
+		self.cacher.write_back('/f')
+
+		self.assertEqual(self._origin()[30:60], 'XYZ' * 10)
+		self.assertEqual(self.cacher.stats()['write_back.writes'], 1)
+		self.assertEqual(self.cacher.stats()['write_back.bytes'], 30)
+
+	def test_writeShouldExtendAndTruncateShouldShrinkFile(self):
+		fh = self.cacher.open('/f', os.O_RDWR)
+
+		self.cacher.write('/f', 'end', 105, fh)
+
+		self.assertEqual(self.cacher.getattr('/f').st_size, 108)
+		self.assertEqual(self.cacher.read('/f', 10, 98, fh), 'ij\0\0\0\0\0end')
+
+		self.cacher.truncate('/f', 50, fh)
+
+		self.assertEqual(self.cacher.getattr('/f').st_size, 50)
+		self.assertEqual(self.cacher.read('/f', 100, 0, fh), 'abcdefghij' * 5)
+
+		self.cacher.write_back('/f')
+
+		self.assertEqual(self._origin(), 'abcdefghij' * 5)
+
+	def test_evictionShouldSkipDirtyData(self):
+		self.cacher.write('/f', 'XYZ', 12)
+
+		self.assertEqual(self.cacher.discard('/f', 10, 20), BUSY)
+		self.assertEqual(self.cacher.evict_file('/f'), BUSY)
+		self.assertEqual(self.cacher.read('/f', 5, 10), 'abXYZ')
+
+		self.cacher.write_back('/f')
+
+		self.assertNotEqual(self.cacher.discard('/f', 10, 20), None)
+
+	def test_revalidationShouldNotDiscardDirtyData(self):
+		self.cacher.attr_ttl = 0.001
+		self.cacher.write('/f', 'XYZ', 12)
+		time.sleep(0.01)
+
+		self.assertEqual(self.cacher.getattr('/f').st_size, 100)
+		self.assertEqual(self.cacher.read('/f', 5, 10), 'abXYZ')
+
+	def test_fsyncShouldWriteBackStraightAway(self):
+		fh = self.cacher.open('/f', os.O_RDWR)
+		self.cacher.write('/f', 'XYZ', 0, fh)
+
+		self.cacher.fsync('/f', fh)
+
+		self.assertEqual(self._origin()[0:5], 'XYZde')
+
+	def test_dirtyDataShouldBeWrittenBackAfterRestart(self):
+		self.cacher.write('/f', 'XYZ', 0)
+		self.cacher.metadata.close()
+
+		cacher = self._writeBackCacher()
+		self.assertEqual(cacher.dirty_paths(), [ '/f' ])
+		self.assertEqual(cacher.read('/f', 5, 0), 'XYZde')
+
+		cacher.close()
+
+		self.assertEqual(self._origin()[0:5], 'XYZde')
+
+	def test_readShouldStopAtNewEndIfTruncatedMeanwhile(self):
+		fh = self.cacher.open('/f', os.O_RDWR)
+		read_cached = self.cacher._read_cached
+
+		# the file is truncated after the data is read, and before the
+		# read checks it is still cached
+		def truncate_then_read(fh, offset, end):
+			result = read_cached(fh, offset, end)
+			if fh.stat.st_size == 100:
+				self.cacher.truncate('/f', 50, fh)
+			return result
+
+		self.cacher._read_cached = truncate_then_read
+
+		self.assertEqual(self.cacher.read('/f', 100, 0, fh), 'abcdefghij' * 5)
+		self.assertEqual(self.cacher.read('/f', 10, 60, fh), '')
+
+	def test_writeShouldFailUnlessWriteBackIsEnabled(self):
+		cacher = self._writeBackCacher()
+
+		self.assertEqual(cacher.write('/f', 'XYZ', 0), -errno.ENOSYS)
+		self.assertRaises(ValueError, self._writeBackCacher, write_back = True, dedup = True)
+
+class CacherAdmissionTest(CacherFsTestCase):
+	def setUp(self):
+		CacherFsTestCase.setUp(self)
+		self._write('/f', 'abcdefghij' * 10)
+
+		self.cacher = self._cacher(block_size = 10, admission = NthAccessAdmission(count = 2))
+
+	def _cached_files(self):
+		return sorted(os.listdir(os.path.join(self.cachedir, 'f')))
+
+	def test_readShouldBypassCacheUntilFileIsAdmitted(self):
+		fh = self.cacher.open('/f', os.O_RDONLY)
+
+		self.assertEqual(self.cacher.read('/f', 5, 12, fh), 'cdefg')
+		self.cacher.release('/f', fh)
+
+		self.assertEqual(self._cached_files(), [ 'cache.stat' ])
+		self.assertEqual(self.cacher.stats()['read.not_admitted'], 1)
+
+		fh = self.cacher.open('/f', os.O_RDONLY)
+		self.assertEqual(self.cacher.read('/f', 5, 12, fh), 'cdefg')
+		self.cacher.release('/f', fh)
+
+		self.assertEqual(self._cached_files(), [ 'cache.data', 'cache.data.coverage', 'cache.stat' ])
+		self.assertEqual(self.cacher.stats()['admission.admitted'], 1)
+
+	def test_filesAlreadyCachedShouldNotNeedAdmitting(self):
+		self.cacher.prefetch('/f', 0, 10)
+
+		fh = self.cacher.open('/f', os.O_RDONLY)
+
+		self.assertTrue(fh.admitted)
+		self.assertEqual(self.cacher.stats()['admission.rejected'], 0)
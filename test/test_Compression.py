@@ -0,0 +1,17 @@
+import unittest
+
+from pcachefs import compression
+
+class CompressionTest(unittest.TestCase):
+	def test_codecsShouldRoundTrip(self):
+		data = 'hello world ' * 100
+
+		for name in compression.CODECS:
+			codec = compression.create_codec(name)
+
+			self.assertEqual(codec.name, name)
+			self.assertTrue(len(codec.compress(data)) < len(data))
+			self.assertEqual(codec.decompress(codec.compress(data)), data)
+
+	def test_createCodecShouldRejectUnknownNames(self):
+		self.assertRaises(ValueError, compression.create_codec, 'nonsense')
@@ -0,0 +1,134 @@
+import unittest
+import os, pickle, shutil, tempfile
+
+from pcachefs.coveragemap import CoverageMap
+from pcachefs.ranges import (Range, Ranges)
+
+class CoverageMapTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'cache.data.coverage')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _pairs(self, coverage):
+		return list(coverage.ranges.pairs())
+
+	def test_openShouldReturnEmptyMapIfNoFileExists(self):
+		coverage = CoverageMap.open(self.path)
+
+		self.assertEqual(self._pairs(coverage), [])
+		self.assertFalse(os.path.exists(self.path))
+
+	def test_flushShouldPersistAddedRanges(self):
+		coverage = CoverageMap.open(self.path)
+		coverage.add(0, 10)
+		coverage.flush()
+		coverage.add(20, 30)
+		coverage.add(10, 15)
+		coverage.flush()
+
+		result = CoverageMap.open(self.path)
+
+		self.assertEqual(self._pairs(result), [ (0, 15), (20, 30) ])
+		self.assertEqual(result.journal_records, 2)
+
+	def test_flushShouldAppendToJournalRatherThanRewrite(self):
+		coverage = CoverageMap.open(self.path)
+		coverage.add(0, 10)
+		coverage.flush()
+		size = os.path.getsize(self.path)
+
+		coverage.add(20, 30)
+		coverage.flush()
+
+		self.assertEqual(os.path.getsize(self.path), size + CoverageMap.RECORD.size)
+
+	def test_flushShouldCompactLongJournal(self):
+		coverage = CoverageMap.open(self.path)
+		coverage.flush()
+
+		for i in range(CoverageMap.MIN_JOURNAL_RECORDS + 1):
+			coverage.add(i * 10, i * 10 + 10)
+			coverage.flush()
+
+		result = CoverageMap.open(self.path)
+
+		self.assertEqual(result.journal_records, 0)
+		self.assertEqual(self._pairs(result), [ (0, (CoverageMap.MIN_JOURNAL_RECORDS + 1) * 10) ])
+
+	def test_openShouldIgnoreTornJournalRecord(self):
+		coverage = CoverageMap.open(self.path)
+		coverage.add(0, 10)
+		coverage.flush()
+
+		with open(self.path, 'ab') as f:
+			f.write(CoverageMap.RECORD.pack(CoverageMap.RECORD_ADD, 20, 30)[:5])
+
+		result = CoverageMap.open(self.path)
+
+		self.assertEqual(self._pairs(result), [ (0, 10) ])
+		self.assertTrue(result.needs_compaction)
+
+	def test_openShouldMigrateLegacyPickledRanges(self):
+		legacy_path = os.path.join(self.dir, 'cache.data.range')
+		ranges = Ranges()
+		ranges.add_range(Range(0, 3))
+		ranges.add_range(Range(6, 10))
+
+		with open(legacy_path, 'wb') as f:
+			pickle.dump(ranges, f)
+
+		coverage = CoverageMap.open(self.path, legacy_path = legacy_path)
+
+		self.assertEqual(self._pairs(coverage), [ (0, 3), (6, 10) ])
+		self.assertFalse(os.path.exists(legacy_path))
+		self.assertEqual(self._pairs(CoverageMap.open(self.path)), [ (0, 3), (6, 10) ])
+
+	def test_removeShouldBeReplayedFromJournal(self):
+		coverage = CoverageMap.open(self.path)
+		coverage.add(0, 100)
+		coverage.flush()
+		coverage.remove(20, 40)
+		coverage.flush()
+
+		self.assertEqual(self._pairs(CoverageMap.open(self.path)), [ (0, 20), (40, 100) ])
+
+	def test_dirtyRangesShouldBeReplayedFromJournal(self):
+		coverage = CoverageMap.open(self.path)
+		coverage.add(0, 100)
+		coverage.flush()
+		coverage.mark_dirty(90, 120)
+		coverage.mark_clean(90, 100)
+		coverage.flush()
+
+		result = CoverageMap.open(self.path)
+
+		self.assertEqual(self._pairs(result), [ (0, 120) ])
+		self.assertEqual(list(result.dirty.pairs()), [ (100, 120) ])
+		self.assertTrue(result.is_dirty(110, 200))
+		self.assertFalse(result.is_dirty(0, 100))
+
+	def test_compactShouldKeepDirtyRanges(self):
+		coverage = CoverageMap.open(self.path)
+		coverage.mark_dirty(0, 10)
+		coverage.mark_dirty(20, 30)
+		coverage.flush()
+
+		result = CoverageMap.open(self.path)
+
+		self.assertEqual(result.journal_records, 0)
+		self.assertEqual(list(result.dirty.pairs()), [ (0, 10), (20, 30) ])
+
+	def test_compactShouldWriteVersion1WhenNothingIsDirty(self):
+		coverage = CoverageMap.open(self.path)
+		coverage.mark_dirty(0, 10)
+		coverage.mark_clean(0, 10)
+		coverage.flush()
+
+		with open(self.path, 'rb') as f:
+			(magic, version, count) = CoverageMap.HEADER.unpack(f.read(CoverageMap.HEADER.size))
+
+		self.assertEqual(version, CoverageMap.VERSION)
+		self.assertEqual(self._pairs(CoverageMap.open(self.path)), [ (0, 10) ])
@@ -0,0 +1,172 @@
+import unittest
+import os, shutil, tempfile
+from mock import (Mock, MagicMock, call, patch)
+
+from pcachefs.evictor import (Evictor, BUSY)
+
+class EvictorTest(unittest.TestCase):
+	def setUp(self):
+		self.cacher = Mock()
+		self.cacher.block_size = 10
+		self.cacher.discard = MagicMock(return_value = 10)
+
+		self.evictor = Evictor(self.cacher, max_cache_size = 20)
+
+	def test_evictShouldDoNothingWhenWithinLimit(self):
+		self.evictor.added('/a', 0, 20)
+
+		self.evictor.evict()
+
+		self.assertFalse(self.cacher.discard.called)
+
+	def test_evictShouldDiscardLeastRecentlyUsedBlocks(self):
+		self.evictor.added('/a', 0, 10)
+		self.evictor.added('/b', 0, 10)
+		self.evictor.touch('/a', 0, 10)
+		self.evictor.added('/c', 0, 10)
+
+		self.evictor.evict()
+
+		self.cacher.discard.assert_called_once_with('/b', 0, 10)
+		self.assertEqual(self.evictor.usage, 20)
+		self.assertEqual(self.evictor.evicted_blocks, 1)
+
+	def test_evictShouldEvictWholeFileIfHolesCannotBePunched(self):
+		self.cacher.discard = MagicMock(return_value = None)
+		self.cacher.evict_file = MagicMock(return_value = 20)
+
+		self.evictor.added('/a', 0, 20)
+		self.evictor.added('/b', 0, 10)
+
+		self.evictor.evict()
+
+		self.cacher.evict_file.assert_called_once_with('/a')
+		self.assertEqual(self.evictor.usage, 10)
+		self.assertEqual(self.evictor.stats()['tracked_blocks'], 1)
+
+	def test_evictShouldRetryOpenFilesLater(self):
+		self.cacher.discard = MagicMock(return_value = None)
+		self.cacher.evict_file = MagicMock(return_value = BUSY)
+
+		self.evictor.added('/a', 0, 30)
+
+		self.evictor.evict()
+
+		self.assertEqual(self.evictor.usage, 30)
+		self.assertEqual(self.evictor.stats()['tracked_blocks'], 3)
+
+	def test_evictShouldPassOverBusyBlocks(self):
+		self.cacher.discard = MagicMock(side_effect = lambda path, start, end: BUSY if path == '/a' else 10)
+
+		self.evictor.added('/a', 0, 20)
+		self.evictor.added('/b', 0, 20)
+		self.evictor.added('/c', 0, 10)
+
+		self.evictor.evict()
+
+		self.assertEqual(self.evictor.usage, 20)
+		self.assertFalse(self.cacher.evict_file.called)
+		self.assertEqual(list(self.evictor._blocks), [ ('/a', 0), ('/a', 1) ])
+
+	def test_evictShouldSkipBlockIfDiscardFails(self):
+		def discard(path, start, end):
+			if path == '/a':
+				raise OSError('origin unavailable')
+			return 10
+		self.cacher.discard = MagicMock(side_effect = discard)
+
+		self.evictor.added('/a', 0, 10)
+		self.evictor.added('/b', 0, 30)
+
+		self.evictor.evict()
+
+		self.assertEqual(self.evictor.usage, 20)
+		self.assertEqual(list(self.evictor._blocks), [ ('/b', 2) ])
+
+	def test_evictShouldKeepBlockIfEvictionFailsUnexpectedly(self):
+		self.cacher.discard = MagicMock(side_effect = ValueError('bug'))
+
+		self.evictor.added('/a', 0, 10)
+		self.evictor.added('/b', 0, 30)
+
+		self.assertRaises(ValueError, self.evictor.evict)
+
+		self.assertEqual(list(self.evictor._blocks), [ ('/a', 0), ('/b', 0), ('/b', 1), ('/b', 2) ])
+
+	def _statvfs(self, free):
+		return Mock(return_value = Mock(f_bavail = free, f_frsize = 1))
+
+	def test_addedShouldReuseRecentFreeSpaceReading(self):
+		evictor = Evictor(self.cacher, min_free_space = 100)
+
+		with patch('os.statvfs', self._statvfs(1000)) as statvfs:
+			for offset in range(0, 100, 10):
+				evictor.added('/a', offset, offset + 10)
+
+		self.assertEqual(statvfs.call_count, 1)
+		self.assertFalse(evictor._wakeup.is_set())
+
+	def test_addedShouldCountBytesAddedSinceReading(self):
+		evictor = Evictor(self.cacher, min_free_space = 950)
+
+		with patch('os.statvfs', self._statvfs(1000)) as statvfs:
+			evictor.added('/a', 0, 10)
+			self.assertFalse(evictor._wakeup.is_set())
+
+			evictor.added('/a', 10, 70)
+
+		self.assertEqual(statvfs.call_count, 1)
+		self.assertTrue(evictor._wakeup.is_set())
+
+	def test_addedShouldTakeNewReadingAfterEnoughBytes(self):
+		evictor = Evictor(self.cacher, min_free_space = 100)
+		evictor.FREE_SPACE_BYTES = 25
+
+		with patch('os.statvfs', self._statvfs(1000)) as statvfs:
+			for offset in range(0, 80, 10):
+				evictor.added('/a', offset, offset + 10)
+
+		self.assertEqual(statvfs.call_count, 3)
+
+	def test_evictShouldTakeFreshReadings(self):
+		evictor = Evictor(self.cacher, min_free_space = 100)
+		readings = [ self._statvfs(free)() for free in (1000, 50, 500) ]
+
+		with patch('os.statvfs', Mock(side_effect = readings)) as statvfs:
+			evictor.added('/a', 0, 20)
+			evictor.evict()
+
+		self.assertEqual(statvfs.call_count, 3)
+		self.cacher.discard.assert_called_once_with('/a', 0, 10)
+
+	def test_scanShouldKeepBytesAddedWhileScanning(self):
+		self.cacher.cachedir = tempfile.mkdtemp()
+		try:
+			os.mkdir(os.path.join(self.cacher.cachedir, 'f'))
+			with open(os.path.join(self.cacher.cachedir, 'f', 'cache.data'), 'wb') as f:
+				f.write('x' * 4096)
+			on_disk = os.stat(os.path.join(self.cacher.cachedir, 'f', 'cache.data')).st_blocks * 512
+
+			def open_coverage(path):
+				# a read fetches more data while the scan is running
+				self.evictor.added('/g', 0, 10)
+				return Mock(ranges = Mock(pairs = Mock(return_value = [ (0, 10) ])))
+			self.cacher.metadata.open_coverage = Mock(side_effect = open_coverage)
+
+			self.evictor._scan()
+
+			self.assertEqual(self.evictor.usage, on_disk + 10)
+		finally:
+			shutil.rmtree(self.cacher.cachedir)
+
+	def test_stopShouldEndBackgroundThread(self):
+		self.cacher.cachedir = tempfile.mkdtemp()
+		try:
+			self.evictor.start()
+			thread = self.evictor._thread
+
+			self.evictor.stop()
+
+			self.assertFalse(thread.is_alive())
+		finally:
+			os.rmdir(self.cacher.cachedir)
@@ -0,0 +1,54 @@
+import unittest
+from mock import (Mock, MagicMock)
+
+from pcachefs import lrucache
+
+class LRUCacheTest(unittest.TestCase):
+	def test_getShouldReturnStoredValue(self):
+		cache = lrucache.LRUCache(10)
+		cache.put('/a', 1)
+
+		self.assertEqual(cache.get('/a'), 1)
+		self.assertEqual(cache.hits, 1)
+		self.assertEqual(cache.misses, 0)
+
+	def test_getShouldCountMisses(self):
+		cache = lrucache.LRUCache(10)
+
+		self.assertEqual(cache.get('/a'), None)
+		self.assertEqual(cache.misses, 1)
+
+	def test_putShouldEvictLeastRecentlyUsed(self):
+		cache = lrucache.LRUCache(2)
+		cache.put('/a', 1)
+		cache.put('/b', 2)
+
+		# touch /a so /b becomes least recently used
+		cache.get('/a')
+		cache.put('/c', 3)
+
+		self.assertEqual(cache.get('/b'), None)
+		self.assertEqual(cache.get('/a'), 1)
+		self.assertEqual(cache.get('/c'), 3)
+		self.assertEqual(cache.evictions, 1)
+
+	def test_getShouldDiscardExpiredItems(self):
+		cache = lrucache.LRUCache(10, ttl = 5)
+
+		lrucache.time = Mock()
+		lrucache.time.time = MagicMock(return_value = 100)
+		cache.put('/a', 1)
+
+		lrucache.time.time = MagicMock(return_value = 106)
+		self.assertEqual(cache.get('/a'), None)
+		self.assertEqual(len(cache), 0)
+
+	def test_zeroSizeShouldStoreNothing(self):
+		cache = lrucache.LRUCache(0)
+		cache.put('/a', 1)
+
+		self.assertEqual(cache.get('/a'), None)
+
+	def tearDown(self):
+		import time
+		lrucache.time = time
@@ -0,0 +1,93 @@
+import unittest
+
+from pcachefs.memorycache import (LRUMemoryCache, ARCMemoryCache, create_memory_cache)
+
+class LRUMemoryCacheTest(unittest.TestCase):
+	def test_putShouldEvictLeastRecentlyUsedBlocksOverBudget(self):
+		cache = LRUMemoryCache(10)
+		cache.put('/a', 0, 'aaaa')
+		cache.put('/a', 1, 'bbbb')
+		cache.get('/a', 0)
+
+		cache.put('/b', 0, 'cccc')
+
+		self.assertEqual(cache.get('/a', 0), 'aaaa')
+		self.assertEqual(cache.get('/a', 1), None)
+		self.assertEqual(cache.get('/b', 0), 'cccc')
+		self.assertEqual(cache.bytes, 8)
+
+	def test_putShouldIgnoreBlocksLargerThanBudget(self):
+		cache = LRUMemoryCache(3)
+
+		cache.put('/a', 0, 'aaaa')
+
+		self.assertEqual(cache.bytes, 0)
+
+	def test_invalidateShouldRemoveEveryBlockOfPath(self):
+		cache = LRUMemoryCache(100)
+		cache.put('/a', 0, 'aaaa')
+		cache.put('/a', 1, 'bbbb')
+		cache.put('/b', 0, 'cccc')
+
+		cache.invalidate('/a')
+
+		self.assertEqual(cache.get('/a', 0), None)
+		self.assertEqual(cache.get('/b', 0), 'cccc')
+		self.assertEqual(cache.stats()['blocks'], 1)
+		self.assertEqual(cache.stats()['bytes'], 4)
+
+class ARCMemoryCacheTest(unittest.TestCase):
+	def test_putShouldKeepWithinBudget(self):
+		cache = ARCMemoryCache(40, 4)
+
+		for i in range(100):
+			cache.put('/a', i, 'xxxx')
+			cache.get('/a', i // 2)
+
+		self.assertTrue(cache.bytes <= 40)
+		self.assertEqual(cache.stats()['blocks'], 10)
+
+	def test_scanShouldNotEvictFrequentlyReadBlocks(self):
+		cache = ARCMemoryCache(40, 4)
+		for i in range(5):
+			cache.put('/hot', i, 'hhhh')
+			cache.get('/hot', i)
+
+		for i in range(1000):
+			if cache.get('/scan', i) is None:
+				cache.put('/scan', i, 'ssss')
+
+		for i in range(5):
+			self.assertEqual(cache.get('/hot', i), 'hhhh')
+
+	def test_lruShouldBePollutedByScan(self):
+		cache = LRUMemoryCache(40)
+		for i in range(5):
+			cache.put('/hot', i, 'hhhh')
+			cache.get('/hot', i)
+
+		for i in range(1000):
+			if cache.get('/scan', i) is None:
+				cache.put('/scan', i, 'ssss')
+
+		self.assertEqual(cache.get('/hot', 0), None)
+
+	def test_invalidateShouldRemoveBlocksFromBothLists(self):
+		cache = ARCMemoryCache(40, 4)
+		cache.put('/a', 0, 'aaaa')
+		cache.get('/a', 0)
+		cache.put('/a', 1, 'bbbb')
+
+		cache.invalidate('/a')
+
+		self.assertEqual(cache.bytes, 0)
+		self.assertEqual(cache.get('/a', 0), None)
+		self.assertEqual(cache.get('/a', 1), None)
+
+class CreateMemoryCacheTest(unittest.TestCase):
+	def test_createShouldRejectUnknownPolicy(self):
+		self.assertRaises(ValueError, create_memory_cache, 'fifo', 100, 10)
+
+	def test_createShouldReturnCacheOfPolicy(self):
+		self.assertEqual(create_memory_cache('lru', 100, 10).policy, 'lru')
+		self.assertEqual(create_memory_cache('arc', 100, 10).policy, 'arc')
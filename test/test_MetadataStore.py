@@ -0,0 +1,192 @@
+import unittest
+import os, shutil, tempfile, time
+
+from pcachefs import metadata
+
+class FileMetadataStoreTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.store = self.create_store()
+
+	def tearDown(self):
+		self.store.close()
+		shutil.rmtree(self.dir)
+
+	def create_store(self):
+		return metadata.FileMetadataStore(self.dir)
+
+	def reopen(self):
+		self.store.close()
+		self.store = self.create_store()
+
+	def test_getStatShouldReturnNoneIfNotStored(self):
+		self.assertEqual(self.store.get_stat('/missing'), None)
+
+	def test_statsShouldBeStored(self):
+		self.store.put_stat('/a', { 'st_size': 1 })
+		self.store.put_stats([ ('/b', { 'st_size': 2 }), ('/c/d', { 'st_size': 3 }) ])
+		self.reopen()
+
+		self.assertEqual(self.store.get_stat('/a')[0], { 'st_size': 1 })
+		self.assertEqual(self.store.get_stat('/b')[0], { 'st_size': 2 })
+		self.assertEqual(self.store.get_stat('/c/d')[0], { 'st_size': 3 })
+
+	def test_getStatShouldReturnTimeStored(self):
+		before = time.time()
+		self.store.put_stat('/a', { 'st_size': 1 })
+
+		self.assertTrue(self.store.get_stat('/a')[1] >= int(before))
+
+	def test_touchStatShouldUpdateTimeStored(self):
+		self.store.put_stat('/a', { 'st_size': 1 })
+		self._age_stat('/a')
+
+		self.store.touch_stat('/a')
+
+		self.assertTrue(self.store.get_stat('/a')[1] > time.time() - 60)
+
+	def test_removeStatShouldForgetStat(self):
+		self.store.put_stat('/a', { 'st_size': 1 })
+
+		self.store.remove_stat('/a')
+
+		self.assertEqual(self.store.get_stat('/a'), None)
+
+	def _age_stat(self, path):
+		os.utime(os.path.join(self.dir, path[1:], 'cache.stat'), (0, 0))
+
+	def test_listingsShouldBeStored(self):
+		self.store.put_listing('/', [ '.', '..', 'a' ])
+		self.reopen()
+
+		self.assertEqual(self.store.get_listing('/')[0], [ '.', '..', 'a' ])
+		self.assertEqual(self.store.get_listing('/other'), None)
+
+	def test_coverageShouldBeStored(self):
+		os.makedirs(os.path.join(self.dir, 'a'))
+
+		coverage = self.store.open_coverage('/a')
+		coverage.add(0, 10)
+		coverage.flush()
+		coverage.add(20, 30)
+		coverage.flush()
+		self.reopen()
+
+		self.assertEqual(list(self.store.open_coverage('/a').ranges.pairs()), [ (0, 10), (20, 30) ])
+
+	def test_removeCoverageShouldForgetCoverage(self):
+		os.makedirs(os.path.join(self.dir, 'a'))
+
+		coverage = self.store.open_coverage('/a')
+		coverage.add(0, 10)
+		coverage.flush()
+
+		self.store.remove_coverage('/a')
+
+		self.assertEqual(list(self.store.open_coverage('/a').ranges.pairs()), [])
+
+	def test_coverageShouldStoreDirtyRanges(self):
+		os.makedirs(os.path.join(self.dir, 'a'))
+
+		coverage = self.store.open_coverage('/a')
+		coverage.mark_dirty(0, 10)
+		coverage.flush()
+		coverage.compact()
+		coverage.mark_dirty(20, 30)
+		coverage.mark_clean(0, 5)
+		coverage.flush()
+		self.reopen()
+
+		result = self.store.open_coverage('/a')
+		self.assertEqual(list(result.ranges.pairs()), [ (0, 10), (20, 30) ])
+		self.assertEqual(list(result.dirty.pairs()), [ (5, 10), (20, 30) ])
+
+	def test_dirtyPathsShouldBeStored(self):
+		self.assertEqual(self.store.get_dirty_paths(), set())
+
+		self.store.set_dirty('/a', True)
+		self.store.set_dirty('/b/c', True)
+		self.store.set_dirty('/a', True)
+		self.store.set_dirty('/d', False)
+		self.store.set_dirty('/b/c', False)
+		self.reopen()
+
+		self.assertEqual(self.store.get_dirty_paths(), set([ '/a' ]))
+
+class SqliteMetadataStoreTest(FileMetadataStoreTest):
+	def create_store(self):
+		return metadata.SqliteMetadataStore(self.dir)
+
+	def _age_stat(self, path):
+		self.store._write('UPDATE stat SET cached_at = 0 WHERE path = ?', [ (path,) ])
+
+	def test_shouldKeepEverythingInOneFile(self):
+		self.store.put_stat('/a/b/c', { 'st_size': 1 })
+
+		self.assertFalse(os.path.exists(os.path.join(self.dir, 'a')))
+
+	def test_closeShouldStopCommitThread(self):
+		committer = self.store._committer
+
+		self.store.close()
+		self.store = self.create_store()
+
+		self.assertFalse(committer.is_alive())
+
+	# Replace the store with one which never commits on its own, so that
+	# only what the store commits itself survives crash()
+	def _use_batching_store(self):
+		self.store.close()
+		self.store = metadata.SqliteMetadataStore(self.dir, commit_interval = 3600)
+
+	# Drop the connection without committing, as if the process had been
+	# killed, and open the store again
+	def crash(self):
+		self.store._closed.set()
+		self.store._committer.join()
+		self.store._db.close()
+
+		self.store = self.create_store()
+
+	def test_removedCoverageShouldSurviveCrash(self):
+		self._use_batching_store()
+
+		coverage = self.store.open_coverage('/a')
+		coverage.add(0, 8192)
+		coverage.flush()
+		self.store.flush()
+
+		coverage.remove(0, 4096)
+		coverage.flush()
+		self.crash()
+
+		self.assertEqual(list(self.store.open_coverage('/a').ranges.pairs()), [ (4096, 8192) ])
+
+	def test_removeCoverageShouldSurviveCrash(self):
+		self._use_batching_store()
+
+		coverage = self.store.open_coverage('/a')
+		coverage.add(0, 8192)
+		coverage.flush()
+		self.store.flush()
+
+		self.store.remove_coverage('/a')
+		self.crash()
+
+		self.assertEqual(list(self.store.open_coverage('/a').ranges.pairs()), [])
+
+	def test_dirtyDataShouldSurviveCrash(self):
+		self._use_batching_store()
+
+		coverage = self.store.open_coverage('/a')
+		coverage.mark_dirty(0, 10)
+		coverage.flush()
+		self.store.set_dirty('/a', True)
+		self.crash()
+
+		self.assertEqual(self.store.get_dirty_paths(), set([ '/a' ]))
+		self.assertEqual(list(self.store.open_coverage('/a').dirty.pairs()), [ (0, 10) ])
+
+class CreateStoreTest(unittest.TestCase):
+	def test_shouldRejectUnknownStore(self):
+		self.assertRaises(ValueError, metadata.create_store, 'nosuchstore', '/tmp')
@@ -0,0 +1,79 @@
+import unittest
+import threading, time
+
+from pcachefs.locks import PathLocks
+
+class PathLocksTest(unittest.TestCase):
+	def setUp(self):
+		self.locks = PathLocks()
+
+	# Start a thread which holds path until released is set, setting the
+	# returned event once it has the lock
+	def _holdInThread(self, path, released):
+		acquired = threading.Event()
+
+		def run():
+			with self.locks.hold(path):
+				acquired.set()
+				released.wait()
+
+		t = threading.Thread(target = run)
+		t.daemon = True
+		t.start()
+
+		return (t, acquired)
+
+	def test_holdShouldSerialiseThreadsOnSamePath(self):
+		first_released = threading.Event()
+		second_released = threading.Event()
+		second_released.set()
+
+		(first, first_acquired) = self._holdInThread('/a', first_released)
+		self.assertTrue(first_acquired.wait(5))
+
+		(second, second_acquired) = self._holdInThread('/a', second_released)
+		self.assertFalse(second_acquired.wait(0.1))
+
+		first_released.set()
+
+		self.assertTrue(second_acquired.wait(5))
+		first.join()
+		second.join()
+
+	def test_holdShouldNotBlockOtherPaths(self):
+		released = threading.Event()
+		(t, acquired) = self._holdInThread('/a', released)
+		self.assertTrue(acquired.wait(5))
+
+		(other, other_acquired) = self._holdInThread('/b', released)
+		try:
+			self.assertTrue(other_acquired.wait(5))
+		finally:
+			released.set()
+		t.join()
+		other.join()
+
+	def test_holdShouldBeReentrant(self):
+		with self.locks.hold('/a'):
+			with self.locks.hold('/a'):
+				self.assertEqual(len(self.locks), 1)
+
+		self.assertEqual(len(self.locks), 0)
+
+	def test_lockShouldBeDiscardedAfterLastRelease(self):
+		released = threading.Event()
+		(first, first_acquired) = self._holdInThread('/a', released)
+		self.assertTrue(first_acquired.wait(5))
+		(second, second_acquired) = self._holdInThread('/a', released)
+
+		# the waiting thread keeps the entry alive too
+		while self.locks._locks['/a'][1] < 2:
+			time.sleep(0.01)
+		self.assertEqual(len(self.locks), 1)
+
+		released.set()
+		first.join()
+		second.join()
+
+		self.assertEqual(len(self.locks), 0)
+		self.assertTrue(second_acquired.is_set())
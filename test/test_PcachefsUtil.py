@@ -0,0 +1,21 @@
+import unittest
+
+from pcachefs.pcachefsutil import parse_size
+
+class ParseSizeTest(unittest.TestCase):
+	def test_parseSizeShouldAcceptPlainNumbers(self):
+		self.assertEqual(parse_size('4096'), 4096)
+		self.assertEqual(parse_size(4096), 4096)
+		self.assertEqual(parse_size(' 0 '), 0)
+
+	def test_parseSizeShouldApplySuffixes(self):
+		self.assertEqual(parse_size('128K'), 128 * 1024)
+		self.assertEqual(parse_size('1m'), 1024 ** 2)
+		self.assertEqual(parse_size('2G'), 2 * 1024 ** 3)
+		self.assertEqual(parse_size('1T'), 1024 ** 4)
+		self.assertEqual(parse_size('64KB'), 64 * 1024)
+		self.assertEqual(parse_size('1.5M'), 1536 * 1024)
+
+	def test_parseSizeShouldRejectInvalidSizes(self):
+		for s in [ '', 'K', 'abc', '12Q', '1.2.3M', None ]:
+			self.assertRaises(ValueError, parse_size, s)
@@ -0,0 +1,38 @@
+import unittest
+from mock import Mock
+
+import pcachefs
+from pcachefs import vfs
+
+class PersistentCacheFsTest(unittest.TestCase):
+	def _fs(self, write_back):
+		# only the state the FUSE handlers use, without parsing a command line
+		fs = pcachefs.PersistentCacheFs.__new__(pcachefs.PersistentCacheFs)
+		fs.cacher = Mock(write_back_enabled = write_back)
+
+		self.enabled = []
+		fs.vfs = vfs.VirtualFileFS('.pcachefs.')
+		fs.vfs.add_file(vfs.BooleanVirtualFile('cache_only',
+			callback_on_true = lambda: self.enabled.append(True),
+			callback_on_false = lambda: self.enabled.append(False)))
+
+		return fs
+
+	# echo 1 > .pcachefs.cache_only opens with O_TRUNC, and the kernel
+	# truncates through the open handle
+	def _ftruncateVirtualFile(self, write_back):
+		fs = self._fs(write_back)
+		fh = fs.open('/.pcachefs.cache_only', 0)
+
+		self.assertEqual(fs.ftruncate('/.pcachefs.cache_only', 0, fh), 0)
+		fs.write('/.pcachefs.cache_only', '1', 0, fh)
+		fs.release('/.pcachefs.cache_only', 0, fh)
+
+		self.assertEqual(self.enabled, [ True ])
+		self.assertFalse(fs.cacher.truncate.called)
+
+	def test_ftruncateShouldTruncateVirtualFile(self):
+		self._ftruncateVirtualFile(write_back = False)
+
+	def test_ftruncateShouldTruncateVirtualFileInWriteBackMode(self):
+		self._ftruncateVirtualFile(write_back = True)
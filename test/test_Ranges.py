@@ -0,0 +1,99 @@
+import unittest
+import pickle
+
+from pcachefs.ranges import (Range, Ranges)
+
+class RangesTest(unittest.TestCase):
+	def _ranges(self, *pairs):
+		ranges = Ranges()
+		for (start, end) in pairs:
+			ranges.add_range(Range(start, end))
+		return ranges
+
+	def _pairs(self, ranges):
+		return [ (r.start, r.end) for r in ranges.ranges ]
+
+	def test_addRangeShouldMergeOverlappingAndTouchingRanges(self):
+		ranges = self._ranges((0, 3), (6, 10), (7, 15), (3, 5))
+		self.assertEqual(self._pairs(ranges), [ (0, 5), (6, 15) ])
+
+		ranges.add_range(Range(5, 6))
+		ranges.add_range(Range(1, 3))
+		self.assertEqual(self._pairs(ranges), [ (0, 15) ])
+
+		self.assertEqual(ranges.start, 0)
+		self.assertEqual(ranges.end, 15)
+
+	def test_addRangeShouldMergeAcrossManyRanges(self):
+		ranges = self._ranges((0, 1), (2, 3), (4, 5), (6, 7), (20, 21))
+		ranges.add_range(Range(1, 6))
+
+		self.assertEqual(self._pairs(ranges), [ (0, 7), (20, 21) ])
+
+	def test_getUncoveredPortionsShouldReturnGaps(self):
+		ranges = self._ranges((0, 3), (5, 10), (12, 15))
+
+		result = ranges.get_uncovered_portions(Range(2, 13))
+
+		self.assertEqual([ (r.start, r.end) for r in result ], [ (3, 5), (10, 12) ])
+
+	def test_getUncoveredPortionsShouldReturnWholeRangeWhenEmpty(self):
+		result = Ranges().get_uncovered_portions(Range(2, 13))
+
+		self.assertEqual([ (r.start, r.end) for r in result ], [ (2, 13) ])
+
+	def test_getUncoveredPortionsShouldReturnNothingWhenCovered(self):
+		ranges = self._ranges((0, 100))
+
+		self.assertEqual(ranges.get_uncovered_portions(Range(10, 100)), [])
+
+	def test_containsShouldMatchNumbersAndRanges(self):
+		ranges = self._ranges((0, 3), (5, 10))
+
+		self.assertTrue(ranges.contains(3))
+		self.assertFalse(ranges.contains(4))
+		self.assertTrue(ranges.contains(Range(5, 10)))
+		self.assertFalse(ranges.contains(Range(2, 6)))
+
+	def test_shouldUnpickleOldListBasedRanges(self):
+		# Ranges as pickled before it was array-backed
+		state = { 'ranges': [ Range(0, 3), Range(6, 10) ], 'start': 0, 'end': 10 }
+		ranges = Ranges.__new__(Ranges)
+		ranges.__setstate__(state)
+
+		self.assertEqual(self._pairs(ranges), [ (0, 3), (6, 10) ])
+
+	def test_shouldRoundTripThroughPickle(self):
+		ranges = self._ranges((0, 3), (6, 10))
+
+		result = pickle.loads(pickle.dumps(ranges))
+
+		self.assertEqual(self._pairs(result), [ (0, 3), (6, 10) ])
+
+	def test_removeShouldTrimAndSplitRanges(self):
+		ranges = self._ranges((0, 10), (20, 30), (40, 50))
+
+		ranges.remove(5, 45)
+
+		self.assertEqual(self._pairs(ranges), [ (0, 5), (45, 50) ])
+
+		ranges.remove(46, 48)
+
+		self.assertEqual(self._pairs(ranges), [ (0, 5), (45, 46), (48, 50) ])
+
+	def test_removeShouldIgnoreUncoveredRange(self):
+		ranges = self._ranges((0, 10), (20, 30))
+
+		ranges.remove(10, 20)
+
+		self.assertEqual(self._pairs(ranges), [ (0, 10), (20, 30) ])
+
+	def test_overlapsShouldIgnoreTouchingRanges(self):
+		ranges = self._ranges((10, 20), (30, 40))
+
+		self.assertTrue(ranges.overlaps(15, 16))
+		self.assertTrue(ranges.overlaps(0, 11))
+		self.assertTrue(ranges.overlaps(19, 31))
+		self.assertFalse(ranges.overlaps(0, 10))
+		self.assertFalse(ranges.overlaps(20, 30))
+		self.assertFalse(ranges.overlaps(40, 50))
@@ -0,0 +1,86 @@
+import unittest
+import threading, time
+
+from pcachefs.readahead import Readahead
+
+class ReadaheadTest(unittest.TestCase):
+	def setUp(self):
+		self.fetched = []
+		self.readahead = Readahead(self._fetch, 100, 4, num_threads = 1)
+
+	def _fetch(self, path, start, end):
+		self.fetched.append((path, start, end))
+
+	def _wait(self, path):
+		for task in self.readahead._states.get(path, count = False).tasks:
+			task.wait()
+
+	def test_shouldNotPrefetchForFirstReads(self):
+		self.readahead.record('/f', 0, 100, 10000)
+		self.readahead.record('/f', 100, 200, 10000)
+		self._wait('/f')
+
+		self.assertEqual(self.fetched, [])
+
+	def test_shouldPrefetchFollowingBlocksWhenSequential(self):
+		for offset in (0, 100, 200):
+			self.readahead.record('/f', offset, offset + 100, 10000)
+		self._wait('/f')
+
+		self.assertEqual(self.fetched, [ ('/f', 300, 400) ])
+
+	def test_shouldGrowWindowUpToMaximum(self):
+		for offset in range(0, 800, 100):
+			self.readahead.record('/f', offset, offset + 100, 10000)
+		self._wait('/f')
+
+		# window grows 1, 2, 4, 4, ... blocks ahead of the last read
+		self.assertEqual(self.fetched[-1], ('/f', 1100, 1200))
+
+	def test_shouldNotPrefetchBeyondEndOfFile(self):
+		for offset in range(0, 400, 100):
+			self.readahead.record('/f', offset, offset + 100, 450)
+		self._wait('/f')
+
+		self.assertEqual(self.fetched[-1], ('/f', 400, 450))
+
+	def test_randomAccessShouldCancelQueuedPrefetches(self):
+		# block the single worker so prefetches stay queued
+		release = threading.Event()
+		self.readahead._pool.submit(release.wait)
+
+		for offset in (0, 100, 200, 300):
+			self.readahead.record('/f', offset, offset + 100, 10000)
+
+		self.readahead.record('/f', 5000, 5100, 10000)
+		release.set()
+		self.readahead._pool.submit(lambda: None).wait()
+
+		self.assertEqual(self.fetched, [])
+		self.assertTrue(self.readahead.cancelled_blocks > 0)
+
+	def test_shutdownShouldSkipQueuedPrefetches(self):
+		started = threading.Event()
+		release = threading.Event()
+
+		def fetch(path, start, end):
+			started.set()
+			release.wait()
+			self.fetched.append((path, start, end))
+
+		self.readahead.fetch = fetch
+		for i in range(4):
+			self.readahead.record('/f', i * 100, (i + 1) * 100, 10000)
+		started.wait()
+
+		shutdown = threading.Thread(target = self.readahead.shutdown)
+		shutdown.start()
+		while not self.readahead._stopped:
+			time.sleep(0.01)
+		release.set()
+		shutdown.join()
+
+		self.readahead.record('/f', 400, 500, 10000)
+
+		self.assertEqual(len(self.fetched), 1)
+		self.assertEqual(self.readahead._pool.pending(), 0)
@@ -0,0 +1,89 @@
+import unittest
+from mock import (Mock, patch)
+import errno, os, shutil, tempfile
+
+from pcachefs import sparse
+
+class SparseTest(unittest.TestCase):
+	SIZE = 1024 * 1024
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.f = open(os.path.join(self.dir, 'cache.data'), 'w+b')
+		self.fd = self.f.fileno()
+
+	def tearDown(self):
+		self.f.close()
+		shutil.rmtree(self.dir)
+
+	def _fill(self):
+		self.f.write('x' * self.SIZE)
+		self.f.flush()
+		os.fsync(self.fd)
+
+	def test_allocateSparseShouldSizeFileWithoutUsingSpace(self):
+		sparse.allocate_sparse(self.fd, self.SIZE)
+
+		self.assertEqual(os.fstat(self.fd).st_size, self.SIZE)
+		self.assertTrue(sparse.allocated_bytes(self.fd) < self.SIZE / 4)
+		self.assertEqual(self.f.read(), '\0' * self.SIZE)
+
+	def test_allocateSparseShouldHandleZeroLengthFiles(self):
+		self._fill()
+
+		sparse.allocate_sparse(self.fd, 0)
+
+		self.assertEqual(os.fstat(self.fd).st_size, 0)
+		self.assertEqual(sparse.allocated_bytes(self.fd), 0)
+
+	def test_punchHoleShouldFreeSpaceAndReadAsZeroes(self):
+		self._fill()
+		before = sparse.allocated_bytes(self.fd)
+
+		if not sparse.punch_hole(self.fd, 0, self.SIZE / 2):
+			self.skipTest('the filesystem holding ' + self.dir + ' cannot punch holes')
+
+		self.assertTrue(sparse.allocated_bytes(self.fd) <= before - self.SIZE / 2)
+		self.assertEqual(os.fstat(self.fd).st_size, self.SIZE)
+
+		self.f.seek(0)
+		data = self.f.read()
+		self.assertEqual(data, '\0' * (self.SIZE / 2) + 'x' * (self.SIZE / 2))
+
+	def test_punchHoleShouldReportWhenUnsupported(self):
+		self._fill()
+
+		with patch.object(sparse, '_fallocate', None):
+			self.assertFalse(sparse.punch_hole(self.fd, 0, self.SIZE))
+
+		with patch.object(sparse, '_fallocate', Mock(return_value = -1)):
+			with patch.object(sparse.ctypes, 'get_errno', Mock(return_value = errno.EOPNOTSUPP)):
+				self.assertFalse(sparse.punch_hole(self.fd, 0, self.SIZE))
+
+			with patch.object(sparse.ctypes, 'get_errno', Mock(return_value = errno.EBADF)):
+				self.assertRaises(OSError, sparse.punch_hole, self.fd, 0, self.SIZE)
+
+		self.assertFalse(sparse.punch_hole(self.fd, 0, 0))
+		self.f.seek(0)
+		self.assertEqual(self.f.read(), 'x' * self.SIZE)
+
+	def test_preallocateShouldReserveSpace(self):
+		sparse.allocate_sparse(self.fd, self.SIZE)
+
+		if not sparse.preallocate(self.fd, 0, self.SIZE):
+			self.skipTest('the filesystem holding ' + self.dir + ' cannot preallocate')
+
+		self.assertTrue(sparse.allocated_bytes(self.fd) >= self.SIZE)
+		self.assertEqual(os.fstat(self.fd).st_size, self.SIZE)
+
+	def test_preallocateShouldReportWhenUnsupported(self):
+		with patch.object(sparse, '_posix_fallocate', None):
+			self.assertFalse(sparse.preallocate(self.fd, 0, self.SIZE))
+
+		with patch.object(sparse, '_posix_fallocate', Mock(return_value = errno.EOPNOTSUPP)):
+			self.assertFalse(sparse.preallocate(self.fd, 0, self.SIZE))
+
+		with patch.object(sparse, '_posix_fallocate', Mock(return_value = errno.ENOSPC)):
+			self.assertRaises(OSError, sparse.preallocate, self.fd, 0, self.SIZE)
+
+		self.assertFalse(sparse.preallocate(self.fd, 0, 0))
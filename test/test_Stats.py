@@ -0,0 +1,36 @@
+import unittest
+
+from pcachefs.stats import (Histogram, Stats, format_stats)
+
+class StatsTest(unittest.TestCase):
+	def test_addShouldAccumulateCounters(self):
+		stats = Stats()
+
+		stats.add('a')
+		stats.add('a', 4)
+		stats.add('b', 0)
+
+		self.assertEqual(stats.values(), { 'a': 5, 'b': 0 })
+
+	def test_histogramShouldCountCumulativeBuckets(self):
+		histogram = Histogram((0.001, 0.01))
+
+		for seconds in (0.0005, 0.001, 0.005, 1):
+			histogram.record(seconds)
+
+		self.assertEqual(histogram.values('h'), {
+			'h.count': 4,
+			'h.sum_ms': 1006,
+			'h.le_1ms': 2,
+			'h.le_10ms': 3,
+			'h.le_inf': 4 })
+
+	def test_recordShouldCreateHistograms(self):
+		stats = Stats()
+
+		stats.record('origin.read', 0.0002)
+
+		self.assertEqual(stats.values()['origin.read.le_0.25ms'], 1)
+
+	def test_formatStatsShouldSortByName(self):
+		self.assertEqual(format_stats({ 'b': 2, 'a': 1 }), 'a 1\nb 2\n')
@@ -0,0 +1,114 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from pcachefs.tracing import (Tracer, RingBufferSink, JsonLinesSink, SamplingProfiler, NULL_SPAN)
+
+class TracerTest(unittest.TestCase):
+	def test_spanShouldDoNothingWhenDisabled(self):
+		sink = RingBufferSink(10)
+		tracer = Tracer([ sink ])
+		tracer.enabled = False
+
+		with tracer.span('op', '/a'):
+			pass
+
+		self.assertIs(tracer.span('op'), NULL_SPAN)
+		self.assertEqual(sink.spans(), [])
+
+	def test_tracerWithoutSinksShouldBeDisabled(self):
+		self.assertFalse(Tracer().enabled)
+
+	def test_spanShouldRecordNameDurationAndParent(self):
+		sink = RingBufferSink(10)
+		tracer = Tracer([ sink ])
+
+		with tracer.span('outer', '/a'):
+			with tracer.span('inner', '/a'):
+				pass
+
+		(inner, outer) = sink.spans()
+		self.assertEqual((inner['name'], outer['name']), ('inner', 'outer'))
+		self.assertEqual(inner['parent'], outer['id'])
+		self.assertEqual(outer['parent'], None)
+		self.assertEqual(outer['path'], '/a')
+		self.assertTrue(outer['duration_ms'] >= inner['duration_ms'] >= 0)
+
+	def test_spanShouldRecordErrors(self):
+		sink = RingBufferSink(10)
+		tracer = Tracer([ sink ])
+
+		try:
+			with tracer.span('op'):
+				raise OSError()
+		except OSError:
+			pass
+
+		self.assertEqual(sink.spans()[0]['error'], 'OSError')
+
+	def test_ringBufferShouldKeepMostRecentSpans(self):
+		sink = RingBufferSink(2)
+		tracer = Tracer([ sink ])
+
+		for name in [ 'a', 'b', 'c' ]:
+			with tracer.span(name):
+				pass
+
+		self.assertEqual([ s['name'] for s in sink.spans() ], [ 'b', 'c' ])
+		self.assertEqual([ json.loads(l)['name'] for l in sink.format().splitlines() ], [ 'b', 'c' ])
+
+	def test_jsonLinesSinkShouldAppendSpans(self):
+		(fd, path) = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			tracer = Tracer([ JsonLinesSink(path) ])
+			with tracer.span('op', '/a'):
+				pass
+			tracer.close()
+
+			with open(path) as f:
+				lines = [ json.loads(l) for l in f ]
+
+			self.assertEqual(len(lines), 1)
+			self.assertEqual((lines[0]['name'], lines[0]['path']), ('op', '/a'))
+		finally:
+			os.remove(path)
+
+class SamplingProfilerTest(unittest.TestCase):
+	def test_sampleShouldCountStacksOfOtherThreads(self):
+		profiler = SamplingProfiler()
+		started = threading.Event()
+		stop = threading.Event()
+
+		def busy_function():
+			started.set()
+			stop.wait()
+
+		thread = threading.Thread(target = busy_function)
+		thread.start()
+		started.wait()
+		try:
+			profiler.sample()
+			profiler.sample()
+		finally:
+			stop.set()
+			thread.join()
+
+		lines = [ l for l in profiler.report().splitlines() if 'busy_function' in l ]
+		self.assertEqual(len(lines), 1)
+		self.assertTrue(lines[0].endswith(' 2'))
+
+	def test_startAndStopShouldControlSampling(self):
+		profiler = SamplingProfiler(interval = 0.001)
+
+		profiler.start()
+		self.assertTrue(profiler.is_running())
+		while profiler.report() == '':
+			time.sleep(0.001)
+		profiler.stop()
+
+		self.assertFalse(profiler.is_running())
+		self.assertNotEqual(profiler.report(), '')
@@ -120,3 +120,42 @@ class UnderlyingFsTest(unittest.TestCase):
 		file_handle = mock_open.return_value.__enter__.return_value
 		file_handle.seek.assert_called_with(3)
 		file_handle.read.assert_called_with(400)
+
+	def test_readdirplusShouldStatEveryEntry(self):
+		# Given
+		ufs = pcachefs.UnderlyingFs('/path/to', stat_threads = 2)
+
+		os.path.isdir = MagicMock(return_value=True)
+		os.listdir = MagicMock(return_value=[ 'file1', 'file2' ])
+		ufs.getattr = MagicMock(side_effect=lambda path: 'stat of ' + path)
+
+		# When
+		(dirents, stats) = ufs.readdirplus('/test_dir')
+
+		# Then
+		self.assertEqual([ d.name for d in dirents ], [ '.', '..', 'file1', 'file2' ])
+		self.assertEqual(stats, [
+			('/test_dir/file1', 'stat of /test_dir/file1'),
+			('/test_dir/file2', 'stat of /test_dir/file2') ])
+
+	def test_readdirplusShouldSkipStatOfEntriesWhichVanish(self):
+		import errno
+
+		# Given
+		ufs = pcachefs.UnderlyingFs('/path/to')
+
+		def getattr(path):
+			if path == '/test_dir/file1':
+				raise OSError(errno.ENOENT, 'No such file or directory')
+			return 'stat of ' + path
+
+		os.path.isdir = MagicMock(return_value=True)
+		os.listdir = MagicMock(return_value=[ 'file1', 'file2' ])
+		ufs.getattr = MagicMock(side_effect=getattr)
+
+		# When
+		(dirents, stats) = ufs.readdirplus('/test_dir')
+
+		# Then
+		self.assertEqual(len(dirents), 4)
+		self.assertEqual(stats, [ ('/test_dir/file2', 'stat of /test_dir/file2') ])
@@ -0,0 +1,115 @@
+import unittest
+
+import os, shutil, tempfile
+
+import pcachefs
+import pcachefs.pcachefs as pcachefsinternal
+import pcachefs.pcachefsutil as pcachefsutil
+from pcachefs.warm import (Warmer, find_files, main)
+
+class WarmTest(unittest.TestCase):
+	def setUp(self):
+		# undo the module patching done by CacherTest
+		import __builtin__
+		pcachefsinternal.os = os
+		pcachefsinternal.__builtin__ = __builtin__
+
+		self.origin = tempfile.mkdtemp()
+		self.cachedir = tempfile.mkdtemp()
+		self.debug = pcachefsutil.DEBUG
+
+		os.makedirs(os.path.join(self.origin, 'd', 'e'))
+		self._write('/a', 'x' * 25)
+		self._write('/d/b', 'y' * 100)
+		self._write('/d/e/c.log', 'z' * 5)
+
+	def tearDown(self):
+		pcachefsutil.DEBUG = self.debug
+		shutil.rmtree(self.origin)
+		shutil.rmtree(self.cachedir)
+
+	def _write(self, path, data):
+		with open(self.origin + path, 'wb') as f:
+			f.write(data)
+
+	def _read(self, path):
+		with open(self.origin + path, 'rb') as f:
+			return f.read()
+
+	def _cacher(self, **kw):
+		return pcachefs.Cacher(self.cachedir, pcachefs.UnderlyingFs(self.origin), block_size = 10, **kw)
+
+	def _cached(self, path):
+		cacher = self._cacher()
+		try:
+			return list(cacher._open_coverage(path).ranges.pairs())
+		finally:
+			cacher.close()
+
+	def _main(self, *args):
+		return main([ '-c', self.cachedir, '-t', self.origin, '--block-size', '10', '--report-interval', '0' ] + list(args))
+
+	def test_findFilesShouldExpandDirectoriesAndGlobs(self):
+		self.assertEqual(find_files(self.origin, [ '/a' ]), [ '/a' ])
+		self.assertEqual(find_files(self.origin, [ 'd' ]), [ '/d/b', '/d/e/c.log' ])
+		self.assertEqual(find_files(self.origin, [ 'd/*/*.log', 'a', '/a' ]), [ '/a', '/d/e/c.log' ])
+		self.assertEqual(find_files(self.origin, [ '' ]), [ '/a', '/d/b', '/d/e/c.log' ])
+		self.assertEqual(find_files(self.origin, [ 'missing' ]), [])
+
+	def test_warmShouldCacheWholeFiles(self):
+		cacher = self._cacher()
+
+		progress = Warmer(cacher, threads = 2, chunk_size = 20).warm([ '/a', '/d/b' ], report_interval = 0)
+		cacher.close()
+
+		self.assertEqual(progress.files_done, 2)
+		self.assertEqual(progress.files_failed, 0)
+		self.assertEqual(progress.bytes_fetched, 125)
+		self.assertEqual(self._cached('/a'), [ (0, 25) ])
+		self.assertEqual(self._cached('/d/b'), [ (0, 100) ])
+
+	def test_warmShouldOnlyCacheStartOfFilesWithMaxBytes(self):
+		cacher = self._cacher()
+
+		Warmer(cacher, max_bytes = 15).warm([ '/d/b' ], report_interval = 0)
+		cacher.close()
+
+		self.assertEqual(self._cached('/d/b'), [ (0, 20) ])
+
+	def test_warmShouldCountFilesWhichFail(self):
+		cacher = self._cacher()
+
+		progress = Warmer(cacher).warm([ '/a', '/missing' ], report_interval = 0)
+		cacher.close()
+
+		self.assertEqual(progress.files_done, 2)
+		self.assertEqual(progress.files_failed, 1)
+
+	def test_mainShouldWarmGivenPathsAndPathsFromFile(self):
+		paths = os.path.join(self.cachedir, 'paths')
+		with open(paths, 'w') as f:
+			f.write('d/e\n')
+
+		self.assertEqual(self._main('a', '--from-file', paths, '--max-bytes', '20'), 0)
+
+		self.assertEqual(self._cached('/a'), [ (0, 20) ])
+		self.assertEqual(self._cached('/d/b'), [])
+		self.assertEqual(self._cached('/d/e/c.log'), [ (0, 5) ])
+
+	def test_mainShouldRejectBadOptions(self):
+		self.assertRaises(SystemExit, main, [ '-t', self.origin, 'a' ])
+		self.assertRaises(SystemExit, main, [ '-c', self.cachedir, '-t', self.origin ])
+		self.assertRaises(SystemExit, self._main, 'a', '--max-bytes', 'lots')
+		self.assertRaises(SystemExit, self._main, 'a', '--metadata-store', 'none')
+		self.assertRaises(SystemExit, self._main, 'a', '--compress', 'none')
+
+	def test_mainShouldRefuseCacheWithDataNotWrittenBack(self):
+		cacher = self._cacher(write_back = True, write_back_interval = 3600)
+		cacher.write('/a', 'XYZ', 0)
+		cacher.writer.stop()
+		cacher.metadata.close()
+
+		self.assertEqual(self._main('a'), 1)
+
+		self.assertEqual(self._read('/a'), 'x' * 25)
+		self.assertEqual(pcachefs.FileMetadataStore(self.cachedir).get_dirty_paths(), set([ '/a' ]))